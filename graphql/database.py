@@ -11,6 +11,9 @@ DB_NAME = config['mongodb']['DB_NAME']
 OVERALL_STATS_COLLECTION_NAME = config['mongodb']['OVERALL_STATS_COLLECTION_NAME']
 OVERALL_REFERENCE_COLLECTION_NAME = config['mongodb']['OVERALL_REFERENCE_STATS_COLLECTION_NAME']
 DATA_STATS_COLLECTION_NAME = config['mongodb']['COLLECTION_NAME_DATA']
+SENSOR_STATS_COLLECTION_NAME = config.get('mongodb', 'SENSOR_STATS_COLLECTION_NAME', fallback='sensor_overall_stats')
+STATS_COLLECTION_NAME = config.get('mongodb', 'COLLECTION_NAME_STATS', fallback='sensor_stats')
+JOBS_COLLECTION_NAME = config.get('mongodb', 'COLLECTION_NAME_AGGREGATE', fallback='to_aggregate')
 
 # MongoDB Client
 client = MongoClient(DB_URI)
@@ -18,3 +21,7 @@ db = client[DB_NAME]
 overall_stats_collection = db[OVERALL_STATS_COLLECTION_NAME]
 overall_reference_collection = db[OVERALL_REFERENCE_COLLECTION_NAME]
 collection = db[DATA_STATS_COLLECTION_NAME]
+sensor_overall_stats_collection = db[SENSOR_STATS_COLLECTION_NAME]
+# Uploads not aggregated yet, for the freshness query
+stats_collection = db[STATS_COLLECTION_NAME]
+jobs_collection = db[JOBS_COLLECTION_NAME]
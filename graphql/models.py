@@ -1,5 +1,11 @@
 import strawberry
 from typing import List, Optional
+from sketches import sketch_cache, equal_width_splits
+
+@strawberry.type
+class SketchHistogram:
+    edges: List[float]
+    pmf: List[float]
 
 @strawberry.type
 class Metric:
@@ -7,12 +13,57 @@ class Metric:
     submetric: Optional[str]
     pmf: List[float]
     x: List[float]
+    # Merged sketch stored with the stats document, and its cache key
+    sketch_bytes: strawberry.Private[Optional[bytes]] = None
+    sketch_key: strawberry.Private[Optional[tuple]] = None
+
+    def sketch(self):
+        if self.sketch_bytes is None:
+            return None
+        return sketch_cache.get(self.sketch_key, self.sketch_bytes)
+
+    @strawberry.field
+    def quantiles(self, ps: List[float]) -> Optional[List[float]]:
+        sketch = self.sketch()
+        if sketch is None or sketch.is_empty():
+            return None
+        return [sketch.get_quantile(p) for p in ps]
+
+    @strawberry.field
+    def cdf(self, points: List[float]) -> Optional[List[float]]:
+        sketch = self.sketch()
+        if sketch is None or sketch.is_empty():
+            return None
+        # The sketch takes sorted unique points and returns one more value, the total mass
+        unique_points = sorted(set(points))
+        cdf = dict(zip(unique_points, sketch.get_cdf(unique_points)[:-1])) if unique_points else {}
+        return [cdf[point] for point in points]
+
+    @strawberry.field
+    def rank(self, value: float) -> Optional[float]:
+        sketch = self.sketch()
+        if sketch is None or sketch.is_empty():
+            return None
+        return sketch.get_rank(value)
+
+    @strawberry.field
+    def histogram(self, bins: int = 30) -> Optional[SketchHistogram]:
+        sketch = self.sketch()
+        if sketch is None or sketch.is_empty():
+            return None
+        splits = equal_width_splits(sketch, bins)
+        return SketchHistogram(edges=[sketch.get_min_value()] + splits + [sketch.get_max_value()],
+                               pmf=sketch.get_pmf(splits) if splits else [1.0])
 
 @strawberry.type
 class DistanceValues:
     PSI: Optional[float]
     Pearson: Optional[float]
     Euclidean: Optional[float]
+    KS: Optional[float] = None
+    SketchWasserstein: Optional[float] = None
+    SketchPSI: Optional[float] = None
+    SketchJS: Optional[float] = None
 
 @strawberry.type
 class Distance:
@@ -40,6 +91,45 @@ class OverallStats:
     project_id: str
     histograms: List[Histogram]
 
+@strawberry.type
+class LatencyBucket:
+    # Upper bound in seconds, None for the last, unbounded bucket
+    le: Optional[float]
+    count: int
+
+@strawberry.type
+class StageLatency:
+    stage: str
+    count: int
+    sum: float
+    max: float
+    mean: Optional[float]
+    buckets: List[LatencyBucket]
+
+@strawberry.type
+class SensorFreshness:
+    sensor_id: str
+    newest_received_at: float
+    aggregated_at: Optional[float]
+    lag_seconds: float
+
+@strawberry.type
+class PendingUploads:
+    uploads: int
+    oldest_received_at: Optional[float]
+    oldest_age_seconds: Optional[float]
+
+@strawberry.type
+class Freshness:
+    project_id: str
+    last_aggregated_at: Optional[float]
+    newest_received_at: Optional[float]
+    lag_seconds: Optional[float]
+    uploads: int
+    stages: List[StageLatency]
+    sensors: List[SensorFreshness]
+    pending: PendingUploads
+
 @strawberry.type
 class DataEntry:
     timestamp: str
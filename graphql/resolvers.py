@@ -1,7 +1,12 @@
 from typing import Optional, List
-from database import collection, overall_stats_collection, overall_reference_collection
-from models import Metric, MetricDistances, Project, DataEntry, MetricData, MetricType, SensorType, Distances, Distance, DistanceValues
+from database import (collection, overall_stats_collection, overall_reference_collection, sensor_overall_stats_collection,
+                      stats_collection, jobs_collection)
+from models import (Metric, MetricDistances, Project, DataEntry, MetricData, MetricType, SensorType, Distances, Distance,
+                    DistanceValues, Freshness, StageLatency, LatencyBucket, SensorFreshness, PendingUploads)
+# Shared with the upload server, copied from server/ into the GraphQL image
+from freshness import load_freshness
 import re
+import time
 from datetime import datetime, timezone, timedelta
 
 def get_metric_stats(project_id: str, metric: str, submetric: Optional[str] = None, reference: Optional[bool] = False) -> Optional[Metric]:
@@ -17,15 +22,46 @@ def get_metric_stats(project_id: str, metric: str, submetric: Optional[str] = No
                         metric=histogram['metric'],
                         submetric=histogram['submetric'],
                         pmf=histogram['pmf'],
-                        x=histogram['x']
+                        x=histogram['x'],
+                        sketch_bytes=histogram.get('sketch'),
+                        sketch_key=(result['_id'], histogram['metric'], histogram['submetric'])
+                    )
+    return None
+
+
+def get_window_metric_stats(project_id: str, metric: str, window: str, submetric: Optional[str] = None) -> Optional[Metric]:
+    # Sliding windows are precomputed by the aggregator from its rollup buckets
+    results = overall_stats_collection.find({"project_id": project_id, "windows.window": window}).sort("last_updated", -1).limit(1)
+    for result in results:
+        for stats in result['windows']:
+            if stats['window'] != window:
+                continue
+            for histogram in stats['histograms']:
+                if histogram['metric'] == metric and (submetric is None or histogram['submetric'] == submetric):
+                    return Metric(
+                        metric=histogram['metric'],
+                        submetric=histogram['submetric'],
+                        pmf=histogram['pmf'],
+                        x=histogram['x'],
+                        sketch_bytes=histogram.get('sketch'),
+                        sketch_key=(result['_id'], window, histogram['metric'], histogram['submetric'])
                     )
     return None
 
 
 def get_metric_distances(project_id: str) -> MetricDistances:
-    # Fetch all documents for the given project_id
-    documents = overall_stats_collection.find({"project_id": project_id})
-    
+    # Fetch the distances of all documents of the project, without their histograms and sketches
+    documents = overall_stats_collection.find({"project_id": project_id}, {"last_updated": 1, "distance": 1})
+    return distances_from_documents(project_id, documents)
+
+
+def get_sensor_metric_distances(project_id: str, sensor_id: str, limit: int = 100) -> MetricDistances:
+    # Per-sensor drift written by the aggregator, newest first
+    documents = sensor_overall_stats_collection.find({"project_id": project_id, "sensor_id": sensor_id}).sort("last_updated", -1).limit(limit)
+    return distances_from_documents(project_id, documents)
+
+
+def distances_from_documents(project_id: str, documents) -> MetricDistances:
     # Initialize the result
     distances_list = []
 
@@ -45,7 +81,11 @@ def get_metric_distances(project_id: str) -> MetricDistances:
                 distancevalues=DistanceValues(
                     PSI=d['distances'].get('PSI'),
                     Pearson=d['distances'].get('Pearson'),
-                    Euclidean=d['distances'].get('Euclidean')
+                    Euclidean=d['distances'].get('Euclidean'),
+                    KS=d['distances'].get('KS'),
+                    SketchWasserstein=d['distances'].get('SketchWasserstein'),
+                    SketchPSI=d['distances'].get('SketchPSI'),
+                    SketchJS=d['distances'].get('SketchJS')
                 )
             )
             for d in distances if d['distances']  # Ensure the distances dictionary is not empty
@@ -60,35 +100,72 @@ def get_metric_distances(project_id: str) -> MetricDistances:
 
 
 
-def transform_data(doc):
+def stage_latency(stage: str, histogram) -> StageLatency:
+    if histogram is None:
+        return StageLatency(stage=stage, count=0, sum=0.0, max=0.0, mean=None, buckets=[])
+    bounds = histogram["le"] + [None]
+    return StageLatency(stage=stage, count=histogram["count"], sum=histogram["sum"], max=histogram["max"],
+                        mean=histogram["sum"] / histogram["count"] if histogram["count"] else None,
+                        buckets=[LatencyBucket(le=bound, count=count) for bound, count in zip(bounds, histogram["counts"])])
+
+def get_freshness(project_id: str, window_seconds: int = 86400, sensor_id: Optional[str] = None, limit: int = 100) -> Freshness:
+    # Stage latencies of the aggregates of the window, and the lag of the newest upload each one holds
+    report = load_freshness(overall_stats_collection, sensor_overall_stats_collection, project_id, window_seconds,
+                            time.time(), jobs_collection, stats_collection, sensor_id)
+    pending = report["pending"]
+    return Freshness(
+        project_id=project_id,
+        last_aggregated_at=report["last_aggregated_at"],
+        newest_received_at=report["newest_received_at"],
+        lag_seconds=report["lag_seconds"],
+        uploads=report["uploads"],
+        stages=[stage_latency(stage, histogram) for stage, histogram in report["stages"].items()],
+        sensors=[SensorFreshness(**sensor) for sensor in report["sensors"][:limit]],
+        pending=PendingUploads(uploads=pending["uploads"], oldest_received_at=pending["oldest_received_at"],
+                               oldest_age_seconds=pending["oldest_age_seconds"])
+    )
+
+
+def transform_data(doc, metrictype_filter=None, metric_filter=None, submetric_filter=None):
     sensor_data = {}
     for entry in doc["type"]:
         metrictype = entry["metrictype"]
+        if metrictype_filter and metrictype != metrictype_filter:
+            continue
         if doc["sensor_id"] not in sensor_data:
             sensor_data[doc["sensor_id"]] = {"sensorId": doc["sensor_id"], "timestamp": doc["timestamp"], "data": []}
         
         metrics = []
         for metric_entry in entry["data"]:
+            if metric_filter and metric_entry["metric"] != metric_filter:
+                continue
+            if submetric_filter is not None and metric_entry["submetric"] != submetric_filter:
+                continue
             data_entries = []
-            for url in metric_entry["data"]:
-                data_entries.append(DataEntry(timestamp=extract_timestamp_and_convert(url), url=url))
+            for sample in metric_entry["data"]:
+                if isinstance(sample, dict):
+                    # Timestamp parsed by the data worker at ingest
+                    data_entries.append(DataEntry(timestamp=format_sample_timestamp(sample["timestamp"]), url=sample["url"]))
+                else:
+                    data_entries.append(DataEntry(timestamp=extract_timestamp_and_convert(sample), url=sample))
             metrics.append(MetricData(metric=metric_entry["metric"], submetric=metric_entry["submetric"], data=data_entries))
         sensor_data[doc["sensor_id"]]["data"].append(MetricType(metrictype=metrictype, data=metrics))
 
     return sensor_data
 
+def format_sample_timestamp(timestamp_us: int) -> str:
+    # Convert to datetime
+    dt = datetime.fromtimestamp(timestamp_us/1000000, tz=timezone.utc)
+    # Format datetime to string
+    return dt.strftime('%Y-%m-%d %H:%M:%S.%f %Z')
+
 def extract_timestamp_and_convert(url: str) -> str:
     # Regular expression to match the timestamp in the URL
     pattern = r'_(\d+)\.png'
     match = re.search(pattern, url)
     if not match:
         raise ValueError("No timestamp found in the URL")
-    timestamp_ms = int(match.group(1))
-    # Convert to datetime
-    dt = datetime.fromtimestamp(timestamp_ms/1000000, tz=timezone.utc)
-    # Format datetime to string
-    dt_str = dt.strftime('%Y-%m-%d %H:%M:%S.%f %Z')
-    return dt_str
+    return format_sample_timestamp(int(match.group(1)))
 
 def fetch_project_data(projectName: str, metrictype: Optional[str] = None, metric: Optional[str] = None,
                        submetric: Optional[str] = None, timestamp: Optional[str] = None, sensorId: Optional[str] = None):
@@ -98,13 +175,14 @@ def fetch_project_data(projectName: str, metrictype: Optional[str] = None, metri
     if sensorId:
         query["sensor_id"] = sensorId
 
-    cursor = collection.find(query)
+    # Served by the (project_name, sensor_id, timestamp) index created by the data worker
+    cursor = collection.find(query).sort([("sensor_id", 1), ("timestamp", -1)])
     projects = {}
     for doc in cursor:
         if doc["project_name"] not in projects:
             projects[doc["project_name"]] = {"projectName": doc["project_name"], "status": doc["status"], "data": []}
         
-        sensor_data = transform_data(doc)
+        sensor_data = transform_data(doc, metrictype, metric, submetric)
         for sensorId, data in sensor_data.items():
             projects[doc["project_name"]]["data"].append(SensorType(**data))
     project_data = projects.get(projectName, None)
@@ -1,7 +1,7 @@
 import strawberry
 from typing import Optional, List
-from models import Metric, Project, MetricDistances
-from resolvers import get_metric_stats, fetch_project_data, get_metric_distances
+from models import Metric, Project, MetricDistances, Freshness
+from resolvers import get_metric_stats, fetch_project_data, get_metric_distances, get_window_metric_stats, get_sensor_metric_distances, get_freshness
 
 @strawberry.type
 class Query:
@@ -13,8 +13,20 @@ class Query:
     def project(self, projectName: str, metrictype: Optional[str] = None, metric: Optional[str] = None, submetric: Optional[str] = None, timestamp: Optional[str] = None, sensorId: Optional[str] = None) -> Project:
         return fetch_project_data(projectName, metrictype, metric, submetric, timestamp, sensorId)
 
+    @strawberry.field
+    def window_metric_stats(self, project_id: str, metric: str, window: str, submetric: Optional[str] = None) -> Optional[Metric]:
+        return get_window_metric_stats(project_id, metric, window, submetric)
+
     @strawberry.field
     def metric_distances(self, project_id: str) -> Optional[MetricDistances]:
         return get_metric_distances(project_id)
 
+    @strawberry.field
+    def sensor_metric_distances(self, project_id: str, sensor_id: str, limit: int = 100) -> Optional[MetricDistances]:
+        return get_sensor_metric_distances(project_id, sensor_id, limit)
+
+    @strawberry.field
+    def freshness(self, project_id: str, window_seconds: int = 86400, sensor_id: Optional[str] = None, limit: int = 100) -> Freshness:
+        return get_freshness(project_id, window_seconds, sensor_id, limit)
+
 schema = strawberry.Schema(query=Query)
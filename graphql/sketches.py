@@ -0,0 +1,55 @@
+import configparser
+import threading
+from collections import OrderedDict
+
+from datasketches import kll_floats_sketch
+
+config = configparser.ConfigParser()
+config.read("config.ini")
+
+SKETCH_CACHE_SIZE = config.getint('graphql', 'SKETCH_CACHE_SIZE', fallback=1024)
+
+
+class SketchCache:
+    """LRU of deserialized sketches keyed by (stats document _id, metric, submetric)."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, serialized):
+        """Return the sketch cached under `key`, deserializing `serialized` on a miss."""
+        with self._lock:
+            sketch = self._entries.get(key)
+            if sketch is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return sketch
+            self.misses += 1
+        sketch = kll_floats_sketch.deserialize(serialized)
+        with self._lock:
+            self._entries[key] = sketch
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return sketch
+
+
+sketch_cache = SketchCache(SKETCH_CACHE_SIZE)
+
+
+def equal_width_splits(sketch, bins):
+    """
+    Return the split points of `bins` equal-width bins between the sketch min and max.
+
+    A constant sketch has no split points: all its mass is in one bin.
+    """
+    if bins < 1:
+        raise ValueError("bins must be at least 1")
+    low, high = sketch.get_min_value(), sketch.get_max_value()
+    if high == low:
+        return []
+    step = (high - low) / bins
+    return [low + i * step for i in range(1, bins)]
@@ -1,13 +1,28 @@
 import os
+import sys
 import time
 import configparser
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from datasketches import kll_floats_sketch
 from helpers import compute_histogram
 import numpy as np
 from scipy.stats import pearsonr
-from quantilemetrics import QuantileMetrics
+from quantilemetrics import batch_metrics
+from sketchmetrics import batch_sketch_metrics
+from notifier import subscriber_from_config
+from segment_store import SegmentReader, compact_segments
+from sketch_merge import merge_groups
+from sketch_cache import SketchCache, sketch_cache_key
+from reference_baseline import ReferenceBaseline
+from freshness import STAGES, LATENCY_BUCKETS, upload_freshness
+from rollups import (parse_duration, parse_granularities, snapshot_time, bucket_start, rollup_key, rollup_expiry,
+                     ensure_rollup_indexes, window_sketches)
+from telemetry import Counter, Gauge, Histogram, mongo_command_metrics, start_metrics_server
 from logger import setup_logger
 import logging
 
@@ -27,18 +42,100 @@ OVERALL_STATS_COLLECTION_NAME = config.get('mongodb', 'OVERALL_STATS_COLLECTION_
 OVERALL_REFERENCE_STATS_COLLECTION_NAME = config.get('mongodb', 'OVERALL_REFERENCE_STATS_COLLECTION_NAME', fallback='reference_stats')
 PROJECT_ID = config.get('DEFAULT', 'PROJECT_ID', fallback='default_project_id')
 SLEEP_INTERVAL = config.getint('DEFAULT', 'SLEEP_INTERVAL', fallback=10)
+AGGREGATE_STATE_COLLECTION_NAME = config.get('mongodb', 'AGGREGATE_STATE_COLLECTION_NAME', fallback='aggregate_state')
+AGGREGATION_BATCH_SIZE = config.getint('aggregator', 'BATCH_SIZE', fallback=1000)
+EXECUTION_MODE = config.get('aggregator', 'EXECUTION_MODE', fallback='thread')
+MERGE_WORKERS = config.getint('aggregator', 'NUM_WORKERS', fallback=0) or os.cpu_count() or 1
+MERGE_FAN_IN = config.getint('aggregator', 'MERGE_FAN_IN', fallback=64)
+SKETCH_CACHE_MB = config.getint('aggregator', 'SKETCH_CACHE_MB', fallback=64)
+PREWARM_SNAPSHOTS = config.getint('aggregator', 'PREWARM_SNAPSHOTS', fallback=0)
+ROLLUP_COLLECTION_NAME = config.get('mongodb', 'ROLLUP_COLLECTION_NAME', fallback='stats_rollups')
+ROLLUP_GRANULARITIES = parse_granularities(config.get('aggregator', 'ROLLUP_GRANULARITIES', fallback='5m:2d,1h:30d,1d'))
+SENSOR_STATS_COLLECTION_NAME = config.get('mongodb', 'SENSOR_STATS_COLLECTION_NAME', fallback='sensor_overall_stats')
+SENSOR_STATS_RETENTION = parse_duration(config.get('aggregator', 'SENSOR_STATS_RETENTION', fallback='30d'))
+OVERALL_STATS_RETENTION = parse_duration(config.get('aggregator', 'OVERALL_STATS_RETENTION', fallback='30d'))
+SLIDING_WINDOWS = [(window.strip(), parse_duration(window)) for window in
+                   config.get('aggregator', 'SLIDING_WINDOWS', fallback='1h,24h,7d').split(',') if window.strip()]
+SEGMENT_ROOT = str(BASE_PATH / "lensai" / "segments")
+METRICS_HOST = config.get('metrics', 'HOST', fallback='0.0.0.0')
+METRICS_PORT = config.getint('metrics', 'AGGREGATOR_PORT', fallback=9103)
+SEGMENT_COMPACT_INTERVAL = config.getint('storage', 'SEGMENT_COMPACT_INTERVAL', fallback=3600)
+SEGMENT_MIN_DEAD_RATIO = config.getfloat('storage', 'SEGMENT_MIN_DEAD_RATIO', fallback=0.5)
+
+# Distances stored with the stats, by the QuantileMetrics metric of the histograms they come from
+HISTOGRAM_DRIFT_METRICS = {"PSI": "psi", "Pearson": "pearson_correlation", "Euclidean": "euclidean_distance"}
+# and by the SketchMetrics metric of the merged sketches
+SKETCH_DRIFT_METRICS = {"KS": "ks_statistic", "SketchWasserstein": "wasserstein_distance",
+                        "SketchPSI": "psi", "SketchJS": "jensen_shannon_divergence"}
+DRIFT_METRICS = [name.strip() for name in config.get(
+    'aggregator', 'DRIFT_METRICS', fallback='PSI,Pearson,Euclidean,KS,SketchWasserstein,SketchPSI,SketchJS').split(',')
+    if name.strip()]
+_unknown_drift_metrics = set(DRIFT_METRICS) - set(HISTOGRAM_DRIFT_METRICS) - set(SKETCH_DRIFT_METRICS)
+if _unknown_drift_metrics:
+    raise ValueError(f"Unknown DRIFT_METRICS: {', '.join(sorted(_unknown_drift_metrics))}")
+
+# Threads reading sketch bytes, and the pool merging them. A process pool, if configured, is
+# forked at startup before the MongoDB client and the metrics server start any threads.
+read_executor = ThreadPoolExecutor(max_workers=MERGE_WORKERS)
+merge_executor = read_executor
+if __name__ == "__main__" and EXECUTION_MODE == "process":
+    # Deserializing and merging are CPU-bound, run them in worker processes
+    merge_executor = ProcessPoolExecutor(max_workers=MERGE_WORKERS, mp_context=multiprocessing.get_context("fork"))
+    merge_executor.submit(os.getpid).result()  # Fork the whole pool now
+    logging.info(f"Merging sketches in {MERGE_WORKERS} processes")
 
 # MongoDB Client
 try:
-    client = MongoClient(DB_URI)
+    client = MongoClient(DB_URI, event_listeners=[mongo_command_metrics])
     db = client[DB_NAME]
     collection = db[COLLECTION_NAME]
     overall_stats_collection = db[OVERALL_STATS_COLLECTION_NAME]
+    overall_stats_collection.create_index([("project_id", 1), ("last_updated", -1)])
+    # Every document carries the histograms and sketches of all metrics and windows, keep a bounded history
+    overall_stats_collection.create_index("expire_at", expireAfterSeconds=0)
     overall_reference_stats_collection = db[OVERALL_REFERENCE_STATS_COLLECTION_NAME]
+    aggregate_state_collection = db[AGGREGATE_STATE_COLLECTION_NAME]
+    aggregate_state_collection.create_index([("project_id", 1), ("metric", 1), ("submetric", 1)], unique=True)
+    rollup_collection = db[ROLLUP_COLLECTION_NAME]
+    ensure_rollup_indexes(rollup_collection)
+    sensor_overall_stats_collection = db[SENSOR_STATS_COLLECTION_NAME]
+    sensor_overall_stats_collection.create_index([("project_id", 1), ("sensor_id", 1), ("last_updated", -1)])
+    sensor_overall_stats_collection.create_index("expire_at", expireAfterSeconds=0)
+    # fleet_drift reads the stats of all sensors in a time window
+    sensor_overall_stats_collection.create_index([("project_id", 1), ("last_updated", -1)])
+    # The uploads folded into an aggregate, and the uploads still waiting for one
+    collection.create_index("aggregation_cycle")
+    collection.create_index([("aggregated", 1), ("received_at", 1)])
 except Exception as e:
     logging.error(f"Error connecting to MongoDB: {e}")
     raise
 
+# Wake-ups for newly completed sensor stats
+subscriber = subscriber_from_config(config, "aggregate", collection)
+
+# Open segments of the segment store, mapped on first read
+segment_reader = SegmentReader()
+
+# Deserialized sketches, keyed by file path, mtime and size or by segment range
+sketch_cache = SketchCache(SKETCH_CACHE_MB * 1024 * 1024)
+
+# Reference baseline for drift, rebuilt only when a new reference upload is aggregated
+reference_baseline = None
+
+# Metrics served on METRICS_PORT
+cycle_seconds = Histogram("lensai_aggregator_cycle_duration_seconds", "Duration of the aggregation cycles that had work",
+                          buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+snapshots_folded = Counter("lensai_aggregator_snapshots_folded_total", "Sensor snapshots folded into the running state")
+sketches_merged = Counter("lensai_aggregator_sketches_merged_total", "Sketches merged, including the running ones merged into")
+stage_seconds = Histogram("lensai_pipeline_stage_seconds", "Latency of the stages of the aggregated uploads",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+Gauge("lensai_aggregator_pending_snapshots", "Completed sensor snapshots waiting to be aggregated").set_function(
+    lambda: collection.count_documents({"status": "completed", "aggregated": {"$in": [0, 2]}}))
+Counter("lensai_aggregator_sketch_cache_hits_total", "Sketch cache hits").set_function(lambda: sketch_cache.hits)
+Counter("lensai_aggregator_sketch_cache_misses_total", "Sketch cache misses").set_function(lambda: sketch_cache.misses)
+Gauge("lensai_aggregator_sketch_cache_bytes", "Size of the deserialized sketches in the cache").set_function(
+    lambda: sketch_cache.bytes)
+
 def compute_psi(original_pmf, reference_pmf, num_bins=1000):
     """Compute the Population Stability Index (PSI)"""
     try:
@@ -65,21 +162,217 @@ def compute_euclidean_distance(original_pmf, reference_pmf):
         logging.error(f"Error computing Euclidean Distance: {e}")
         return None
 
-def get_latest_timestamp_per_sensor():
-    """Fetch the latest timestamp per sensor"""
+def prewarm_sketch_cache(num_snapshots):
+    """
+    Load the sketches of the snapshots waiting to be aggregated into the sketch cache.
+
+    Only pending and in-progress snapshots are read again, by the next cycles and
+    in the order they claim them; folded snapshots are never read again.
+    """
     try:
-        pipeline = [
-            {"$match": {"status": "completed", "aggregated": 0, "sensor_id": {"$ne": "reference"}}},
-            {"$sort": {"timestamp": -1}},
-            {"$group": {
-                "_id": "$sensor_id",
-                "latest_stats": {"$first": "$$ROOT"}
-            }}
-        ]
-        return list(collection.aggregate(pipeline))
+        snapshots = collection.find({"status": "completed", "aggregated": {"$in": [0, 2]}},
+                                    {"type": 1}).sort("_id", 1).limit(num_snapshots)
+        sketch_refs = [sketch_ref for refs in gather_bin_files([{'latest_stats': snapshot} for snapshot in snapshots]).values()
+                       for sketch_ref in refs]
+        list(read_executor.map(read_sketch, sketch_refs))
+        logging.info(f"Pre-warmed the sketch cache with {len(sketch_refs)} sketches: {sketch_cache.stats()}")
     except Exception as e:
-        logging.error(f"Error in getting latest timestamp per sensor: {e}")
-        return []
+        logging.error(f"Error pre-warming the sketch cache: {e}")
+
+def claim_pending_snapshots():
+    """
+    Claim the next batch of completed sensor snapshots to fold into the running state.
+
+    Snapshots move from aggregated 0 to 2 (in progress) under a cycle id and to 1
+    once folded. A batch left in progress by an interrupted cycle is resumed first.
+
+    Returns:
+        A (cycle, snapshots) tuple; snapshots is empty if there is nothing to do.
+    """
+    try:
+        interrupted = collection.find_one({"aggregated": 2}, {"aggregation_cycle": 1})
+        if interrupted:
+            cycle = interrupted["aggregation_cycle"]
+            logging.info(f"Resuming interrupted aggregation cycle {cycle}")
+        else:
+            cycle = time.time_ns()
+            pending = collection.find(
+                {"status": "completed", "aggregated": 0, "sensor_id": {"$ne": "reference"}}, {"_id": 1}
+            ).sort("_id", 1).limit(AGGREGATION_BATCH_SIZE)
+            ids = [doc["_id"] for doc in pending]
+            if not ids:
+                return cycle, []
+            collection.update_many({"_id": {"$in": ids}, "aggregated": 0},
+                                   {"$set": {"aggregated": 2, "aggregation_cycle": cycle}})
+        return cycle, list(collection.find({"aggregated": 2, "aggregation_cycle": cycle}))
+    except Exception as e:
+        logging.error(f"Error claiming pending snapshots: {e}")
+        return None, []
+
+def fold_snapshots(snapshots, cycle):
+    """
+    Merge the sketches of new snapshots into the running sketch of each (metric, submetric)
+    and into the tumbling-window rollup buckets the snapshots fall in.
+
+    A state or rollup document records the cycle that last updated it, so
+    resuming an interrupted cycle never merges the same snapshots twice.
+
+    Returns:
+        A dict of sensor_id to {(metric, submetric): sketch} merging the new
+        snapshots of each sensor, from the sketches already read for the fold.
+    """
+    metrics_files = {}
+    for snapshot in snapshots:
+        snapshot_seconds = snapshot_time(snapshot)
+        for (metric, submetric), sketch_refs in gather_bin_files([{'latest_stats': snapshot}]).items():
+            metrics_files.setdefault(("total", metric, submetric), []).extend(sketch_refs)
+            metrics_files.setdefault(("sensor", snapshot["sensor_id"], metric, submetric), []).extend(sketch_refs)
+            for name, seconds, _ in ROLLUP_GRANULARITIES:
+                key = ("rollup", metric, submetric, name, bucket_start(snapshot_seconds, seconds))
+                metrics_files.setdefault(key, []).extend(sketch_refs)
+
+    states = {}
+    total_keys = [{"metric": key[1], "submetric": key[2]} for key in metrics_files if key[0] == "total"]
+    if total_keys:
+        for state in aggregate_state_collection.find({"project_id": PROJECT_ID, "$or": total_keys}):
+            states[("total", state["metric"], state["submetric"])] = state
+    for name, _, _ in ROLLUP_GRANULARITIES:
+        starts = list({key[4] for key in metrics_files if key[0] == "rollup" and key[3] == name})
+        if starts:
+            for rollup in rollup_collection.find({"project_id": PROJECT_ID, "granularity": name,
+                                                  "bucket_start": {"$in": starts}}):
+                states[("rollup", rollup["metric"], rollup["submetric"], name, rollup["bucket_start"])] = rollup
+
+    # Keys already folded by an interrupted run of this cycle are skipped
+    pending_files = {key: sketch_refs for key, sketch_refs in metrics_files.items()
+                     if states.get(key, {}).get("last_cycle") != cycle}
+    merged = merge_sketch_groups(pending_files, {key: state["sketch"] for key, state in states.items()})
+
+    now = int(time.time())
+    requests = []
+    rollup_requests = []
+    granularities = {name: (seconds, retention) for name, seconds, retention in ROLLUP_GRANULARITIES}
+    sensor_sketches = {}
+    for key, running in merged.items():
+        if key[0] == "sensor":
+            sensor_sketches.setdefault(key[1], {})[(key[2], key[3])] = running
+            continue
+        update = {"sketch": running.serialize(), "n": running.n, "last_cycle": cycle, "last_updated": now}
+        if key[0] == "total":
+            requests.append(UpdateOne({"project_id": PROJECT_ID, "metric": key[1], "submetric": key[2]},
+                                      {"$set": update}, upsert=True))
+        else:
+            _, metric, submetric, name, start = key
+            expire_at = rollup_expiry(start, *granularities[name])
+            if expire_at is not None:
+                update["expire_at"] = expire_at
+            rollup_requests.append(UpdateOne(rollup_key(PROJECT_ID, metric, submetric, name, start),
+                                             {"$set": update}, upsert=True))
+    if rollup_requests:
+        rollup_collection.bulk_write(rollup_requests, ordered=False)
+    if requests:
+        aggregate_state_collection.bulk_write(requests, ordered=False)
+    return sensor_sketches
+
+def compute_sensor_stats(sensor_sketches, baseline, freshness=None):
+    """
+    Build the per-sensor stats documents: the histogram and sketch of every
+    metric of a sensor and its drift against the reference. fleet_drift merges
+    the sketches to compare sensors with each other. `freshness` optionally maps
+    sensor ids to the upload_freshness of their snapshots in this cycle.
+
+    Drift is computed as for the overall stats: the histogram metrics with
+    batch_metrics against the reference HistogramBaseline, the sketch metrics
+    for all sensors of a metric at once.
+    """
+    now = int(time.time())
+    documents = {}
+    for sensor_id, sketches in sensor_sketches.items():
+        document = {"project_id": PROJECT_ID, "sensor_id": sensor_id, "last_updated": now,
+                    "histograms": [], "distance": []}
+        if SENSOR_STATS_RETENTION:
+            document["expire_at"] = datetime.fromtimestamp(now + SENSOR_STATS_RETENTION, tz=timezone.utc)
+        if freshness and sensor_id in freshness:
+            document["aggregation_cycle"] = freshness[sensor_id]["aggregation_cycle"]
+            document["freshness"] = freshness[sensor_id]
+        for (metric, submetric), sketch in sorted(sketches.items()):
+            x, pmf = compute_histogram(sketch)
+            if pmf and x:
+                document["histograms"].append({"metric": metric, "submetric": submetric, "pmf": pmf, "x": x,
+                                               "sketch": sketch.serialize()})
+        documents[sensor_id] = document
+
+    if baseline is not None:
+        histogram_metrics = selected_drift_metrics(HISTOGRAM_DRIFT_METRICS)
+        sketch_metrics = selected_drift_metrics(SKETCH_DRIFT_METRICS)
+        # Distances by (sensor_id, metric, submetric)
+        distances = {}
+        if histogram_metrics:
+            pairs = [((sensor_id, histogram['metric'], histogram['submetric']), histogram,
+                      baseline.get(histogram['metric'], histogram['submetric']))
+                     for sensor_id, document in documents.items() for histogram in document["histograms"]]
+            pairs = [pair for pair in pairs if pair[2] is not None]
+            values = histogram_drift([(histogram, reference) for _, histogram, reference in pairs], histogram_metrics)
+            distances.update((key, distance) for (key, _, _), distance in zip(pairs, values))
+        if sketch_metrics:
+            by_metric = {}
+            for sensor_id, sketches in sensor_sketches.items():
+                for key, sketch in sketches.items():
+                    if not sketch.is_empty():
+                        by_metric.setdefault(key, []).append((sensor_id, sketch))
+            for (metric, submetric), sensors in by_metric.items():
+                sketch_baseline = baseline.get_sketch(metric, submetric)
+                if sketch_baseline is None:
+                    continue
+                values = batch_sketch_metrics([sketch for _, sketch in sensors], sketch_baseline, sketch_metrics.values())
+                for index, (sensor_id, _) in enumerate(sensors):
+                    distances.setdefault((sensor_id, metric, submetric), {}).update(
+                        {name: values[sketch_metric][index].item() for name, sketch_metric in sketch_metrics.items()})
+        for (sensor_id, metric, submetric), distance in sorted(distances.items()):
+            documents[sensor_id]["distance"].append({
+                "metric": metric,
+                "submetric": submetric,
+                # NaN (e.g. Pearson of a constant histogram) is stored as null
+                "distances": {name: None if value != value else value for name, value in distance.items()}
+            })
+    return list(documents.values())
+
+def get_window_histograms(now=None):
+    """Compute the histograms and merged sketches of every sliding window from the rollup buckets it covers"""
+    now = time.time() if now is None else now
+    windows = []
+    for name, seconds in SLIDING_WINDOWS:
+        sketches = window_sketches(rollup_collection, PROJECT_ID, now - seconds, now, ROLLUP_GRANULARITIES, now)
+        histograms = []
+        for (metric, submetric), sketch in sorted(sketches.items()):
+            x, pmf = compute_histogram(sketch)
+            if pmf and x:
+                histograms.append({
+                    "metric": metric,
+                    "submetric": submetric,
+                    "pmf": pmf,
+                    "x": x,
+                    "sketch": sketch.serialize()
+                })
+        windows.append({"window": name, "start": int(now - seconds), "end": int(now), "histograms": histograms})
+    return windows
+
+def get_running_histograms():
+    """Compute the histograms of every running sketch of the project"""
+    histograms = []
+    for state in aggregate_state_collection.find({"project_id": PROJECT_ID}).sort([("metric", 1), ("submetric", 1)]):
+        sketch = kll_floats_sketch.deserialize(state["sketch"])
+        if sketch.is_empty():
+            continue
+        x, pmf = compute_histogram(sketch)
+        histograms.append({
+            "metric": state["metric"],
+            "submetric": state["submetric"],
+            "pmf": pmf,
+            "x": x,
+            "sketch": state["sketch"]
+        })
+    return histograms
 
 def get_latest_reference_data():
     """Fetch the latest reference data"""
@@ -92,13 +385,32 @@ def get_latest_reference_data():
 def get_latest_reference_stats():
     """Fetch the latest reference stats"""
     try:
-        return overall_reference_stats_collection.find_one({"sensor_id": "reference"}, sort=[("timestamp", -1)])
+        return overall_reference_stats_collection.find_one({"project_id": PROJECT_ID}, sort=[("last_updated", -1)])
     except Exception as e:
         logging.error(f"Error in getting latest reference stats: {e}")
         return None
 
+def get_reference_baseline():
+    """
+    Return the baseline of the latest reference stats, loading it on first use.
+
+    The baseline is only replaced when a new reference upload is aggregated.
+    """
+    global reference_baseline
+    if reference_baseline is None:
+        reference_stats = get_latest_reference_stats()
+        if reference_stats:
+            reference_baseline = ReferenceBaseline(reference_stats)
+            logging.info(f"Loaded reference baseline {reference_baseline.reference_id} with {len(reference_baseline)} metrics")
+    return reference_baseline
+
 def gather_bin_files(latest_data):
-    """Gather bin files from the latest data"""
+    """
+    Gather sketch references from the latest data.
+
+    A reference is the path of a .bin file, or a (segment, offset, length)
+    tuple for sketches kept in the segment store.
+    """
     metrics_files = {}
     if latest_data:
         for item in latest_data:
@@ -107,6 +419,10 @@ def gather_bin_files(latest_data):
             for t in types:
                 stats = t.get('stats', [])
                 for stat in stats:
+                    if 'segment' in stat:
+                        key = (stat['metric'], stat['submetric'])
+                        metrics_files.setdefault(key, []).append((stat['segment'], stat['offset'], stat['length']))
+                        continue
                     file_name = os.path.basename(stat.get('path', ''))
                     if file_name.endswith(".bin") and not file_name.startswith("._"):
                         metric, submetric = file_name.split('_', 1) if '_' in file_name else (file_name, "")
@@ -119,25 +435,63 @@ def gather_bin_files(latest_data):
                         metrics_files[key].append(path)
     return metrics_files
 
-def read_sketch(bin_file_path):
-    """Read and deserialize a sketch from a binary file"""
+def read_sketch(sketch_ref):
+    """Read and deserialize a sketch from a binary file or a segment range, through the sketch cache"""
+    key = sketch_cache_key(sketch_ref)
+    sketch = sketch_cache.get(key) if key is not None else None
+    if sketch is not None:
+        return sketch
+    blob = read_sketch_bytes(sketch_ref)
+    if blob is None:
+        return None
+    try:
+        sketch = kll_floats_sketch.deserialize(bytes(blob))
+    except Exception as e:
+        logging.error(f"Error reading sketch from {sketch_ref}: {e}")
+        return None
+    if key is not None:
+        sketch_cache.put(key, sketch, len(blob))
+    return sketch
+
+def read_sketch_bytes(sketch_ref):
+    """Read a serialized sketch from a binary file or a segment range"""
     try:
-        with open(bin_file_path, 'rb') as f:
-            sketch = kll_floats_sketch.deserialize(f.read())
-            return sketch
+        if isinstance(sketch_ref, tuple):
+            return segment_reader.read(*sketch_ref)
+        with open(sketch_ref, 'rb') as f:
+            return f.read()
     except Exception as e:
-        logging.error(f"Error reading sketch from {bin_file_path}: {e}")
+        logging.error(f"Error reading sketch from {sketch_ref}: {e}")
         return None
 
+def merge_sketch_groups(metrics_files, initial=None):
+    """
+    Merge the sketches of each key in parallel.
+
+    Sketches are read concurrently, then merged with a tree reduction on
+    merge_executor. With a thread pool they are taken from the sketch cache
+    and deserialized on a miss; a process pool is sent the serialized bytes.
+    `initial` optionally maps keys to a serialized sketch to merge the group into.
+    A sketch that belongs to several groups is read once.
+
+    Returns:
+        A dict of key to merged kll_floats_sketch.
+    """
+    unique_refs = list(dict.fromkeys(sketch_ref for sketch_refs in metrics_files.values() for sketch_ref in sketch_refs))
+    read = read_sketch if merge_executor is read_executor else read_sketch_bytes
+    blobs = dict(zip(unique_refs, read_executor.map(read, unique_refs)))
+    groups = {}
+    for key, sketch_refs in metrics_files.items():
+        groups[key] = [initial[key]] if initial and key in initial else []
+        groups[key].extend(blobs[sketch_ref] for sketch_ref in sketch_refs if blobs[sketch_ref] is not None)
+    sketches_merged.inc(sum(len(group) for group in groups.values()))
+    return merge_groups(merge_executor, groups, MERGE_FAN_IN)
+
 def aggregate_sketches(bin_file_paths):
     """Aggregate sketches from multiple bin files"""
-    hist_sketch = kll_floats_sketch()
     try:
-        for bin_file_path in bin_file_paths:
-            sketch = read_sketch(bin_file_path)
-            if sketch:
-                hist_sketch.merge(sketch)
-        if not hist_sketch.is_empty():
+        hist_sketch = merge_sketch_groups({None: bin_file_paths}).get(None)
+        if hist_sketch and not hist_sketch.is_empty():
             bin_edges, histogram = compute_histogram(hist_sketch)
             return bin_edges, histogram
         return [], []
@@ -153,50 +507,61 @@ def insert_stats(collection, overall_data):
     except Exception as e:
         logging.error(f"Error inserting stats into {collection.name}: {e}")
 
-def update_aggregated_status(sensor_ids):
-    """Update aggregated status for given sensor IDs"""
+def update_aggregated_status(snapshot_ids, aggregated_at=None):
+    """Mark the given sensor snapshots as aggregated, keeping the cycle that folded them in"""
     try:
         collection.update_many(
-            {"sensor_id": {"$in": sensor_ids}, "aggregated": 0},
-            {"$set": {"aggregated": 1}}
+            {"_id": {"$in": snapshot_ids}},
+            {"$set": {"aggregated": 1, "aggregated_at": time.time() if aggregated_at is None else aggregated_at}}
         )
-        logging.info(f"Updated aggregated status for sensor IDs: {sensor_ids}")
+        logging.info(f"Marked {len(snapshot_ids)} snapshots as aggregated")
     except Exception as e:
         logging.error(f"Error updating aggregated status: {e}")
 
 def process_and_insert_overall_stats():
-    """Main function to process and insert overall stats"""
-    latest_data = get_latest_timestamp_per_sensor()
-    if not latest_data:
+    """
+    Main function to process and insert overall stats.
+
+    Folds the newly completed snapshots into the running sketches and emits the
+    overall histograms from them, so a cycle only reads the new sketches.
+
+    Returns:
+        The number of snapshots folded in.
+    """
+    start = time.perf_counter()
+    cycle, snapshots = claim_pending_snapshots()
+    reference_data = get_latest_reference_data()
+    if not snapshots and not reference_data:
         logging.info("No new data to process.")
-        return
+        return 0
 
     # Process regular sensor data
-    metrics_files = gather_bin_files(latest_data)
-    histograms = []
-    for (metric, submetric), paths in metrics_files.items():
-        x, pmf = aggregate_sketches(paths)
-        if pmf and x:
-            histograms.append({
-                "metric": metric,
-                "submetric": submetric,
-                "pmf": pmf,
-                "x": x
-            })
+    sensor_sketches = {}
+    if snapshots:
+        try:
+            sensor_sketches = fold_snapshots(snapshots, cycle)
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            # The snapshots stay in progress and are resumed in the next cycle
+            logging.error(f"Error folding {len(snapshots)} snapshots into the running state: {e}")
+            return 0
+    histograms = get_running_histograms()
     
     # Process reference data
-    reference_data = get_latest_reference_data()
     if reference_data:
         reference_metrics_files = gather_bin_files([{'latest_stats': reference_data}])
         reference_histograms = []
-        for (metric, submetric), paths in reference_metrics_files.items():
-            x, pmf = aggregate_sketches(paths)
+        reference_sketches = merge_sketch_groups(reference_metrics_files)
+        for (metric, submetric), sketch in reference_sketches.items():
+            x, pmf = compute_histogram(sketch)
             if pmf and x:
                 reference_histograms.append({
                     "metric": metric,
                     "submetric": submetric,
                     "pmf": pmf,
-                    "x": x
+                    "x": x,
+                    "sketch": sketch.serialize()
                 })
         reference_stats = {
             "project_id": PROJECT_ID,
@@ -204,57 +569,146 @@ def process_and_insert_overall_stats():
             "histograms": reference_histograms
         }
         insert_stats(overall_reference_stats_collection, reference_stats) 
-        update_aggregated_status([reference_data['_id']])
-    else:
-        reference_stats = get_latest_reference_stats()
+        # insert_one set the _id of the new reference stats, the baseline is keyed by it
+        global reference_baseline
+        reference_baseline = ReferenceBaseline(reference_stats, reference_sketches)
+        # Older reference uploads that were never aggregated are superseded by this one
+        superseded = collection.find({"sensor_id": "reference", "aggregated": 0,
+                                      "timestamp": {"$lte": reference_data['timestamp']}}, {"_id": 1})
+        update_aggregated_status([reference_data['_id']] + [doc['_id'] for doc in superseded])
         
-    dist = compute_metrics(histograms, reference_stats)
+    baseline = get_reference_baseline()
+    dist = compute_metrics(histograms, baseline)
+    windows = get_window_histograms()
+    aggregated_at = time.time()
     overall_data = {
         "project_id": PROJECT_ID,
-        "last_updated": int(time.time()),
+        "last_updated": int(aggregated_at),
         "histograms": histograms,
-        "distance": dist 
+        "windows": windows,
+        "distance": dist,
+        # The sensor_stats documents folded in keep this cycle
+        "aggregation_cycle": cycle if snapshots else None,
+        "freshness": upload_freshness(snapshots, aggregated_at, cycle if snapshots else None)
     }
+    if OVERALL_STATS_RETENTION:
+        overall_data["expire_at"] = datetime.fromtimestamp(aggregated_at + OVERALL_STATS_RETENTION, tz=timezone.utc)
     insert_stats(overall_stats_collection, overall_data)
+
+    snapshots_by_sensor = {}
+    for snapshot in snapshots:
+        snapshots_by_sensor.setdefault(snapshot["sensor_id"], []).append(snapshot)
+    freshness = {sensor_id: upload_freshness(sensor_snapshots, aggregated_at, cycle)
+                 for sensor_id, sensor_snapshots in snapshots_by_sensor.items()}
+    sensor_documents = compute_sensor_stats(sensor_sketches, baseline, freshness)
+    if sensor_documents:
+        try:
+            sensor_overall_stats_collection.insert_many(sensor_documents, ordered=False)
+        except Exception as e:
+            logging.error(f"Error inserting per-sensor stats: {e}")
     
-    sensor_ids = [item['_id'] for item in latest_data]
-    update_aggregated_status(sensor_ids)
+    update_aggregated_status([snapshot['_id'] for snapshot in snapshots], aggregated_at)
+    logging.info(f"Sketch cache: {sketch_cache.stats()}")
+    observe_stage_latencies(snapshots, aggregated_at)
+    snapshots_folded.inc(len(snapshots))
+    cycle_seconds.observe(time.perf_counter() - start)
+    return len(snapshots)
 
-def compute_metrics(original_list, reference_dict):
-    """Compute various metrics comparing original data to reference data"""
-    original_metrics = original_list
-    reference_metrics = reference_dict.get('histograms', [])
+def observe_stage_latencies(snapshots, aggregated_at):
+    """Observe the pipeline stage latencies of the snapshots folded in a cycle."""
+    for snapshot in snapshots:
+        stamps = {"received_at": snapshot.get("received_at"), "extracted_at": snapshot.get("extracted_at"),
+                  "aggregated_at": aggregated_at}
+        for stage, (stage_start, stage_end) in STAGES.items():
+            if stamps[stage_start] is not None and stamps[stage_end] is not None:
+                stage_seconds.labels(stage).observe(max(0.0, stamps[stage_end] - stamps[stage_start]))
 
+def selected_drift_metrics(metrics):
+    """Return the DRIFT_METRICS among `metrics`, a dict of distance name to metric."""
+    return {name: metrics[name] for name in DRIFT_METRICS if name in metrics}
+
+def histogram_drift(pairs, histogram_metrics):
+    """
+    Compute the histogram drift metrics of (histogram, HistogramBaseline) pairs, with one
+    batch_metrics call per shape of the histograms.
+
+    Args:
+        pairs: (histogram, reference) tuples; histogram is a dict with "pmf" and "x".
+        histogram_metrics: Dict of distance name to QuantileMetrics metric.
+
+    Returns:
+        A list with a dict of distance name to value per pair.
+    """
+    distances = [{} for _ in pairs]
+    by_shape = {}
+    for index, (histogram, reference) in enumerate(pairs):
+        by_shape.setdefault((len(histogram['x']), len(reference.x)), []).append(index)
+    for indexes in by_shape.values():
+        values = batch_metrics([pairs[index][0]['pmf'] for index in indexes],
+                               [pairs[index][0]['x'] for index in indexes],
+                               [pairs[index][1].hist for index in indexes],
+                               [pairs[index][1].x for index in indexes],
+                               metrics=histogram_metrics.values())
+        columns = {name: values[metric].tolist() for name, metric in histogram_metrics.items()}
+        for row, index in enumerate(indexes):
+            distances[index].update({name: column[row] for name, column in columns.items()})
+    return distances
+
+def compute_metrics(original_list, baseline):
+    """
+    Compute the DRIFT_METRICS comparing original data to the reference baseline.
+
+    The histogram metrics of the histograms of the same shapes are computed in one
+    batch_metrics call, the sketch metrics from the stored running and reference sketches.
+    """
     overall_distance_stats = []
-    reference_metrics_dict = {(metric['metric'], metric['submetric']): metric for metric in reference_metrics}
-    for original_metric in original_metrics:
-        key = (original_metric['metric'], original_metric['submetric'])
-        if key in reference_metrics_dict:
-            reference_metric = reference_metrics_dict[key]
-            original_pmf = np.array(original_metric['pmf'])
-            reference_pmf = np.array(reference_metric['pmf'])
-
-            metrics = QuantileMetrics(original_metric['pmf'], original_metric['x'],
-                                      reference_metric['pmf'], reference_metric['x'])
-            psi_value = getattr(metrics, "psi")()
-            pearson_coeff = getattr(metrics, "pearson_correlation")()
-            euclidean_distance = getattr(metrics, "euclidean_distance")()
-
-            overall_distance_stats.append({
-                "metric": original_metric['metric'],
-                "submetric": original_metric['submetric'],
-                "distances": {
-                    "PSI": psi_value,
-                    "Pearson": pearson_coeff,
-                    "Euclidean": euclidean_distance
-                }
-            })
+    if baseline is None:
+        return overall_distance_stats
+    histogram_metrics = selected_drift_metrics(HISTOGRAM_DRIFT_METRICS)
+    sketch_metrics = selected_drift_metrics(SKETCH_DRIFT_METRICS)
+    pairs = [(original_metric, baseline.get(original_metric['metric'], original_metric['submetric']))
+             for original_metric in original_list]
+    pairs = [(original_metric, reference_histogram) for original_metric, reference_histogram in pairs
+             if reference_histogram is not None]
+    distances = histogram_drift(pairs, histogram_metrics) if histogram_metrics else [{} for _ in pairs]
+
+    if sketch_metrics:
+        for index, (original_metric, _) in enumerate(pairs):
+            sketch_baseline = baseline.get_sketch(original_metric['metric'], original_metric['submetric'])
+            if sketch_baseline is None or not original_metric.get('sketch'):
+                continue
+            sketch = kll_floats_sketch.deserialize(original_metric['sketch'])
+            values = batch_sketch_metrics([sketch], sketch_baseline, sketch_metrics.values())
+            distances[index].update({name: values[metric][0].item() for name, metric in sketch_metrics.items()})
+
+    for (original_metric, _), distance in zip(pairs, distances):
+        overall_distance_stats.append({
+            "metric": original_metric['metric'],
+            "submetric": original_metric['submetric'],
+            "distances": distance
+        })
 
     return overall_distance_stats
 
-# Continuous job that runs every SLEEP_INTERVAL seconds
+# Continuous job that runs when new stats are completed, or every fallback interval
 if __name__ == "__main__":
+    start_metrics_server(METRICS_PORT, METRICS_HOST)
+    if PREWARM_SNAPSHOTS > 0:
+        prewarm_sketch_cache(PREWARM_SNAPSHOTS)
+    last_compaction = time.monotonic()
     while True:
-        process_and_insert_overall_stats()
-        time.sleep(SLEEP_INTERVAL)
+        try:
+            folded = process_and_insert_overall_stats()
+        except BrokenProcessPool as e:
+            # A merge process died, e.g. out of memory, and the pool fails every later merge.
+            # supervisord restarts the aggregator with a new pool, which resumes the interrupted cycle.
+            logging.error(f"Merge process pool is broken, exiting to be restarted with a new one: {e}")
+            sys.exit(1)
+        if time.monotonic() - last_compaction >= SEGMENT_COMPACT_INTERVAL:
+            # Segments of aggregated snapshots are dropped or rewritten, release their mappings first
+            segment_reader.close()
+            compact_segments(collection, SEGMENT_ROOT, SEGMENT_MIN_DEAD_RATIO)
+            last_compaction = time.monotonic()
+        if folded < AGGREGATION_BATCH_SIZE:
+            subscriber.wait()  # Otherwise more snapshots are waiting, fold them right away
 
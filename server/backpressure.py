@@ -0,0 +1,132 @@
+# backpressure.py
+import logging
+import shutil
+import time
+from contextlib import contextmanager
+
+# Pressure levels, from least to most loaded
+OK = "ok"
+DEGRADED = "degraded"
+OVERLOADED = "overloaded"
+
+
+class Backpressure:
+    """
+    Admission control for the upload server.
+
+    Tracks the worker backlog (to_aggregate jobs waiting to be extracted), the free disk
+    space under BASE_PATH and the number of uploads in flight. The backlog and disk
+    figures are refreshed at most every `refresh_interval` seconds and counted up
+    locally in between, so admission never costs a query of its own.
+
+    Above the DEGRADED watermarks stats uploads are still accepted but data uploads
+    are deferred; above the OVERLOADED watermarks every upload is rejected.
+    """
+
+    def __init__(self, base_path, max_backlog, defer_data_backlog, min_free_disk_mb,
+                 defer_data_free_disk_mb, max_pending_uploads, refresh_interval, retry_after):
+        self.base_path = base_path
+        self.max_backlog = max_backlog
+        self.defer_data_backlog = defer_data_backlog
+        self.min_free_disk_mb = min_free_disk_mb
+        self.defer_data_free_disk_mb = defer_data_free_disk_mb
+        self.max_pending_uploads = max_pending_uploads
+        self.refresh_interval = refresh_interval
+        self.retry_after = retry_after
+
+        self.backlog = 0
+        self.free_disk_mb = None
+        self.pending_uploads = 0
+        self.last_refresh = 0
+        self._refreshing = False
+        self._recorded_during_refresh = 0
+
+    def begin_refresh(self):
+        """Return True if the cached figures are stale and no refresh is running yet."""
+        if self._refreshing or time.monotonic() - self.last_refresh < self.refresh_interval:
+            return False
+        self._refreshing = True
+        self._recorded_during_refresh = 0
+        return True
+
+    def refresh(self, collection):
+        """
+        Reload the backlog depth and free disk space. Blocking, run it off the event loop.
+
+        A figure that cannot be read keeps its last value until the next refresh.
+        """
+        try:
+            try:
+                # Jobs recorded while counting may or may not be included, count them to stay on the safe side
+                self.backlog = collection.count_documents({"extracted": 0, "state": {"$ne": "failed"}}) + self._recorded_during_refresh
+            except Exception as e:
+                logging.error(f"Error counting the worker backlog, keeping {self.backlog}: {e}")
+            try:
+                self.free_disk_mb = shutil.disk_usage(self.base_path).free / (1024 * 1024)
+            except OSError as e:
+                logging.error(f"Error reading the free disk space of {self.base_path}, keeping {self.free_disk_mb}: {e}")
+        finally:
+            self.last_refresh = time.monotonic()
+            self._refreshing = False
+
+    def record_jobs(self, count=1):
+        """Count newly queued jobs until the next refresh."""
+        self.backlog += count
+        if self._refreshing:
+            self._recorded_during_refresh += count
+
+    @contextmanager
+    def track_upload(self):
+        """Count an upload as in flight for the duration of the block."""
+        self.pending_uploads += 1
+        try:
+            yield
+        finally:
+            self.pending_uploads -= 1
+
+    def level(self):
+        """Return the current pressure level."""
+        disk_known = self.free_disk_mb is not None
+        if (self.backlog >= self.max_backlog
+                or self.pending_uploads >= self.max_pending_uploads
+                or (disk_known and self.free_disk_mb < self.min_free_disk_mb)):
+            return OVERLOADED
+        if (self.backlog >= self.defer_data_backlog
+                or (disk_known and self.free_disk_mb < self.defer_data_free_disk_mb)):
+            return DEGRADED
+        return OK
+
+    def admit(self, file_type):
+        """Return True if an upload of `file_type` should be accepted now."""
+        level = self.level()
+        if level == OVERLOADED:
+            return False
+        if level == DEGRADED:
+            return file_type == "stats"
+        return True
+
+    def defers(self, file_type):
+        """
+        Return True if an upload of `file_type` whose body was already received should be deferred.
+
+        Only data uploads are, above the DEGRADED watermarks: the OVERLOADED check runs
+        before the body is read, and turning away a stats upload already received saves nothing.
+        """
+        return file_type != "stats" and self.level() != OK
+
+    def status(self):
+        """Return the current pressure figures and watermarks."""
+        return {
+            "level": self.level(),
+            "backlog": self.backlog,
+            "free_disk_mb": self.free_disk_mb,
+            "pending_uploads": self.pending_uploads,
+            "retry_after": self.retry_after,
+            "watermarks": {
+                "max_backlog": self.max_backlog,
+                "defer_data_backlog": self.defer_data_backlog,
+                "min_free_disk_mb": self.min_free_disk_mb,
+                "defer_data_free_disk_mb": self.defer_data_free_disk_mb,
+                "max_pending_uploads": self.max_pending_uploads
+            }
+        }
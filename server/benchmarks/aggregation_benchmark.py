@@ -0,0 +1,102 @@
+"""
+Aggregation cycle time against sensor count, sequential versus tree-reduction merge.
+
+Each cycle merges one sketch per sensor for every metric key, as the
+aggregator does, using sketch_merge.merge_groups on a thread or process pool
+and a plain sequential merge for comparison. The merged sketches are checked
+against the sequential ones within the KLL rank error, e.g.
+
+    python benchmarks/aggregation_benchmark.py --sensors 100 500 2000 --workers 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from datasketches import kll_floats_sketch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sketch_merge import merge_groups, merge_sequential  # noqa: E402
+from synthetic import DEFAULT_METRICS, make_sketch  # noqa: E402
+
+# Distinct sketches generated per key; sensors reuse them round-robin
+DISTINCT_SKETCHES = 50
+
+
+def warm_up(_):
+    return os.getpid()
+
+
+def make_groups(num_sensors, num_keys, num_values, seed=0):
+    """Build {key: [serialized sketch per sensor]} for `num_keys` keys."""
+    rng = np.random.default_rng(seed)
+    groups = {}
+    for key in range(num_keys):
+        distinct = [make_sketch(rng, loc=key + rng.normal(0, 0.1), num_values=num_values).serialize()
+                    for _ in range(DISTINCT_SKETCHES)]
+        groups[key] = [distinct[index % DISTINCT_SKETCHES] for index in range(num_sensors)]
+    return groups
+
+
+def max_rank_error(sketch, reference):
+    """Largest rank difference between two sketches over a grid of the reference quantiles."""
+    points = [reference.get_quantile(rank) for rank in np.linspace(0.01, 0.99, 99)]
+    return max(abs(sketch.get_rank(point) - reference.get_rank(point)) for point in points)
+
+
+def run(groups, mode, workers, fan_in):
+    """Return the cycle time in seconds and the merged sketches."""
+    if mode == "sequential":
+        start = time.perf_counter()
+        merged = {key: merge_sequential(blobs) for key, blobs in groups.items()}
+        return time.perf_counter() - start, merged
+    if mode == "process":
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+    with pool:
+        list(pool.map(warm_up, range(workers)))  # Start the workers before timing
+        start = time.perf_counter()
+        merged = merge_groups(pool, groups, fan_in)
+        return time.perf_counter() - start, merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the aggregation merge")
+    parser.add_argument("--sensors", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--keys", type=int, default=len(DEFAULT_METRICS), help="Metric keys per cycle")
+    parser.add_argument("--values", type=int, default=1000, help="Values per sketch")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--fan-in", type=int, default=64, help="Sketches merged by one leaf task")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    tolerance = 2 * kll_floats_sketch().normalized_rank_error(False)
+    results = {"cpu_count": os.cpu_count(), "workers": args.workers, "keys": args.keys,
+               "fan_in": args.fan_in, "cycle_s": {}, "max_rank_error": {}}
+    print("cpus: {}  workers: {}  keys: {}  fan-in: {}".format(os.cpu_count(), args.workers, args.keys, args.fan_in))
+    for num_sensors in args.sensors:
+        groups = make_groups(num_sensors, args.keys, args.values)
+        results["cycle_s"][str(num_sensors)] = {}
+        results["max_rank_error"][str(num_sensors)] = {}
+        _, reference = run(groups, "sequential", 1, args.fan_in)
+        for mode in ["sequential", "thread", "process"]:
+            elapsed, merged = run(groups, mode, args.workers, args.fan_in)
+            error = max(max_rank_error(merged[key], reference[key]) for key in groups)
+            assert error <= tolerance, "{} merge is off by rank {:.4f}".format(mode, error)
+            results["cycle_s"][str(num_sensors)][mode] = elapsed
+            results["max_rank_error"][str(num_sensors)][mode] = error
+            print("{:5d} sensors {:10s}: {:7.3f} s  (max rank error {:.4f})".format(num_sensors, mode, elapsed, error))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
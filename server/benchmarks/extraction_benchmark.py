@@ -0,0 +1,72 @@
+"""
+Archives per second of the stats extraction step at 1, 2, 4 and 8 processes.
+
+Runs extract_and_index_stats, the part of a stats job that worker_stats hands
+to its process pool, over synthetic archives. The thread mode is measured with
+the same worker counts for comparison, e.g.
+
+    python benchmarks/extraction_benchmark.py --archives 400
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stats_ingest import extract_and_index_stats  # noqa: E402
+from synthetic import make_stats_archive, write_fleet  # noqa: E402
+
+
+def warm_up(_):
+    return os.getpid()
+
+
+def run(mode, workers, num_archives, archive):
+    """Extract `num_archives` copies of `archive` with `workers` threads or processes."""
+    with tempfile.TemporaryDirectory() as base_path:
+        dirs = [dir_path for _, dir_path in write_fleet(base_path, num_archives, archive=archive)]
+        if mode == "process":
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+        with pool:
+            list(pool.map(warm_up, range(workers)))  # Start the workers before timing
+            start = time.perf_counter()
+            results = list(pool.map(extract_and_index_stats, dirs))
+            elapsed = time.perf_counter() - start
+    assert all(result for result in results)
+    return num_archives / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark stats archive extraction")
+    parser.add_argument("--archives", type=int, default=200, help="Archives per run")
+    parser.add_argument("--values", type=int, default=20000, help="Values per sketch")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    archive = make_stats_archive(np.random.default_rng(0), num_values=args.values)
+    results = {"cpu_count": os.cpu_count(), "archive_bytes": len(archive), "archives_per_s": {}}
+    print("cpus: {}  archive: {} bytes".format(os.cpu_count(), len(archive)))
+    for mode in ["thread", "process"]:
+        results["archives_per_s"][mode] = {}
+        for workers in args.workers:
+            rate = run(mode, workers, args.archives, archive)
+            results["archives_per_s"][mode][str(workers)] = rate
+            print("{:8s} {:2d} workers: {:8.1f} archives/s".format(mode, workers, rate))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+The upload server, stats worker, aggregator and GraphQL modules, wired to an
+offline stand-in for MongoDB for the benchmark suite.
+
+The modules read config.ini from the working directory and connect to MongoDB
+when they are imported. LocalStack writes a config.ini into a scratch
+directory, with BASE_PATH pointing into it, and imports the modules from there
+with pymongo.MongoClient returning one shared in-process mongomock client, so
+what the server writes is what the worker, the aggregator and the resolvers
+read. With a MongoDB URI the modules connect to that server instead.
+
+The modules are imported once per process, so there is one LocalStack per process.
+"""
+import configparser
+import importlib
+import inspect
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCHMARKS_DIR)
+GRAPHQL_DIR = os.path.join(os.path.dirname(SERVER_DIR), "graphql")
+
+
+def patch_mongomock():
+    """Let mongomock take the bulk writes of the installed pymongo."""
+    import mongomock.collection
+
+    # pymongo 4.11+ passes the sort of UpdateOne to the bulk builder, which mongomock 4.x does not take
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+    if "sort" not in inspect.signature(add_update).parameters:
+        def add_update_without_sort(self, *args, sort=None, **kwargs):
+            return add_update(self, *args, **kwargs)
+        mongomock.collection.BulkOperationBuilder.add_update = add_update_without_sort
+
+
+def use_mongomock():
+    """Make every pymongo.MongoClient created from now on return one shared mongomock client."""
+    import mongomock
+    import pymongo
+
+    patch_mongomock()
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: client
+    return client
+
+
+class LocalStack:
+
+    def __init__(self, mongo_uri=None, overrides=None, log_level=logging.WARNING):
+        """
+        mongo_uri: MongoDB server to use instead of the in-process stand-in.
+        overrides: Dict of (section, key) to a config value, e.g. {("server", "INLINE_STATS_INGEST"): "true"}.
+        log_level: Level of the root logger once the modules have set up logging.
+        """
+        self.base_path = tempfile.mkdtemp(prefix="lensai_benchmark_")
+        config = configparser.ConfigParser()
+        config.optionxform = str  # Keep the case of the keys
+        config.read(os.path.join(SERVER_DIR, "config.ini"))
+        config.set("paths", "BASE_PATH", self.base_path)
+        if mongo_uri:
+            config.set("mongodb", "MONGO_URI", mongo_uri)
+        for (section, key), value in (overrides or {}).items():
+            config.set(section, key, str(value))
+        with open(os.path.join(self.base_path, "config.ini"), "w") as f:
+            config.write(f)
+        self.config = config
+        self.mongo = "mongomock" if not mongo_uri else mongo_uri
+
+        if not mongo_uri:
+            use_mongomock()
+        for path in [GRAPHQL_DIR, SERVER_DIR]:
+            if path not in sys.path:
+                sys.path.insert(0, path)
+        cwd = os.getcwd()
+        os.chdir(self.base_path)
+        try:
+            self.server = importlib.import_module("server")
+            self.worker = importlib.import_module("worker_stats")
+            self.aggregator = importlib.import_module("aggregator_stats")
+            self.resolvers = importlib.import_module("resolvers")
+            self.schema = importlib.import_module("schema").schema
+        finally:
+            os.chdir(cwd)
+        logging.getLogger().setLevel(log_level)
+        self.db = self.aggregator.db
+
+    def reset(self):
+        """Empty the collections, keeping their indexes, and delete the uploaded files and cached state."""
+        for name in self.db.list_collection_names():
+            self.db[name].delete_many({})
+        shutil.rmtree(os.path.join(self.base_path, "lensai"), ignore_errors=True)
+        self.aggregator.sketch_cache.clear()
+        self.aggregator.reference_baseline = None
+
+    def close(self):
+        shutil.rmtree(self.base_path, ignore_errors=True)
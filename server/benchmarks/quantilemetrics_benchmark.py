@@ -0,0 +1,103 @@
+"""
+Micro-benchmarks of QuantileMetrics, per-bin loop versus vectorized rebinning,
+and one QuantileMetrics object per pair versus batch_metrics.
+
+Times the rebinning of one histogram pair to its common bins, a full drift
+evaluation of a pair (construction, then PSI, Pearson and Euclidean on the
+same object) for several bin counts, and the drift of many 30-bin pairs, e.g.
+
+    python benchmarks/quantilemetrics_benchmark.py --bins 30 100 1000 --repeat 200 --pairs 40 4000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quantilemetrics import (HistogramBaseline, QuantileMetrics, batch_metrics, rebin_histogram,  # noqa: E402
+                             rebin_histogram_loop)
+from synthetic import make_sketch  # noqa: E402
+
+DRIFT_METRICS = ["psi", "pearson_correlation", "euclidean_distance"]
+
+
+def make_histogram(rng, loc, num_bins):
+    """Build (x, pmf) of a synthetic sketch with `num_bins` equal-width bins, as helpers.compute_histogram does."""
+    sketch = make_sketch(rng, loc=loc)
+    step = (sketch.get_max_value() - sketch.get_min_value()) / num_bins
+    splits = [sketch.get_min_value() + i * step for i in range(num_bins)]
+    return splits + [sketch.get_max_value()], sketch.get_pmf(splits)
+
+
+class LoopQuantileMetrics(QuantileMetrics):
+    """QuantileMetrics with the per-bin rebinning loop."""
+
+    def rebin_histogram(self, hist, original_bins, common_bins):
+        return rebin_histogram_loop(hist, original_bins, common_bins)
+
+
+def evaluate(cls, x1, pmf1, baseline):
+    metrics = cls(pmf1, x1, baseline=baseline)
+    return [getattr(metrics, name)() for name in DRIFT_METRICS]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark QuantileMetrics rebinning")
+    parser.add_argument("--bins", type=int, nargs="+", default=[30, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=200, help="Evaluations timed per case")
+    parser.add_argument("--pairs", type=int, nargs="+", default=[40, 4000], help="Pair counts of the batch case")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    results = {"repeat": args.repeat, "rebin_us": {}, "pair_us": {}, "batch_ms": {}}
+    for num_bins in args.bins:
+        x1, pmf1 = make_histogram(rng, 0.0, num_bins)
+        x2, pmf2 = make_histogram(rng, 0.3, num_bins)
+        baseline = HistogramBaseline(pmf2, x2)
+        metrics = QuantileMetrics(pmf1, x1, baseline=baseline)
+        common = metrics.common_bins
+        assert np.array_equal(rebin_histogram(metrics.hist1, metrics.bins1, common),
+                              rebin_histogram_loop(metrics.hist1, metrics.bins1, common))
+
+        rebin = {}
+        for name, function in [("loop", rebin_histogram_loop), ("vectorized", rebin_histogram)]:
+            seconds = timeit.timeit(lambda: function(metrics.hist1, metrics.bins1, common), number=args.repeat)
+            rebin[name] = seconds / args.repeat * 1e6
+        pair = {}
+        for name, cls in [("loop", LoopQuantileMetrics), ("vectorized", QuantileMetrics)]:
+            seconds = timeit.timeit(lambda: evaluate(cls, x1, pmf1, baseline), number=args.repeat)
+            pair[name] = seconds / args.repeat * 1e6
+        results["rebin_us"][str(num_bins)] = rebin
+        results["pair_us"][str(num_bins)] = pair
+        print("{:5d} bins  rebin: loop {:9.1f} us  vectorized {:7.1f} us   pair: loop {:9.1f} us  vectorized {:7.1f} us".format(
+            num_bins, rebin["loop"], rebin["vectorized"], pair["loop"], pair["vectorized"]))
+
+    for num_pairs in args.pairs:
+        histograms = [make_histogram(rng, rng.normal(0, 0.3), 30) for _ in range(min(num_pairs, 100))]
+        reference = [make_histogram(rng, 0.0, 30) for _ in range(min(num_pairs, 100))]
+        pairs = [histograms[index % len(histograms)] + reference[index % len(reference)] for index in range(num_pairs)]
+        x1, pmf1, x2, pmf2 = (list(column) for column in zip(*pairs))
+        baselines = [HistogramBaseline(pmf, x) for x, pmf in zip(x2, pmf2)]
+
+        start = timeit.default_timer()
+        per_pair = [evaluate(QuantileMetrics, x, pmf, baseline) for x, pmf, baseline in zip(x1, pmf1, baselines)]
+        per_pair_ms = (timeit.default_timer() - start) * 1e3
+        start = timeit.default_timer()
+        batch = batch_metrics(pmf1, x1, pmf2, x2, metrics=DRIFT_METRICS)
+        batch_ms = (timeit.default_timer() - start) * 1e3
+        assert np.allclose(np.array(per_pair), np.column_stack([batch[name] for name in DRIFT_METRICS]), equal_nan=True)
+        results["batch_ms"][str(num_pairs)] = {"per_pair": per_pair_ms, "batch": batch_ms}
+        print("{:5d} pairs  per pair {:9.1f} ms  batch {:7.1f} ms".format(num_pairs, per_pair_ms, batch_ms))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
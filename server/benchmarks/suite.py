@@ -0,0 +1,294 @@
+"""
+Offline benchmark suite of the ingest -> extract -> aggregate -> query pipeline.
+
+Runs against an in-process MongoDB stand-in (see local_stack.py), so it needs
+no running services:
+
+- micro: compute_histogram, every QuantileMetrics metric, aggregate_sketches
+  and extract_tar_without_root
+- pipeline: for every sensor and metric count, a synthetic fleet of KLL sketch
+  archives is uploaded through the FastAPI app, extracted by the stats worker
+  and aggregated, then the GraphQL resolvers are queried on the result
+
+Every result has a `value`, its `unit` and whether `lower` or `higher` is
+better, and is written as JSON with the machine and commit it ran on. With
+--baseline the run is compared to an earlier result file and the command
+exits with 1 if any value got worse by more than --tolerance, e.g.
+
+    python benchmarks/suite.py --sensors 50 200 --metrics 10 34 --output results.json
+    python benchmarks/suite.py --output new.json --baseline results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import httpx
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import compute_histogram  # noqa: E402
+from quantilemetrics import QuantileMetrics  # noqa: E402
+from stats_ingest import extract_tar_without_root  # noqa: E402
+from local_stack import LocalStack  # noqa: E402
+from synthetic import make_metrics, make_sketch, make_stats_archive  # noqa: E402
+from upload_load_test import upload  # noqa: E402
+
+# Distinct archives uploaded per fleet; sensors reuse them round-robin
+DISTINCT_ARCHIVES = 20
+
+# Sketch files merged by the aggregate_sketches micro-benchmark
+AGGREGATED_SKETCHES = [10, 100, 1000]
+
+
+def result_key(name, **params):
+    return "{}[{}]".format(name, ",".join("{}={}".format(key, value) for key, value in params.items())) if params else name
+
+
+def sample(func, repeat, setup=None):
+    """Time `repeat` calls of func, with the arguments returned by an untimed setup() if given."""
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def latency(times, **details):
+    """Summarize call times in seconds as a median latency result."""
+    ms = np.array(times) * 1000
+    return dict(value=float(np.median(ms)), unit="ms", better="lower", min_ms=float(ms.min()),
+                p99_ms=float(np.percentile(ms, 99)), samples=len(ms), **details)
+
+
+def throughput(count, elapsed, unit, **details):
+    return dict(value=count / elapsed, unit=unit, better="higher", count=count, elapsed_s=elapsed, **details)
+
+
+def micro_benchmarks(stack, repeat, values):
+    rng = np.random.default_rng(0)
+    results = {}
+
+    for num_values in values:
+        sketch = make_sketch(rng, num_values=num_values)
+        results[result_key("compute_histogram", values=num_values)] = latency(
+            sample(lambda: compute_histogram(sketch), repeat))
+
+    x1, pmf1 = compute_histogram(make_sketch(rng, loc=0.0))
+    x2, pmf2 = compute_histogram(make_sketch(rng, loc=0.3))
+    for name in QuantileMetrics.available_metrics():
+        # A new object per call, so the rebinning it shares between metrics is timed too
+        results[result_key("QuantileMetrics." + name, bins=len(pmf1))] = latency(
+            sample(lambda: getattr(QuantileMetrics(pmf1, x1, pmf2, x2), name)(), repeat))
+
+    with tempfile.TemporaryDirectory() as scratch:
+        distinct = [make_sketch(rng, loc=rng.normal(0, 0.1)).serialize() for _ in range(DISTINCT_ARCHIVES)]
+        paths = []
+        for index in range(max(AGGREGATED_SKETCHES)):
+            paths.append(os.path.join(scratch, "brightness_channel_{}.bin".format(index)))
+            with open(paths[-1], "wb") as f:
+                f.write(distinct[index % len(distinct)])
+
+        def clear_sketch_cache():
+            # Cold: every sketch is read and deserialized again
+            stack.aggregator.sketch_cache.clear()
+            return ()
+
+        for num_sketches in AGGREGATED_SKETCHES:
+            results[result_key("aggregate_sketches", sketches=num_sketches)] = latency(
+                sample(lambda: stack.aggregator.aggregate_sketches(paths[:num_sketches]), repeat,
+                       setup=clear_sketch_cache))
+
+        tar_path = os.path.join(scratch, "stats.tar.gz")
+        with open(tar_path, "wb") as f:
+            f.write(make_stats_archive(rng))
+        results[result_key("extract_tar_without_root", bytes=os.path.getsize(tar_path))] = latency(
+            sample(lambda path: extract_tar_without_root(tar_path, path), repeat,
+                   setup=lambda: (tempfile.mkdtemp(dir=scratch),)))
+    return results
+
+
+async def upload_fleet(app, uploads, concurrency):
+    """Upload (sensor_id, timestamp, archive) triples through the ASGI app; returns elapsed seconds, latencies, status codes."""
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=120) as client:
+        async def bounded(sensor_id, timestamp, archive):
+            async with semaphore:
+                return await upload(client, "/upload/", archive, sensor_id, timestamp, "stats")
+
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(bounded(*item) for item in uploads))
+        elapsed = time.perf_counter() - start
+    status_codes = {}
+    for status, _ in responses:
+        status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+    return elapsed, [latency_s for _, latency_s in responses], status_codes
+
+
+def run_worker(stack, threads):
+    """Claim, extract and commit stats jobs as the stats worker does until none are left; returns the job count."""
+    worker = stack.worker
+    done = 0
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            jobs = worker.claim_jobs(worker.collection_aggregate, "stats", worker.WORKER_ID,
+                                     worker.LEASE_SECONDS, worker.BATCH_SIZE)
+            if not jobs:
+                return done
+            worker.commit_batch(list(pool.map(worker.extract_job, jobs)))
+            done += len(jobs)
+
+
+def pipeline_benchmarks(stack, num_sensors, num_metrics, args):
+    """Upload, extract, aggregate and query one synthetic fleet; returns the results of every stage."""
+    stack.reset()
+    params = {"sensors": num_sensors, "metrics": num_metrics}
+    rng = np.random.default_rng(0)
+    metrics = make_metrics(num_metrics)
+    archives = [make_stats_archive(rng, metrics, args.values, shift=rng.normal(0, 0.1)) for _ in range(DISTINCT_ARCHIVES)]
+    timestamp = str(time.time_ns() // 1000)  # Microseconds, unique per fleet
+    tag = "{}x{}".format(num_sensors, num_metrics)  # Uploads of earlier fleets stay in the idempotency cache
+    results = {}
+
+    reference = [("reference", timestamp, make_stats_archive(rng, metrics, args.values))]
+    uploads = [("{}_sensor_{:05d}".format(tag, index), timestamp, archives[index % len(archives)])
+               for index in range(num_sensors)]
+    asyncio.run(upload_fleet(stack.server.app, reference, 1))
+    elapsed, latencies, status_codes = asyncio.run(upload_fleet(stack.server.app, uploads, args.concurrency))
+    results[result_key("upload", **params)] = throughput(
+        num_sensors, elapsed, "uploads/s", concurrency=args.concurrency, archive_bytes=len(archives[0]),
+        p50_ms=float(np.percentile(latencies, 50) * 1000), p99_ms=float(np.percentile(latencies, 99) * 1000),
+        status_codes=status_codes)
+
+    start = time.perf_counter()
+    jobs = run_worker(stack, args.worker_threads)
+    results[result_key("extract", **params)] = throughput(jobs, time.perf_counter() - start, "jobs/s",
+                                                          threads=args.worker_threads)
+
+    start = time.perf_counter()
+    cycles = snapshots = 0
+    while True:
+        folded = stack.aggregator.process_and_insert_overall_stats()
+        cycles += 1
+        snapshots += folded
+        if not folded:
+            break
+    results[result_key("aggregate", **params)] = dict(
+        value=time.perf_counter() - start, unit="s", better="lower", cycles=cycles, snapshots=snapshots)
+
+    project_id = stack.aggregator.PROJECT_ID
+    metric, submetric = metrics[0][1].split("_", 1)
+    window = stack.aggregator.SLIDING_WINDOWS[0][0]
+    sensor_id = uploads[0][0]
+    resolvers = stack.resolvers
+    queries = {
+        "metric_stats": lambda: resolvers.get_metric_stats(project_id, metric, submetric),
+        "reference_metric_stats": lambda: resolvers.get_metric_stats(project_id, metric, submetric, True),
+        "window_metric_stats": lambda: resolvers.get_window_metric_stats(project_id, metric, window, submetric),
+        "metric_distances": lambda: resolvers.get_metric_distances(project_id),
+        "sensor_metric_distances": lambda: resolvers.get_sensor_metric_distances(project_id, sensor_id),
+        "freshness": lambda: resolvers.get_freshness(project_id),
+    }
+    for name, query in queries.items():
+        assert query() is not None, "{} returned nothing".format(name)
+        results[result_key("graphql." + name, **params)] = latency(sample(query, args.repeat))
+
+    # The whole GraphQL request, with the quantiles served from the stored sketch
+    document = """{{ metricStats(projectId: "{}", metric: "{}", submetric: "{}") {{
+        pmf x quantiles(ps: [0.05, 0.5, 0.95]) histogram(bins: 30) {{ edges pmf }} }} }}""".format(
+        project_id, metric, submetric)
+    response = stack.schema.execute_sync(document)
+    assert not response.errors, response.errors
+    results[result_key("graphql.query.metricStats", **params)] = latency(
+        sample(lambda: stack.schema.execute_sync(document), args.repeat))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every result also in `baseline`; returns the keys that got worse by more than tolerance."""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None or not previous["value"]:
+            continue
+        change = current["value"] / previous["value"] - 1
+        worse = change > tolerance if current["better"] == "lower" else change < -tolerance
+        if worse:
+            regressions.append(key)
+        print("{:70s} {:12.3f} -> {:12.3f} {:8s} {:+7.1%}{}".format(
+            key, previous["value"], current["value"], current["unit"], change, "  REGRESSION" if worse else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stats pipeline offline")
+    parser.add_argument("--only", nargs="+", choices=["micro", "pipeline"], default=["micro", "pipeline"])
+    parser.add_argument("--sensors", type=int, nargs="+", default=[50, 200], help="Fleet sizes of the pipeline runs")
+    parser.add_argument("--metrics", type=int, nargs="+", default=[10, 34], help="Metrics per sensor of the pipeline runs")
+    parser.add_argument("--values", type=int, default=1000, help="Values per sketch")
+    parser.add_argument("--repeat", type=int, default=50, help="Calls timed per latency result")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent uploads")
+    parser.add_argument("--worker-threads", type=int, default=4, help="Extraction threads of the stats worker")
+    parser.add_argument("--mongo-uri", help="Use this MongoDB server instead of the in-process stand-in")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare to the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    stack = LocalStack(args.mongo_uri)
+    run = {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "mongo": stack.mongo,
+        "args": vars(args),
+        "results": {},
+    }
+    try:
+        if "micro" in args.only:
+            run["results"].update(micro_benchmarks(stack, args.repeat, [args.values, 100 * args.values]))
+        if "pipeline" in args.only:
+            for num_sensors in args.sensors:
+                for num_metrics in args.metrics:
+                    run["results"].update(pipeline_benchmarks(stack, num_sensors, num_metrics, args))
+    finally:
+        stack.close()
+
+    for key, result in run["results"].items():
+        print("{:70s} {:12.3f} {}".format(key, result["value"], result["unit"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\nChange against {} ({})".format(args.baseline, baseline.get("commit")))
+        regressions = compare(run["results"], baseline["results"], args.tolerance)
+        if regressions:
+            print("{} regressions above {:.0%}".format(len(regressions), args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Synthetic sensor fleets for the benchmarks.
+
+Sketches are real datasketches KLL sketches, serialized and packed into
+stats.tar.gz archives with the same layout the sensors upload.
+"""
+import io
+import os
+import tarfile
+
+import numpy as np
+from datasketches import kll_floats_sketch
+
+# (metrictype, file name without .bin) of a typical image sensor upload
+DEFAULT_METRICS = (
+    [("imgstats", "{}_channel_{}".format(metric, channel))
+     for metric in ["brightness", "mean", "sharpness", "contrast", "noise", "saturation"]
+     for channel in range(3)]
+    + [("modelstats", "accuracy_{}".format(label)) for label in range(10)]
+    + [("customstats", "latency_{}".format(stage)) for stage in ["pre", "infer", "post"]]
+)
+
+
+def make_metrics(num_metrics):
+    """Return `num_metrics` (metrictype, file name) pairs, DEFAULT_METRICS first, then synthetic custom stats."""
+    extra = [("customstats", "synthetic{}_value".format(index)) for index in range(max(0, num_metrics - len(DEFAULT_METRICS)))]
+    return (list(DEFAULT_METRICS) + extra)[:num_metrics]
+
+
+def make_sketch(rng, loc=0.0, scale=1.0, num_values=1000):
+    """Build a KLL sketch of `num_values` normal samples."""
+    sketch = kll_floats_sketch()
+    for value in rng.normal(loc, scale, num_values):
+        sketch.update(float(value))
+    return sketch
+
+
+def make_stats_archive(rng, metrics=DEFAULT_METRICS, num_values=1000, shift=0.0):
+    """Build the bytes of a stats.tar.gz holding one sketch per metric."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for index, (metrictype, name) in enumerate(metrics):
+            payload = make_sketch(rng, loc=index + shift, num_values=num_values).serialize()
+            info = tarfile.TarInfo(name="{}/{}.bin".format(metrictype, name))
+            info.size = len(payload)
+            tar.addfile(info, io.BytesIO(payload))
+    return buffer.getvalue()
+
+
+def write_fleet(base_path, num_sensors, timestamp="0", metrics=DEFAULT_METRICS, num_values=1000, seed=0, archive=None):
+    """
+    Write one stats.tar.gz per sensor under base_path/lensai/stats/<sensor>/<timestamp>.
+
+    With `archive`, the same archive bytes are written for every sensor.
+
+    Returns:
+        The list of (sensor_id, dir_path) pairs.
+    """
+    rng = np.random.default_rng(seed)
+    sensors = []
+    for index in range(num_sensors):
+        sensor_id = "sensor_{:05d}".format(index)
+        dir_path = os.path.join(base_path, "lensai", "stats", sensor_id, timestamp)
+        os.makedirs(dir_path, exist_ok=True)
+        data = archive if archive is not None else make_stats_archive(rng, metrics, num_values, shift=rng.normal(0, 0.1))
+        with open(os.path.join(dir_path, "stats.tar.gz"), "wb") as f:
+            f.write(data)
+        sensors.append((sensor_id, dir_path))
+    return sensors
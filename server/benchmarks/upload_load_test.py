@@ -0,0 +1,109 @@
+"""
+Load test for the sensor upload endpoint.
+
+Fires concurrent POST /upload/ requests at a running server and reports
+requests/sec and p50/p99 latency. Run it once against a build of the previous
+handler and once against the current one to compare them, e.g.
+
+    python benchmarks/upload_load_test.py --url http://localhost:8000 --requests 2000 --concurrency 200
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import tarfile
+import time
+import uuid
+
+import httpx
+import numpy as np
+
+
+def make_archive(size):
+    """Build an in-memory stats.tar.gz holding `size` bytes of random data."""
+    buffer = io.BytesIO()
+    payload = os.urandom(size)
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        info = tarfile.TarInfo(name="imgstats/brightness_channel_0.bin")
+        info.size = len(payload)
+        tar.addfile(info, io.BytesIO(payload))
+    return buffer.getvalue()
+
+
+async def upload(client, url, archive, sensor_id, timestamp, file_type):
+    """Send a single upload and return (status_code, latency_seconds)."""
+    start = time.perf_counter()
+    try:
+        response = await client.post(
+            url,
+            data={"sensor_id": sensor_id, "timestamp": timestamp, "file_type": file_type},
+            files={"file": ("{}.tar.gz".format(file_type), archive, "application/gzip")},
+        )
+        status = response.status_code
+    except httpx.HTTPError:
+        status = 0
+    return status, time.perf_counter() - start
+
+
+async def run(url, num_requests, concurrency, archive, file_type):
+    """Run the load test and return the collected statistics."""
+    run_id = uuid.uuid4().hex[:8]
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        async def bounded(i):
+            async with semaphore:
+                sensor_id = "loadtest_{}_{}".format(run_id, i % 500)
+                return await upload(client, url, archive, sensor_id, str(i), file_type)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(bounded(i) for i in range(num_requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for _, latency in results]) * 1000
+    status_codes = {}
+    for status, _ in results:
+        status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+
+    return {
+        "url": url,
+        "requests": num_requests,
+        "concurrency": concurrency,
+        "payload_bytes": len(archive),
+        "elapsed_s": elapsed,
+        "requests_per_s": num_requests / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "max_ms": float(latencies.max()),
+        "status_codes": status_codes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test POST /upload/")
+    parser.add_argument("--url", default="http://localhost:8000", help="Base URL of the upload server")
+    parser.add_argument("--requests", type=int, default=1000, help="Total number of uploads")
+    parser.add_argument("--concurrency", type=int, default=100, help="Number of concurrent uploads")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="Payload size in bytes")
+    parser.add_argument("--file-type", default="stats", choices=["stats", "data"])
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    archive = make_archive(args.size)
+    results = asyncio.run(run(args.url.rstrip("/") + "/upload/", args.requests,
+                              args.concurrency, archive, args.file_type))
+
+    print("requests/s: {:.1f}".format(results["requests_per_s"]))
+    print("p50: {:.1f} ms  p99: {:.1f} ms  max: {:.1f} ms".format(
+        results["p50_ms"], results["p99_ms"], results["max_ms"]))
+    print("status codes: {}".format(results["status_codes"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# data_ingest.py
+import logging
+import os
+import re
+import shutil
+import tarfile
+from pathlib import PurePosixPath
+
+# Sample files end with their capture time in microseconds, e.g. sample_1718000000123456.png
+SAMPLE_FILE_PATTERN = re.compile(r'_(\d+)\.(?:png|jpe?g)$', re.IGNORECASE)
+
+
+def parse_sample_timestamp(file_name):
+    """Return the capture time in microseconds encoded in a sample file name, or None."""
+    match = SAMPLE_FILE_PATTERN.search(file_name)
+    return int(match.group(1)) if match else None
+
+
+def sample_url(path, base_path, url_prefix):
+    """Return the URL of an extracted sample: its path, or its path below base_path under url_prefix."""
+    if not url_prefix:
+        return path
+    return "{}/{}".format(url_prefix.rstrip("/"), os.path.relpath(path, base_path))
+
+
+def iter_sample_members(tar):
+    """
+    Yields (metrictype, group, file_name, timestamp, member) for the sample files of a tar stream.
+
+    Samples are stored as <metrictype>/<metric>[_<submetric>]/<name>_<timestamp>.png.
+    Absolute members and members with ".." parts are skipped.
+    """
+    for member in tar:
+        if not member.isfile():
+            continue
+        parts = PurePosixPath(member.name).parts
+        if parts and parts[0] == ".":
+            parts = parts[1:]
+        if len(parts) != 3 or parts[2].startswith("._") or any(part in ("/", "..") for part in parts):
+            continue
+        metrictype, group, file_name = parts
+        timestamp = parse_sample_timestamp(file_name)
+        if timestamp is not None:
+            yield metrictype, group, file_name, timestamp, member
+
+
+def extract_and_index_data(dir_path, base_path, url_prefix="", chunk_size=1024 * 1024):
+    """
+    Extracts dir_path/data.tar.gz and indexes the sample files.
+
+    The archive is read as a stream, each sample is written to
+    dir_path/<metrictype>/<group>/<file_name> and its timestamp is parsed once
+    here, so readers never have to parse URLs. The archive is left in place, so
+    a retry extracts it again; the caller removes it once the job is done.
+
+    Returns:
+        The "type" list for the data_stats document, with the samples of each
+        metric sorted by timestamp, or None if the archive could not be read.
+    """
+    tar_path = os.path.join(dir_path, "data.tar.gz")
+    root = os.path.realpath(dir_path)
+    samples = {}
+    try:
+        with tarfile.open(tar_path, "r|gz") as tar:
+            for metrictype, group, file_name, timestamp, member in iter_sample_members(tar):
+                group_path = os.path.join(dir_path, metrictype, group)
+                path = os.path.join(group_path, file_name)
+                if os.path.commonpath([root, os.path.realpath(path)]) != root:
+                    logging.warning(f"Skipping {member.name} of {tar_path}, it points outside {dir_path}")
+                    continue
+                os.makedirs(group_path, exist_ok=True)
+                with tar.extractfile(member) as source, open(path, "wb") as target:
+                    shutil.copyfileobj(source, target, chunk_size)
+                samples.setdefault(metrictype, {}).setdefault(group, []).append({
+                    "url": sample_url(path, base_path, url_prefix),
+                    "timestamp": timestamp
+                })
+    except (tarfile.TarError, EOFError, IOError) as e:
+        logging.error(f"Error extracting {tar_path}: {e}")
+        return None
+
+    processed_types = []
+    for metrictype in sorted(samples):
+        metrics = []
+        for group in sorted(samples[metrictype]):
+            metric, submetric = group.split('_', 1) if '_' in group else (group, "")
+            metrics.append({
+                "metric": metric,
+                "submetric": submetric,
+                "data": sorted(samples[metrictype][group], key=lambda sample: sample["timestamp"])
+            })
+        processed_types.append({"metrictype": metrictype, "data": metrics})
+    return processed_types
+
+
+def remove_data_archive(dir_path):
+    """Remove dir_path/data.tar.gz once its samples are extracted and indexed."""
+    try:
+        os.remove(os.path.join(dir_path, "data.tar.gz"))
+    except FileNotFoundError:
+        pass
+
+
+def sample_time_range(processed_types):
+    """Return the (first, last) sample timestamp of a "type" list, or (None, None) if it has no samples."""
+    timestamps = [sample["timestamp"]
+                  for metric_type in processed_types
+                  for metric in metric_type["data"]
+                  for sample in metric["data"]]
+    if not timestamps:
+        return None, None
+    return min(timestamps), max(timestamps)
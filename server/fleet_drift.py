@@ -0,0 +1,196 @@
+# fleet_drift.py
+"""
+Sensor-versus-sensor drift of one (metric, submetric) across a fleet.
+
+The merged sketch of every sensor is queried once on a grid shared by the
+whole fleet: the CDF at the fleet quantiles, the quantile function at
+midpoint ranks and the masses of the fleet decile buckets. Pairwise
+distances are then whole-array operations on these N x G matrices, computed
+a block of rows at a time with scipy cdist and matrix products, so top-k
+queries never hold the N x N matrix.
+
+The distances are those of sketchmetrics, on the fleet grid instead of the
+grid of a reference:
+
+- ks_statistic: largest CDF difference
+- wasserstein_distance: mean absolute difference of the quantile functions
+- psi: symmetric PSI of the bucket masses, a few matrix products per block
+- jensen_shannon_divergence: Jensen-Shannon distance of the bucket masses
+
+A sensor's divergence is the median of its distances to the other sensors,
+so one miscalibrated camera stands out even if a few others drift with it.
+
+Run from server/ to list the most divergent sensors of the per-sensor stats, e.g.
+
+    python fleet_drift.py brightness channel_0 --metric ks_statistic --top 20 --window 24h
+"""
+import argparse
+import configparser
+import heapq
+import time
+
+import numpy as np
+from datasketches import kll_floats_sketch
+from scipy.spatial.distance import cdist
+
+from rollups import parse_duration
+from sketchmetrics import PSI_EPSILON, QUANTILE_BUCKETS, QUANTILE_POINTS, SketchMetrics
+
+# Upper bound of the distances of a block, about 32 MB
+BLOCK_ELEMENTS = 4 * 1024 * 1024
+
+
+class FleetSketches:
+
+    def __init__(self, sketches, num_points=QUANTILE_POINTS, num_buckets=QUANTILE_BUCKETS):
+        """
+        Query the sketches of a fleet on a shared grid.
+        sketches: Dict of sensor_id to a non-empty kll_floats_sketch of the same (metric, submetric).
+        """
+        self.sensor_ids = list(sketches)
+        fleet = kll_floats_sketch()
+        for sketch in sketches.values():
+            fleet.merge(sketch)
+        ranks = ((np.arange(num_points) + 0.5) / num_points).tolist()
+        points = np.unique(fleet.get_quantiles(ranks)).tolist()
+        splits = np.unique(fleet.get_quantiles([i / num_buckets for i in range(1, num_buckets)])).tolist()
+
+        count = len(self.sensor_ids)
+        self.cdfs = np.empty((count, len(points)))
+        self.quantiles = np.empty((count, len(ranks)))
+        self.pmfs = np.empty((count, len(splits) + 1))
+        for row, sketch in enumerate(sketches.values()):
+            self.cdfs[row] = sketch.get_cdf(points)[:-1]
+            self.quantiles[row] = sketch.get_quantiles(ranks)
+            self.pmfs[row] = sketch.get_pmf(splits)
+        clipped = np.clip(self.pmfs, PSI_EPSILON, None)
+        self._psi_terms = (clipped, np.log(clipped), np.sum(clipped * np.log(clipped), axis=1))
+
+    def __len__(self):
+        return len(self.sensor_ids)
+
+    def distances(self, rows, metric):
+        """Return the distances of the sensors at `rows` (a slice) to every sensor, a len(rows) x N array."""
+        if metric == "ks_statistic":
+            return cdist(self.cdfs[rows], self.cdfs, "chebyshev")
+        if metric == "wasserstein_distance":
+            return cdist(self.quantiles[rows], self.quantiles, "cityblock") / self.quantiles.shape[1]
+        if metric == "psi":
+            # sum((p - q) * (log p - log q)) expanded into products of the whole block
+            p, log_p, entropy = self._psi_terms
+            psi = entropy[rows, None] + entropy[None, :] - p[rows] @ log_p.T - log_p[rows] @ p.T
+            return np.maximum(psi, 0)
+        if metric == "jensen_shannon_divergence":
+            return cdist(self.pmfs[rows], self.pmfs, "jensenshannon")
+        raise ValueError(f"Unknown fleet drift metric: {metric}")
+
+    def iter_blocks(self, metric, block_size=None):
+        """Yield (first row, distances of a block of rows to every sensor) until all rows are covered."""
+        if block_size is None:
+            block_size = max(1, BLOCK_ELEMENTS // max(1, len(self)))
+        for start in range(0, len(self), block_size):
+            yield start, self.distances(slice(start, start + block_size), metric)
+
+
+def pairwise_matrix(fleet, metric):
+    """Return the full N x N distance matrix of a fleet, for small fleets."""
+    return np.vstack([block for _, block in fleet.iter_blocks(metric)]) if len(fleet) else np.zeros((0, 0))
+
+
+def divergence_scores(fleet, metric, block_size=None):
+    """Return the median distance of every sensor to the other sensors."""
+    scores = np.zeros(len(fleet))
+    if len(fleet) < 2:
+        return scores
+    for start, block in fleet.iter_blocks(metric, block_size):
+        rows = np.arange(start, start + len(block))
+        block = block.astype(float)
+        block[np.arange(len(block)), rows] = np.nan
+        scores[rows] = np.nanmedian(block, axis=1)
+    return scores
+
+
+def top_divergent_sensors(fleet, metric, k=10, block_size=None):
+    """Return the k sensors with the largest divergence scores as (sensor_id, score), largest first."""
+    scores = divergence_scores(fleet, metric, block_size)
+    order = np.argsort(-scores, kind="stable")[:k]
+    return [(fleet.sensor_ids[index], float(scores[index])) for index in order]
+
+
+def top_divergent_pairs(fleet, metric, k=10, block_size=None):
+    """Return the k sensor pairs furthest apart as (sensor_id, sensor_id, distance), largest first."""
+    heap = []
+    for start, block in fleet.iter_blocks(metric, block_size):
+        # Each pair once, from the row of its first sensor
+        block = np.where(np.arange(len(fleet))[None, :] > np.arange(start, start + len(block))[:, None], block, -np.inf)
+        flat = block.ravel()
+        candidates = np.argpartition(-flat, min(k, flat.size) - 1)[:k] if flat.size > k else np.arange(flat.size)
+        for index in candidates:
+            if flat[index] == -np.inf:
+                continue
+            row, column = divmod(int(index), len(fleet))
+            item = (float(flat[index]), start + row, column)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+    return [(fleet.sensor_ids[row], fleet.sensor_ids[column], distance)
+            for distance, row, column in sorted(heap, reverse=True)]
+
+
+def load_sensor_sketches(collection, project_id, metric, submetric, since=None):
+    """
+    Merge the per-sensor sketches of a (metric, submetric) stored by the aggregator.
+
+    Args:
+        collection: The per-sensor stats collection.
+        since: Only merge the stats written at or after this epoch second.
+
+    Returns:
+        A dict of sensor_id to the merged kll_floats_sketch, for the sensors with data.
+    """
+    query = {"project_id": project_id}
+    if since is not None:
+        query["last_updated"] = {"$gte": since}
+    projection = {"sensor_id": 1, "histograms": {"$elemMatch": {"metric": metric, "submetric": submetric}}}
+    sketches = {}
+    for document in collection.find(query, projection):
+        for histogram in document.get("histograms", []):
+            if histogram.get("sketch"):
+                sketch = sketches.setdefault(document["sensor_id"], kll_floats_sketch())
+                sketch.merge(kll_floats_sketch.deserialize(histogram["sketch"]))
+    return {sensor_id: sketch for sensor_id, sketch in sketches.items() if not sketch.is_empty()}
+
+
+def main():
+    from pymongo import MongoClient
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    parser = argparse.ArgumentParser(description="Most divergent sensors of a metric across the fleet")
+    parser.add_argument("metric")
+    parser.add_argument("submetric", nargs="?", default="")
+    parser.add_argument("--metric", dest="distance", default="ks_statistic", choices=SketchMetrics.available_metrics())
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--window", default="24h", help="Merge the per-sensor stats of this long ago until now")
+    parser.add_argument("--pairs", action="store_true", help="List the pairs furthest apart instead of sensors")
+    args = parser.parse_args()
+
+    client = MongoClient(config.get('mongodb', 'MONGO_URI', fallback='mongodb://localhost:27017'))
+    db = client[config.get('mongodb', 'DB_NAME', fallback='lensai')]
+    collection = db[config.get('mongodb', 'SENSOR_STATS_COLLECTION_NAME', fallback='sensor_overall_stats')]
+    project_id = config.get('DEFAULT', 'PROJECT_ID', fallback='default_project_id')
+
+    since = int(time.time()) - parse_duration(args.window)
+    fleet = FleetSketches(load_sensor_sketches(collection, project_id, args.metric, args.submetric, since))
+    print(f"{len(fleet)} sensors with {args.metric} {args.submetric} in the last {args.window}")
+    if args.pairs:
+        for sensor_a, sensor_b, distance in top_divergent_pairs(fleet, args.distance, args.top):
+            print(f"{sensor_a}\t{sensor_b}\t{distance:.4f}")
+    else:
+        for sensor_id, score in top_divergent_sensors(fleet, args.distance, args.top):
+            print(f"{sensor_id}\t{score:.4f}")
+
+
+if __name__ == "__main__":
+    main()
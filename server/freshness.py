@@ -0,0 +1,177 @@
+# freshness.py
+"""
+Stage timestamps of stats uploads and the freshness of the aggregates.
+
+An upload is stamped `received_at` by the server once it is stored,
+`extracted_at` when the stats worker commits its sensor_stats document and
+`aggregated_at` when the aggregator folds it into the overall stats. Each
+overall_stats and per-sensor stats document records its aggregation cycle,
+the cycle of the sensor_stats documents it consumed, and the latencies of
+these uploads as fixed-bucket histograms, so they can be merged over any
+time range without reading the uploads again.
+
+The freshness lag of a project or sensor is the age of the newest upload its
+latest aggregate contains: how stale the dashboard is.
+
+The upload server and the GraphQL server both report freshness from this
+module; the GraphQL container copies it from server/.
+"""
+import bisect
+
+# (start, end) timestamps of each stage of the pipeline
+STAGES = {
+    "extract": ("received_at", "extracted_at"),
+    "aggregate": ("extracted_at", "aggregated_at"),
+    "end_to_end": ("received_at", "aggregated_at"),
+}
+
+# Upper bounds in seconds of the latency buckets, followed by an unbounded bucket
+LATENCY_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 24 * 3600]
+
+
+def latency_histogram(latencies, buckets=LATENCY_BUCKETS):
+    """Return the histogram of latencies in seconds: the count per bucket, total count, sum and max."""
+    counts = [0] * (len(buckets) + 1)
+    for latency in latencies:
+        counts[bisect.bisect_left(buckets, latency)] += 1
+    return {"le": list(buckets), "counts": counts, "count": len(latencies),
+            "sum": float(sum(latencies)), "max": float(max(latencies, default=0.0))}
+
+
+def merge_latency_histograms(histograms):
+    """Merge histograms of the same buckets; None if there are none."""
+    merged = None
+    for histogram in histograms:
+        if merged is None:
+            merged = dict(histogram, le=list(histogram["le"]), counts=list(histogram["counts"]))
+            continue
+        if histogram["le"] != merged["le"]:
+            continue  # Written with other buckets, not comparable
+        merged["counts"] = [a + b for a, b in zip(merged["counts"], histogram["counts"])]
+        merged["count"] += histogram["count"]
+        merged["sum"] += histogram["sum"]
+        merged["max"] = max(merged["max"], histogram["max"])
+    return merged
+
+
+def upload_freshness(snapshots, aggregated_at, cycle=None):
+    """
+    Summarize the stage latencies of the sensor_stats documents folded into one aggregate.
+
+    Snapshots stored before the stages were stamped are counted but have no latencies.
+    """
+    stamps = [{"received_at": snapshot.get("received_at"), "extracted_at": snapshot.get("extracted_at"),
+               "aggregated_at": aggregated_at} for snapshot in snapshots]
+    received = [item["received_at"] for item in stamps if item["received_at"] is not None]
+    stages = {}
+    for stage, (start, end) in STAGES.items():
+        stages[stage] = latency_histogram([max(0.0, item[end] - item[start]) for item in stamps
+                                           if item[start] is not None and item[end] is not None])
+    return {
+        "aggregation_cycle": cycle,
+        "aggregated_at": aggregated_at,
+        "uploads": len(snapshots),
+        "oldest_received_at": min(received, default=None),
+        "newest_received_at": max(received, default=None),
+        "stages": stages,
+    }
+
+
+def freshness_report(overall_documents, sensor_documents, now, pending=None):
+    """
+    Build the freshness of a project from its overall_stats documents and the latest per-sensor stats.
+
+    Args:
+        overall_documents: overall_stats documents of the reporting window, with their freshness.
+        sensor_documents: The latest per-sensor stats document of each sensor.
+        now: Epoch seconds the lags are measured at.
+        pending: Optional (count, oldest_received_at) of the uploads not aggregated yet.
+
+    Returns:
+        A dict with the project lag, the stage histograms merged over the window
+        and the sensors, stalest first.
+    """
+    freshness = [document["freshness"] for document in overall_documents if document.get("freshness")]
+    newest_received_at = max((item["newest_received_at"] for item in freshness
+                              if item.get("newest_received_at") is not None), default=None)
+    sensors = []
+    for document in sensor_documents:
+        item = document.get("freshness") or {}
+        if item.get("newest_received_at") is None:
+            continue
+        sensors.append({
+            "sensor_id": document["sensor_id"],
+            "newest_received_at": item["newest_received_at"],
+            "aggregated_at": item.get("aggregated_at"),
+            "lag_seconds": now - item["newest_received_at"],
+        })
+    sensors.sort(key=lambda sensor: sensor["lag_seconds"], reverse=True)
+
+    report = {
+        "now": now,
+        "last_aggregated_at": max((item["aggregated_at"] for item in freshness), default=None),
+        "newest_received_at": newest_received_at,
+        "lag_seconds": now - newest_received_at if newest_received_at is not None else None,
+        "uploads": sum(item["uploads"] for item in freshness),
+        "stages": {stage: merge_latency_histograms(item["stages"][stage] for item in freshness
+                                                   if stage in item.get("stages", {}))
+                   for stage in STAGES},
+        "sensors": sensors,
+    }
+    if pending is not None:
+        count, oldest_received_at = pending
+        report["pending"] = {
+            "uploads": count,
+            "oldest_received_at": oldest_received_at,
+            "oldest_age_seconds": now - oldest_received_at if oldest_received_at is not None else None,
+        }
+    return report
+
+
+def latest_sensor_freshness(sensor_stats_collection, project_id, sensor_id=None):
+    """Return the freshness of the latest per-sensor stats document of every sensor of a project, or of one sensor."""
+    match = {"project_id": project_id}
+    if sensor_id:
+        match["sensor_id"] = sensor_id
+    return list(sensor_stats_collection.aggregate([
+        {"$match": match},
+        {"$sort": {"sensor_id": 1, "last_updated": -1}},
+        {"$group": {"_id": "$sensor_id", "sensor_id": {"$first": "$sensor_id"}, "freshness": {"$first": "$freshness"}}},
+    ]))
+
+
+def pending_uploads(jobs_collection, stats_collection):
+    """
+    Return the number of stats uploads not aggregated yet and the received_at of the oldest one.
+
+    Jobs that failed for good are left out, as in the worker backlog: they are never aggregated.
+    """
+    queries = [
+        (jobs_collection, {"file_type": "stats", "extracted": 0, "state": {"$ne": "failed"}}),
+        (stats_collection, {"aggregated": {"$in": [0, 2]}, "sensor_id": {"$ne": "reference"}}),
+    ]
+    count = 0
+    oldest = []
+    for collection, query in queries:
+        count += collection.count_documents(query)
+        document = collection.find_one(dict(query, received_at={"$ne": None}), {"received_at": 1},
+                                       sort=[("received_at", 1)])
+        if document:
+            oldest.append(document["received_at"])
+    return count, min(oldest, default=None)
+
+
+def load_freshness(overall_stats_collection, sensor_stats_collection, project_id, window_seconds, now,
+                   jobs_collection=None, stats_collection=None, sensor_id=None):
+    """
+    Read the freshness_report of a project: stage latencies of the aggregates of the last
+    `window_seconds`, the lag of every sensor, or only of `sensor_id`, and, given the job and
+    sensor_stats collections, the uploads waiting to be aggregated.
+    """
+    overall_documents = overall_stats_collection.find(
+        {"project_id": project_id, "last_updated": {"$gte": int(now - window_seconds)}}, {"freshness": 1})
+    pending = None
+    if jobs_collection is not None and stats_collection is not None:
+        pending = pending_uploads(jobs_collection, stats_collection)
+    return freshness_report(overall_documents, latest_sensor_freshness(sensor_stats_collection, project_id, sensor_id),
+                            now, pending)
@@ -1,11 +1,44 @@
-from quantilemetrics import QuantileMetrics
+import os
+
+from datasketches import kll_floats_sketch
+
+from quantilemetrics import batch_metrics
+
+# Sub-directories of a stats archive that hold serialized sketches
+METRIC_TYPES = ["imgstats", "modelstats", "samples", "customstats"]
+
+def parse_stat_file_name(file_name):
+    """
+    Splits a sketch file name such as brightness_channel_0.bin into its metric and submetric.
+
+    Returns:
+        A (metric, submetric) tuple, or None if the file is not a sketch file.
+    """
+    if not file_name.endswith(".bin") or file_name.startswith("._"):
+        return None
+    metric, submetric = file_name.split('_', 1) if '_' in file_name else (file_name, "")
+    return metric.replace(".bin", ""), submetric.replace(".bin", "")
+
+def is_path_part(value):
+    """
+    Checks that an upload key such as a sensor_id or timestamp can name a single directory.
+
+    Returns:
+        False for empty values, "." and "..", and values containing a path separator or NUL.
+    """
+    return value not in ("", ".", "..") and not any(char in value for char in "/\\\0")
+
+def is_within(path, root):
+    """Checks that `path` resolves to `root` or to a path below it, following symlinks."""
+    root = os.path.realpath(root)
+    return os.path.commonpath([root, os.path.realpath(path)]) == root
 
 def compute_histogram(sketch, num_splits=30):
     """
-    Reads a binary file, deserializes the content, and extracts the PMF.
+    Extracts the PMF of a sketch over equal-width splits between its min and max.
 
     Args:
-        filename: Path to the binary file.
+        sketch: The kll_floats_sketch.
         num_splits: Number of splits for the PMF (default: 30).
 
     Returns:
@@ -17,7 +50,7 @@ def compute_histogram(sketch, num_splits=30):
     try:
         step = (sketch.get_max_value() - xmin) / num_splits
     except ZeroDivisionError:
-        print(f"Error: num_splits should be non-zero for file {filename}")
+        print("Error: num_splits should be non-zero")
         return None, None
     if step == 0:
         step = 0.01
@@ -33,28 +66,44 @@ def compute_distance_metrics(stats1, stats2, metric_name):
     """
     Computes distance metrics between two sets of statistics.
 
+    The sketches found at the same paths of both trees are compared with
+    batch_metrics, all pairs with histograms of the same shapes in one call.
+
     Args:
-        stats1: The first set of statistics.
+        stats1: The first set of statistics, nested dicts with kll_floats_sketch leaves.
         stats2: The second set of statistics.
-        metric_name: The name of the distance metric to use.
+        metric_name: The name of the distance metric to use, from QuantileMetrics.available_metrics().
 
     Returns:
-        Dictionary of distance metrics.
+        Dictionary of distance metrics, nested like the statistics.
     """
-    def recursive_distance_computation(dict1, dict2, path=[]):
-        distance_metrics = {}
+    pairs = []
+
+    def collect_sketch_pairs(dict1, dict2, distance_metrics, path):
         for key, value in dict1.items():
             if key in dict2:
                 if isinstance(value, dict) and isinstance(dict2[key], dict):
-                    distance_metrics[key] = recursive_distance_computation(value, dict2[key], path + [key])
+                    distance_metrics[key] = {}
+                    collect_sketch_pairs(value, dict2[key], distance_metrics[key], path + [key])
                 elif isinstance(value, kll_floats_sketch) and isinstance(dict2[key], kll_floats_sketch):
-                    # Compute distance metric between sketches
-                    x1, pmf1 = get_histogram(value)
-                    x2, pmf2 = get_histogram(dict2[key])
-                    metrics = QuantileMetrics(pmf1, x1, pmf2, x2)
-                    dist = getattr(metrics, metric_name)()
-                    distance_metrics[key] = dist
+                    x1, pmf1 = compute_histogram(value)
+                    x2, pmf2 = compute_histogram(dict2[key])
+                    if x1 and x2:
+                        pairs.append((distance_metrics, key, x1, pmf1, x2, pmf2))
+                    else:
+                        print(f"Skipping key {key} at path {'.'.join(path)} due to an empty sketch.")
                 else:
                     print(f"Skipping key {key} at path {'.'.join(path)} due to incompatible types or missing sub-dictionary.")
-        return distance_metrics
-    return recursive_distance_computation(stats1, stats2)
+
+    distance_metrics = {}
+    collect_sketch_pairs(stats1, stats2, distance_metrics, [])
+
+    by_shape = {}
+    for pair in pairs:
+        by_shape.setdefault((len(pair[2]), len(pair[4])), []).append(pair)
+    for group in by_shape.values():
+        _, _, x1, pmf1, x2, pmf2 = zip(*group)
+        values = batch_metrics(pmf1, x1, pmf2, x2, metrics=[metric_name])[metric_name].tolist()
+        for (result, key, *_), value in zip(group, values):
+            result[key] = value
+    return distance_metrics
@@ -0,0 +1,61 @@
+# idempotency.py
+from collections import OrderedDict
+
+# Outcomes of checking an upload against what the server has already seen
+NEW = "new"
+DUPLICATE = "duplicate"
+CONFLICT = "conflict"
+
+
+def classify(stored_hash, content_hash):
+    """
+    Compare the content hash of a known upload with the hash of a new one.
+
+    Returns DUPLICATE when the hashes match or either one is unknown, CONFLICT
+    when both are known and differ.
+    """
+    if stored_hash and content_hash and stored_hash != content_hash:
+        return CONFLICT
+    return DUPLICATE
+
+
+class RecentUploads:
+    """
+    Size-bounded LRU of recently seen (sensor_id, timestamp) keys.
+
+    Each key maps to the content hash of the upload, or None if it is unknown.
+    Keys are added as soon as an upload starts, so concurrent retries of the
+    same upload are recognised before any bytes are written.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def check(self, key, content_hash=None):
+        """Return NEW, DUPLICATE or CONFLICT for an upload of `key`."""
+        if key not in self._entries:
+            return NEW
+        self._entries.move_to_end(key)
+        return classify(self._entries[key], content_hash)
+
+    def add(self, key, content_hash=None):
+        """Remember `key`, evicting the least recently seen key when full."""
+        if self.max_size <= 0:
+            return
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            content_hash = content_hash or self._entries[key]
+        self._entries[key] = content_hash
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        """Forget `key`, e.g. when its upload failed."""
+        self._entries.pop(key, None)
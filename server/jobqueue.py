@@ -0,0 +1,222 @@
+# jobqueue.py
+import logging
+import threading
+import time
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+# Job states in the to_aggregate collection. Jobs written before states were
+# introduced have no state field and are treated as pending.
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+
+def ensure_job_indexes(collection):
+    """Create the index used to find claimable jobs."""
+    collection.create_index([("file_type", 1), ("extracted", 1), ("state", 1), ("lease_expiry", 1)])
+
+
+def claimable_query(file_type, now, max_attempts=None):
+    """Query matching jobs that are pending or whose lease has expired with attempts left."""
+    expired = {"state": CLAIMED, "lease_expiry": {"$lt": now}}
+    if max_attempts is not None:
+        expired["attempts"] = {"$lt": max_attempts}
+    return {
+        "file_type": file_type,
+        "extracted": 0,
+        "$or": [
+            {"state": {"$in": [None, PENDING]}},
+            expired
+        ]
+    }
+
+
+def fail_expired_jobs(collection, file_type, max_attempts):
+    """
+    Move jobs whose lease expired on their last attempt to FAILED.
+
+    Such a job crashed or hung its worker `max_attempts` times without reaching
+    fail_job, so it is not claimed again.
+
+    Returns:
+        The number of jobs marked as failed.
+    """
+    result = collection.update_many(
+        {"file_type": file_type, "extracted": 0, "state": CLAIMED,
+         "lease_expiry": {"$lt": time.time()}, "attempts": {"$gte": max_attempts}},
+        {"$set": {"state": FAILED, "error": "lease expired after {} attempts".format(max_attempts)},
+         "$unset": {"lease_expiry": "", "worker_id": ""}}
+    )
+    if result.modified_count:
+        logging.error(f"{result.modified_count} {file_type} jobs failed, their lease expired on the last attempt")
+    return result.modified_count
+
+
+def claim_jobs(collection, file_type, worker_id, lease_seconds, limit, max_attempts=None):
+    """
+    Atomically claim up to `limit` jobs of `file_type` for `worker_id`.
+
+    Each job is moved to CLAIMED with a lease that expires after `lease_seconds`.
+    Jobs whose lease ran out without being completed are claimed again, unless
+    they were already attempted `max_attempts` times; those are moved to FAILED.
+
+    Returns:
+        The list of claimed job documents, oldest first.
+    """
+    if max_attempts is not None:
+        fail_expired_jobs(collection, file_type, max_attempts)
+    jobs = []
+    while len(jobs) < limit:
+        now = time.time()
+        job = collection.find_one_and_update(
+            claimable_query(file_type, now, max_attempts),
+            {
+                "$set": {"state": CLAIMED, "worker_id": worker_id, "lease_expiry": now + lease_seconds},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("_id", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def renew_leases(collection, jobs, worker_id, lease_seconds):
+    """
+    Extend the leases of claimed jobs still held by `worker_id` to `lease_seconds` from now.
+
+    Returns:
+        The number of leases extended.
+    """
+    if not jobs:
+        return 0
+    result = collection.update_many(
+        {"_id": {"$in": [job["_id"] for job in jobs]}, "state": CLAIMED, "worker_id": worker_id},
+        {"$set": {"lease_expiry": time.time() + lease_seconds}}
+    )
+    return result.modified_count
+
+
+class LeaseHeartbeat:
+    """
+    Keeps the leases of the jobs a worker is processing from expiring.
+
+    A background thread renews the leases of the held jobs every third of
+    `lease_seconds`, so a job that takes longer than its lease is not claimed
+    by a second worker. A worker that dies stops renewing and its jobs are
+    claimed again once the lease runs out.
+    """
+
+    def __init__(self, collection, worker_id, lease_seconds):
+        self.collection = collection
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.interval = lease_seconds / 3
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, jobs):
+        """Start renewing the leases of newly claimed jobs."""
+        with self._lock:
+            self._jobs.update((job["_id"], job) for job in jobs)
+
+    def remove(self, jobs):
+        """Stop renewing the leases of jobs that are completed or released."""
+        with self._lock:
+            for job in jobs:
+                self._jobs.pop(job["_id"], None)
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def renew(self):
+        """Renew the leases of the held jobs now. Returns the number of leases extended."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        try:
+            return renew_leases(self.collection, jobs, self.worker_id, self.lease_seconds)
+        except Exception as e:
+            logging.error(f"Error renewing the leases of {len(jobs)} jobs: {e}")
+            return 0
+
+    def start(self):
+        """Renew the leases from a daemon thread until stop is called."""
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.renew()
+
+
+def complete_job(collection, job, worker_id):
+    """
+    Mark a claimed job as done.
+
+    Returns:
+        False if the job is no longer held by `worker_id`, e.g. because its lease
+        expired and another worker finished it first.
+    """
+    now = time.time()
+    result = collection.update_one(
+        {"_id": job["_id"], "state": CLAIMED, "worker_id": worker_id},
+        {"$set": {"state": DONE, "extracted": 1, "extracted_at": now}, "$unset": {"lease_expiry": ""}}
+    )
+    return result.modified_count == 1
+
+
+def complete_jobs(collection, jobs, worker_id):
+    """
+    Mark several claimed jobs as done with one unordered bulk write.
+
+    Returns:
+        The jobs marked as done. Jobs no longer held by `worker_id` are left
+        untouched and are not returned.
+    """
+    if not jobs:
+        return []
+    now = time.time()
+    requests = [
+        UpdateOne(
+            {"_id": job["_id"], "state": CLAIMED, "worker_id": worker_id},
+            {"$set": {"state": DONE, "extracted": 1, "extracted_at": now}, "$unset": {"lease_expiry": ""}}
+        )
+        for job in jobs
+    ]
+    try:
+        modified = collection.bulk_write(requests, ordered=False).modified_count
+    except BulkWriteError as e:
+        logging.error(f"Error completing {len(e.details.get('writeErrors', []))} of {len(jobs)} jobs: {e}")
+        modified = e.details.get("nModified", 0)
+    if modified == len(jobs):
+        return list(jobs)
+    # The jobs completed by this call are the ones stamped with its time for this worker
+    completed_ids = {document["_id"] for document in collection.find(
+        {"_id": {"$in": [job["_id"] for job in jobs]}, "state": DONE, "worker_id": worker_id, "extracted_at": now},
+        {"_id": 1})}
+    return [job for job in jobs if job["_id"] in completed_ids]
+
+
+def fail_job(collection, job, worker_id, max_attempts, error=None):
+    """
+    Release a claimed job after a failed attempt.
+
+    The job goes back to PENDING for another attempt, or to FAILED once it has
+    been attempted `max_attempts` times.
+    """
+    state = FAILED if job.get("attempts", 1) >= max_attempts else PENDING
+    update = {"$set": {"state": state}, "$unset": {"lease_expiry": "", "worker_id": ""}}
+    if error is not None:
+        update["$set"]["error"] = str(error)
+    collection.update_one({"_id": job["_id"], "state": CLAIMED, "worker_id": worker_id}, update)
+    return state
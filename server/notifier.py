@@ -0,0 +1,201 @@
+# notifier.py
+"""
+Wake-up notifications between the upload server, the workers and the aggregator.
+
+Publishers announce new work on a topic, subscribers block in wait() until work
+is announced or their fallback poll interval runs out. Bursts are coalesced:
+after a wake-up the subscriber waits COALESCE_WINDOW seconds and drops every
+notification that arrived meanwhile, so 1,000 uploads cause a few wake-ups.
+
+Backends, selected with [notify] BACKEND:
+- poll: no notifications, subscribers sleep SLEEP_INTERVAL as before
+- socket: UDP datagrams on localhost, for single-host deployments
+- changestream: MongoDB change streams, needs a replica set
+- inprocess: threading events, for tests and single-process deployments
+"""
+import logging
+import select
+import socket
+import threading
+import time
+
+from pymongo.errors import PyMongoError
+
+# Topics and the port offset used for them by the socket backend
+TOPICS = ["stats", "data", "aggregate"]
+
+# Change stream filters, matching the writes that announce work on each topic
+CHANGE_STREAM_PIPELINES = {
+    "stats": [{"$match": {"operationType": "insert", "fullDocument.file_type": "stats"}}],
+    "data": [{"$match": {"operationType": "insert", "fullDocument.file_type": "data"}}],
+    "aggregate": [{"$match": {"$or": [
+        {"operationType": "insert", "fullDocument.status": "completed"},
+        {"operationType": "update", "updateDescription.updatedFields.status": "completed"}
+    ]}}]
+}
+
+_inprocess_events = {topic: threading.Event() for topic in TOPICS}
+
+
+class NullPublisher:
+    """Publisher for backends where the database write itself is the notification."""
+
+    def publish(self, topic):
+        pass
+
+
+class InProcessPublisher:
+    """Publisher that sets the in-process event of a topic."""
+
+    def publish(self, topic):
+        _inprocess_events[topic].set()
+
+
+class SocketPublisher:
+    """Publisher that sends a UDP datagram to the subscriber port of a topic."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def publish(self, topic):
+        try:
+            self.sock.sendto(b"1", (self.host, self.port + TOPICS.index(topic)))
+        except OSError as e:
+            logging.error(f"Error publishing {topic} notification: {e}")
+
+
+class Subscriber:
+    """Base subscriber. Subclasses implement _wait_for_event and _drain."""
+
+    def __init__(self, interval, coalesce_window):
+        self.interval = interval
+        self.coalesce_window = coalesce_window
+
+    def wait(self, timeout=None):
+        """
+        Block until work is announced or `timeout` (default: the fallback interval) passes.
+
+        Returns:
+            True if woken by a notification, False on timeout.
+        """
+        woken = self._wait_for_event(self.interval if timeout is None else timeout)
+        if woken:
+            if self.coalesce_window > 0:
+                time.sleep(self.coalesce_window)
+            self._drain()
+        return woken
+
+    def _wait_for_event(self, timeout):
+        raise NotImplementedError
+
+    def _drain(self):
+        raise NotImplementedError
+
+
+class PollSubscriber(Subscriber):
+    """Subscriber that is never notified and simply sleeps."""
+
+    def _wait_for_event(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def _drain(self):
+        pass
+
+
+class EventSubscriber(Subscriber):
+    """Subscriber woken through a threading event."""
+
+    def __init__(self, event, interval, coalesce_window):
+        super().__init__(interval, coalesce_window)
+        self.event = event
+
+    def _wait_for_event(self, timeout):
+        return self.event.wait(timeout)
+
+    def _drain(self):
+        self.event.clear()
+
+
+class SocketSubscriber(Subscriber):
+    """Subscriber listening for UDP datagrams on the port of its topic."""
+
+    def __init__(self, host, port, interval, coalesce_window):
+        super().__init__(interval, coalesce_window)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+
+    def _wait_for_event(self, timeout):
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def _drain(self):
+        try:
+            while True:
+                self.sock.recv(64)
+        except BlockingIOError:
+            pass
+
+
+class ChangeStreamSubscriber(EventSubscriber):
+    """Subscriber fed by a MongoDB change stream watched in a background thread."""
+
+    def __init__(self, collection, pipeline, interval, coalesce_window):
+        super().__init__(threading.Event(), interval, coalesce_window)
+        self.collection = collection
+        self.pipeline = pipeline
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        while True:
+            try:
+                with self.collection.watch(self.pipeline) as stream:
+                    for _ in stream:
+                        self.event.set()
+            except PyMongoError as e:
+                # Subscribers keep polling at the fallback interval until the stream is back
+                logging.error(f"Change stream on {self.collection.name} failed: {e}")
+                time.sleep(self.interval)
+
+
+def publisher_from_config(config):
+    """Create the publisher for the backend selected in config.ini."""
+    backend = config.get('notify', 'BACKEND', fallback='poll')
+    if backend == 'socket':
+        return SocketPublisher(config.get('notify', 'SOCKET_HOST', fallback='127.0.0.1'),
+                               config.getint('notify', 'SOCKET_PORT', fallback=47800))
+    if backend == 'inprocess':
+        return InProcessPublisher()
+    return NullPublisher()
+
+
+def subscriber_from_config(config, topic, collection):
+    """
+    Create the subscriber for `topic` and the backend selected in config.ini.
+
+    `collection` is the collection whose writes announce work on the topic; it
+    is only watched by the changestream backend.
+    """
+    backend = config.get('notify', 'BACKEND', fallback='poll')
+    sleep_interval = config.getint('DEFAULT', 'SLEEP_INTERVAL', fallback=10)
+    interval = config.getint('notify', 'FALLBACK_INTERVAL', fallback=60)
+    coalesce_window = config.getfloat('notify', 'COALESCE_WINDOW', fallback=0.5)
+
+    if backend == 'socket':
+        port = config.getint('notify', 'SOCKET_PORT', fallback=47800) + TOPICS.index(topic)
+        return SocketSubscriber(config.get('notify', 'SOCKET_HOST', fallback='127.0.0.1'), port,
+                                interval, coalesce_window)
+    if backend == 'changestream':
+        return ChangeStreamSubscriber(collection, CHANGE_STREAM_PIPELINES[topic], interval, coalesce_window)
+    if backend == 'inprocess':
+        return EventSubscriber(_inprocess_events[topic], interval, coalesce_window)
+    if backend != 'poll':
+        logging.error(f"Unknown notify backend {backend}, falling back to polling")
+    return PollSubscriber(sleep_interval, coalesce_window)
@@ -1,141 +1,378 @@
+from functools import cached_property
+
 import numpy as np
-from scipy.spatial import distance
-from scipy.stats import pearsonr, spearmanr, entropy, wasserstein_distance
-from scipy.spatial.distance import jensenshannon
-from scipy.interpolate import interp1d
+from scipy.special import rel_entr
+
+def normalize_bins(x, min_val, max_val):
+    return (x - min_val) / (max_val - min_val)
+
+def rebin_histogram(hist, original_bins, common_bins):
+    """
+    Rebin a histogram to common bins that contain all of its bin edges, e.g. their union with other bins.
+
+    Every common bin lies inside exactly one original bin, or outside all of them,
+    so one searchsorted finds the original bin of each common bin and the counts
+    are gathered with a single indexing operation.
+    """
+    hist = np.asarray(hist, dtype=float)
+    original_bins = np.asarray(original_bins)
+    common_bins = np.asarray(common_bins)
+    if len(original_bins) < 2 or len(common_bins) < 2:
+        return np.zeros(max(len(common_bins) - 1, 0), dtype=float)
+    owner = np.searchsorted(original_bins, common_bins[:-1], side='right') - 1
+    inside = (owner >= 0) & (owner < len(original_bins) - 1)
+    return np.where(inside, hist[np.clip(owner, 0, len(original_bins) - 2)], 0.0)
+
+def rebin_histogram_loop(hist, original_bins, common_bins):
+    """Rebin a histogram one original bin at a time, as a reference for rebin_histogram."""
+    rebinned = np.zeros(len(common_bins) - 1, dtype=float)
+    for i in range(len(original_bins) - 1):
+        start = np.searchsorted(common_bins, original_bins[i], side='right') - 1
+        end = np.searchsorted(common_bins, original_bins[i + 1], side='left')
+        if start < end:
+            rebinned[start:end] += hist[i]
+    return rebinned
+
+def normalize_rows(x):
+    """Normalize every row of bin edges to [0, 1], as normalize_bins does for one histogram."""
+    return normalize_bins(x, x.min(axis=1, keepdims=True), x.max(axis=1, keepdims=True))
+
+def rebin_pairs(hist1, bins1, hist2, bins2):
+    """
+    Rebin N histogram pairs to the union of the bin edges of each pair.
+
+    hist1, bins1: N x B1 arrays of histograms and their normalized bin edges.
+    hist2, bins2: N x B2 arrays of the histograms they are compared to.
+
+    The edges of each pair are sorted together. A bin of the union starts at the
+    last edge of every run of equal edges, and the number of edges of either
+    histogram up to there tells the bin of that histogram it lies in. Rows whose
+    edges are not ascending (e.g. the histogram of a constant sketch) are
+    rebinned one at a time with rebin_histogram_loop.
+
+    Returns:
+        (rebinned1, rebinned2, valid) N x (B1 + B2 - 1) arrays. Row i holds the
+        rebinned histograms of pair i in its first columns, flagged in valid,
+        followed by zeros.
+    """
+    rows, width1 = bins1.shape
+    width2 = bins2.shape[1]
+    width = width1 + width2 - 1
+    rebinned1 = np.zeros((rows, width))
+    rebinned2 = np.zeros((rows, width))
+    valid = np.zeros((rows, width), dtype=bool)
+
+    ascending = (np.diff(bins1, axis=1) >= 0).all(axis=1) & (np.diff(bins2, axis=1) >= 0).all(axis=1)
+    sorted_rows = np.flatnonzero(ascending)
+    if len(sorted_rows):
+        edges = np.concatenate([bins1[sorted_rows], bins2[sorted_rows]], axis=1)
+        order = np.argsort(edges, axis=1, kind='stable')
+        edges = np.take_along_axis(edges, order, axis=1)
+        count1 = np.cumsum(order < width1, axis=1)
+        count2 = np.arange(1, width + 2) - count1
+
+        # The last edge of every run starts a bin, except the largest edge
+        starts = np.zeros(edges.shape, dtype=bool)
+        starts[:, :-1] = edges[:, 1:] != edges[:, :-1]
+        row, position = np.nonzero(starts)
+        column = (np.cumsum(starts, axis=1) - 1)[row, position]
+        target = sorted_rows[row]
+        for rebinned, hist, count, edge_count in [(rebinned1, hist1, count1, width1),
+                                                  (rebinned2, hist2, count2, width2)]:
+            owner = count[row, position] - 1
+            inside = (owner >= 0) & (owner < edge_count - 1)
+            rebinned[target, column] = np.where(inside, hist[target, np.clip(owner, 0, edge_count - 2)], 0.0)
+        valid[target, column] = True
+
+    for index in np.flatnonzero(~ascending):
+        common_bins = np.union1d(bins1[index], bins2[index])
+        size = len(common_bins) - 1
+        rebinned1[index, :size] = rebin_histogram_loop(hist1[index], bins1[index], common_bins)
+        rebinned2[index, :size] = rebin_histogram_loop(hist2[index], bins2[index], common_bins)
+        valid[index, :size] = True
+    return rebinned1, rebinned2, valid
+
+def _constant_rows(x, valid):
+    return np.where(valid, x == x[:, :1], True).all(axis=1)
+
+def _pearson_rows(x, y, valid):
+    """Pearson correlation of every row pair over its valid columns, NaN for constant rows."""
+    count = valid.sum(axis=1, keepdims=True)
+    x_centered = np.where(valid, x - np.where(valid, x, 0).sum(axis=1, keepdims=True) / count, 0)
+    y_centered = np.where(valid, y - np.where(valid, y, 0).sum(axis=1, keepdims=True) / count, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.sum(x_centered * y_centered, axis=1) / np.sqrt(np.sum(x_centered ** 2, axis=1) * np.sum(y_centered ** 2, axis=1))
+    r = np.clip(r, -1.0, 1.0)
+    r[_constant_rows(x, valid) | _constant_rows(y, valid)] = np.nan
+    return r
+
+def _rank_rows(x, valid):
+    """Rank the valid columns of every row, ties getting their average rank, as scipy.stats.rankdata."""
+    width = x.shape[1]
+    order = np.argsort(np.where(valid, x, np.inf), axis=1, kind='stable')
+    ordered = np.take_along_axis(np.where(valid, x, np.inf), order, axis=1)
+    columns = np.arange(width)
+    new_run = np.ones(ordered.shape, dtype=bool)
+    new_run[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    run_end = np.ones(ordered.shape, dtype=bool)
+    run_end[:, :-1] = new_run[:, 1:]
+    first = np.maximum.accumulate(np.where(new_run, columns, 0), axis=1)
+    last = np.minimum.accumulate(np.where(run_end, columns, width)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(x.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis=1)
+    return ranks
+
+def _wasserstein_rows(x, y, valid):
+    """Wasserstein distance between the values of every row pair, which have the same number of valid columns."""
+    count = valid.sum(axis=1)
+    in_count = np.arange(x.shape[1]) < count[:, None]
+    x_sorted = np.where(in_count, np.sort(np.where(valid, x, np.inf), axis=1), 0)
+    y_sorted = np.where(in_count, np.sort(np.where(valid, y, np.inf), axis=1), 0)
+    return np.sum(np.abs(x_sorted - y_sorted), axis=1) / count
+
+def histogram_distances(rebinned1, rebinned2, valid=None, metrics=None):
+    """
+    Compute the distances of N pairs of histograms rebinned to common bins.
+
+    rebinned1, rebinned2: N x K arrays, e.g. from rebin_pairs.
+    valid: N x K mask of the columns that hold bins, all of them by default.
+    metrics: Names from QuantileMetrics.available_metrics() other than psi, all of them by default.
+
+    Returns:
+        A dict of metric name to an array with one value per pair.
+    """
+    p = np.atleast_2d(np.asarray(rebinned1, dtype=float))
+    q = np.atleast_2d(np.asarray(rebinned2, dtype=float))
+    valid = np.ones(p.shape, dtype=bool) if valid is None else valid
+    if metrics is None:
+        metrics = [name for name in QuantileMetrics.available_metrics() if name != "psi"]
+
+    results = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name in metrics:
+            if name == "euclidean_distance":
+                results[name] = np.sqrt(np.sum((p - q) ** 2, axis=1))
+            elif name == "manhattan_distance":
+                results[name] = np.sum(np.abs(p - q), axis=1)
+            elif name == "cosine_similarity":
+                cosine = 1.0 - np.sum(p * q, axis=1) / np.sqrt(np.sum(p * p, axis=1) * np.sum(q * q, axis=1))
+                results[name] = 1 - np.clip(cosine, 0.0, 2.0)
+            elif name == "pearson_correlation":
+                results[name] = _pearson_rows(p, q, valid)
+            elif name == "spearman_rank_correlation":
+                results[name] = _pearson_rows(_rank_rows(p, valid), _rank_rows(q, valid), valid)
+            elif name == "jensen_shannon_divergence":
+                p_norm = p / np.sum(p, axis=1, keepdims=True)
+                q_norm = q / np.sum(q, axis=1, keepdims=True)
+                m = (p_norm + q_norm) / 2.0
+                js = np.sum(rel_entr(p_norm, m), axis=1) + np.sum(rel_entr(q_norm, m), axis=1)
+                results[name] = np.sqrt(js / 2.0)
+            elif name == "kullback_leibler_divergence":
+                p_norm = p / np.sum(p, axis=1, keepdims=True)
+                q_norm = q / np.sum(q, axis=1, keepdims=True)
+                results[name] = np.sum(rel_entr(p_norm, q_norm), axis=1)
+            elif name == "hellinger_distance":
+                results[name] = np.sqrt(np.sum((np.sqrt(p) - np.sqrt(q)) ** 2, axis=1)) / np.sqrt(2)
+            elif name == "wasserstein_distance":
+                results[name] = _wasserstein_rows(p, q, valid)
+            else:
+                raise ValueError(f"Unknown histogram distance: {name}")
+    return results
+
+def _interp_rows(x, y, x_new):
+    """Linear interpolation with extrapolation of every row, as scipy interp1d does for one row."""
+    order = np.argsort(x, axis=1, kind='mergesort')
+    x = np.take_along_axis(x, order, axis=1)
+    y = np.take_along_axis(y, order, axis=1)
+    hi = np.clip(np.sum(x[:, :, None] < x_new[:, None, :], axis=1), 1, x.shape[1] - 1)
+    lo = hi - 1
+    x_lo = np.take_along_axis(x, lo, axis=1)
+    y_lo = np.take_along_axis(y, lo, axis=1)
+    slope = (np.take_along_axis(y, hi, axis=1) - y_lo) / (np.take_along_axis(x, hi, axis=1) - x_lo)
+    return slope * (x_new - x_lo) + y_lo
+
+def batch_psi(hist1, bins1, hist2, bins2, num_buckets=10):
+    """
+    Calculate the PSI of N histogram pairs, as QuantileMetrics.psi does for one pair.
+
+    hist1, bins1: N x B1 arrays of the expected histograms and their normalized bin edges.
+    hist2, bins2: N x B2 arrays of the actual histograms.
+    """
+    min_x = np.maximum(bins1.min(axis=1), bins2.min(axis=1))
+    max_x = np.minimum(bins1.max(axis=1), bins2.max(axis=1))
+    common_x = np.linspace(min_x, max_x, num_buckets + 1, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = _interp_rows(bins1, hist1, common_x)
+        actual = _interp_rows(bins2, hist2, common_x)
+
+        # Ensure no zero values for log and division calculations
+        expected = np.where(expected == 0, 0.0001, expected)
+        actual = np.where(actual == 0, 0.0001, actual)
+        return np.sum((expected - actual) * np.log(expected / actual), axis=1)
+
+def batch_metrics(hist1, bins1, hist2, bins2, metrics=None, num_buckets=10):
+    """
+    Compute distance metrics of N histogram pairs at once.
+
+    Every row of the arguments is one pair, with the same number of bins in all
+    pairs, e.g. every metric of a sensor against its reference histogram.
+
+    Args:
+        hist1, bins1: N x B1 arrays of histograms and their bin edges.
+        hist2, bins2: N x B2 arrays of the histograms they are compared to.
+        metrics: Names from QuantileMetrics.available_metrics(), all of them by default.
+        num_buckets: Number of buckets of the PSI.
+
+    Returns:
+        A dict of metric name to an array with, for each pair, the value QuantileMetrics returns.
+    """
+    hist1 = np.atleast_2d(np.asarray(hist1, dtype=float))
+    hist2 = np.atleast_2d(np.asarray(hist2, dtype=float))
+    bins1 = normalize_rows(np.atleast_2d(np.asarray(bins1, dtype=float)))
+    bins2 = normalize_rows(np.atleast_2d(np.asarray(bins2, dtype=float)))
+    metrics = QuantileMetrics.available_metrics() if metrics is None else list(metrics)
+
+    results = {}
+    distances = [name for name in metrics if name != "psi"]
+    if distances:
+        rebinned1, rebinned2, valid = rebin_pairs(hist1, bins1, hist2, bins2)
+        results.update(histogram_distances(rebinned1, rebinned2, valid, distances))
+    if "psi" in metrics:
+        results["psi"] = batch_psi(hist1, bins1, hist2, bins2, num_buckets)
+    return {name: results[name] for name in metrics}
+
+class HistogramBaseline:
+
+    def __init__(self, hist, bins):
+        """
+        Precompute the parts of a histogram that do not depend on the histogram it is compared to,
+        so a reference histogram is prepared once and reused across comparisons.
+        hist: Array representing the histogram counts.
+        bins: Array representing the bin edges.
+        """
+        self.hist = np.array(hist)
+        self.x = np.array(bins)
+        self.bins = normalize_bins(self.x, self.x.min(), self.x.max())
 
 class QuantileMetrics:
+    """
+    Distance metrics of one histogram pair. The metrics are computed by the batch
+    functions of this module on a single row; use batch_metrics for many pairs.
+    """
 
-    def __init__(self, hist1, bins1, hist2, bins2):
+    def __init__(self, hist1, bins1, hist2=None, bins2=None, baseline=None):
         """
         Initialize the class with two histograms and their respective bin edges.
         hist1, hist2: Arrays representing the histogram counts.
         bins1, bins2: Arrays representing the bin edges.
+        baseline: HistogramBaseline used instead of hist2 and bins2.
         """
+        if baseline is None:
+            baseline = HistogramBaseline(hist2, bins2)
+        self.baseline = baseline
         self.hist1 = np.array(hist1)
-        self.hist2 = np.array(hist2)
-        self.bins1 = self.normalize_bins(np.array(bins1), min(bins1), max(bins1))
-        self.bins2 = self.normalize_bins(np.array(bins2), min(bins2), max(bins2))
+        self.x1 = np.array(bins1)
+        self.hist2 = baseline.hist
+        self.bins1 = self.normalize_bins(self.x1, self.x1.min(), self.x1.max())
+        self.bins2 = baseline.bins
+
+    # The common bins and rebinned histograms are computed on first use and kept,
+    # so several metrics of one pair share them.
 
-        # Create common bins
-        self.common_bins = np.union1d(self.bins1, self.bins2)
+    @cached_property
+    def common_bins(self):
+        return np.union1d(self.bins1, self.bins2)
 
-        # Rebin the histograms to the common bins
-        self.rebinned_hist1 = self.rebin_histogram(self.hist1, self.bins1, self.common_bins)
-        self.rebinned_hist2 = self.rebin_histogram(self.hist2, self.bins2, self.common_bins)
+    @cached_property
+    def rebinned_hist1(self):
+        return self.rebin_histogram(self.hist1, self.bins1, self.common_bins)
+
+    @cached_property
+    def rebinned_hist2(self):
+        return self.rebin_histogram(self.hist2, self.bins2, self.common_bins)
 
     def rebin_histogram(self, hist, original_bins, common_bins):
         """
         Rebin the histogram to a common set of bins.
         """
-        # Create an empty array for the new bins
-        rebinned = np.zeros(len(common_bins) - 1, dtype=float)
-
-        # Fill the new bins with appropriate counts
-        for i in range(len(original_bins) - 1):
-            # Find the indices where the original bins fall into the common bins
-            start = np.searchsorted(common_bins, original_bins[i], side='right') - 1
-            end = np.searchsorted(common_bins, original_bins[i + 1], side='left')
+        return rebin_histogram(hist, original_bins, common_bins)
 
-            # Distribute the count across the corresponding new bins
-            if start < end:
-                rebinned[start:end] += hist[i]
+    def normalize_bins(self, x, min_val, max_val):
+        return normalize_bins(x, min_val, max_val)
 
-        return rebinned
+    def _distance(self, name):
+        return histogram_distances(self.rebinned_hist1[None], self.rebinned_hist2[None], metrics=[name])[name][0]
 
-    
-    def normalize_bins(self, x, min_val, max_val):
-        return (x - min_val) / (max_val - min_val)
-    
     def euclidean_distance(self):
         """
         Compute the Euclidean distance.
         """
-        return distance.euclidean(self.rebinned_hist1, self.rebinned_hist2)
+        return self._distance("euclidean_distance")
 
     def manhattan_distance(self):
         """
         Compute the Manhattan distance.
         """
-        return distance.cityblock(self.rebinned_hist1, self.rebinned_hist2)
+        return self._distance("manhattan_distance")
 
     def cosine_similarity(self):
         """
         Compute the cosine similarity.
         """
-        return 1 - distance.cosine(self.rebinned_hist1, self.rebinned_hist2)
+        return self._distance("cosine_similarity")
 
     def pearson_correlation(self):
         """
         Compute the Pearson correlation coefficient.
         """
-        return pearsonr(self.rebinned_hist1, self.rebinned_hist2)[0]
+        return self._distance("pearson_correlation")
 
     def spearman_rank_correlation(self):
         """
         Compute the Spearman rank correlation coefficient.
         """
-        return spearmanr(self.rebinned_hist1, self.rebinned_hist2)[0]
+        return self._distance("spearman_rank_correlation")
 
     def jensen_shannon_divergence(self):
         """
         Compute the Jensen-Shannon divergence.
         """
-        return jensenshannon(self.rebinned_hist1, self.rebinned_hist2)
+        return self._distance("jensen_shannon_divergence")
 
     def kullback_leibler_divergence(self):
         """
         Compute the Kullback-Leibler divergence.
         """
-        return entropy(self.rebinned_hist1, self.rebinned_hist2)
+        return self._distance("kullback_leibler_divergence")
 
     def hellinger_distance(self):
         """
         Compute the Hellinger distance.
         """
-        return np.sqrt(np.sum((np.sqrt(self.rebinned_hist1) - np.sqrt(self.rebinned_hist2)) ** 2)) / np.sqrt(2)
+        return self._distance("hellinger_distance")
 
     def wasserstein_distance(self):
         """
         Compute the Wasserstein distance.
         """
-        return wasserstein_distance(self.rebinned_hist1, self.rebinned_hist2)
+        return self._distance("wasserstein_distance")
 
     def psi(self, num_buckets=10):
         """
         Calculate the Population Stability Index (PSI) between two distributions.
 
+        The PMFs of both histograms are interpolated to `num_buckets` + 1 points
+        of the range their normalized bins share.
+
         Args:
-            expected_x (array-like): The x values of the expected distribution.
-            expected_pmf (array-like): The PMF values of the expected distribution.
-            actual_x (array-like): The x values of the actual distribution.
-            actual_pmf (array-like): The PMF values of the actual distribution.
             num_buckets (int): Number of buckets to split the distributions into.
 
         Returns:
             float: The PSI value.
         """
-        # Interpolate PMFs to a common x range
-        min_x = max(min(self.bins1), min(self.bins2))
-        max_x = min(max(self.bins1), max(self.bins2))
-        common_x = np.linspace(min_x, max_x, num_buckets + 1)
-    
-        interp_expected = interp1d(self.bins1, self.hist1, kind='linear', fill_value="extrapolate")
-        interp_actual = interp1d(self.bins2, self.hist2, kind='linear', fill_value="extrapolate")
-    
-        common_expected_pmf = interp_expected(common_x)
-        common_actual_pmf = interp_actual(common_x)
-    
-        # Ensure no zero values for log and division calculations
-        common_expected_pmf = np.where(common_expected_pmf == 0, 0.0001, common_expected_pmf)
-        common_actual_pmf = np.where(common_actual_pmf == 0, 0.0001, common_actual_pmf)
-    
-        # Calculate the PSI
-        psi_value = np.sum((common_expected_pmf - common_actual_pmf) * np.log(common_expected_pmf / common_actual_pmf))
-    
-        return psi_value
-
-        
+        return batch_psi(self.hist1[None].astype(float), self.bins1[None].astype(float),
+                         self.hist2[None].astype(float), self.bins2[None].astype(float), num_buckets)[0]
+
     @staticmethod
     def available_metrics():
         return [
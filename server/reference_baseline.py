@@ -0,0 +1,45 @@
+# reference_baseline.py
+from datasketches import kll_floats_sketch
+
+from quantilemetrics import HistogramBaseline
+from sketchmetrics import SketchBaseline
+
+
+class ReferenceBaseline:
+    """
+    Drift artifacts of one reference stats document: per (metric, submetric) the
+    reference histogram with its normalized bins, and the merged reference
+    sketch, passed in or loaded from the stored document, with its SketchBaseline.
+
+    Built once per reference upload and identified by the reference document _id,
+    so drift computation never rebuilds them while the reference is unchanged.
+    """
+
+    def __init__(self, reference_stats, sketches=None):
+        self.reference_id = reference_stats.get("_id")
+        self.last_updated = reference_stats.get("last_updated")
+        self.histograms = {}
+        stored_sketches = {}
+        for histogram in reference_stats.get("histograms", []):
+            key = (histogram["metric"], histogram["submetric"])
+            if histogram.get("pmf") and histogram.get("x"):
+                self.histograms[key] = HistogramBaseline(histogram["pmf"], histogram["x"])
+            if histogram.get("sketch") and sketches is None:
+                stored_sketches[key] = kll_floats_sketch.deserialize(histogram["sketch"])
+        self.sketches = sketches if sketches is not None else stored_sketches
+        self.sketch_baselines = {key: SketchBaseline(sketch) for key, sketch in self.sketches.items()
+                                 if not sketch.is_empty()}
+
+    def get(self, metric, submetric):
+        """Return the HistogramBaseline of a metric, or None if the reference does not have it."""
+        return self.histograms.get((metric, submetric))
+
+    def get_sketch(self, metric, submetric):
+        """Return the SketchBaseline of a metric, or None if the reference has no sketch of it."""
+        return self.sketch_baselines.get((metric, submetric))
+
+    def __contains__(self, key):
+        return key in self.histograms
+
+    def __len__(self):
+        return len(self.histograms)
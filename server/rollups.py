@@ -0,0 +1,137 @@
+# rollups.py
+"""
+Tumbling-window rollups of sketches.
+
+Every (project, metric, submetric) keeps one mergeable KLL sketch per bucket
+of each granularity, e.g. 5 minutes, 1 hour and 1 day, with buckets aligned to
+the epoch. A sliding window is answered by covering it with as few buckets as
+possible, coarse ones in the middle and fine ones at its start, and merging
+their sketches, so the cost depends on the window length in buckets and not
+on the number of snapshots in it.
+"""
+import re
+import time
+from datetime import datetime, timezone
+
+from datasketches import kll_floats_sketch
+
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(value):
+    """Parse a duration such as 30s, 5m, 1h, 7d or 2w into seconds."""
+    match = re.fullmatch(r"\s*(\d+)\s*([smhdw])\s*", value)
+    if not match:
+        raise ValueError(f"Invalid duration: {value}")
+    return int(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+
+def parse_granularities(value):
+    """
+    Parse a granularity list such as "5m:2d, 1h:30d, 1d" into (name, seconds, retention_seconds) tuples.
+
+    A granularity without retention is kept forever (retention None). The
+    result is sorted from the finest to the coarsest granularity.
+    """
+    granularities = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, retention = item.strip().partition(":")
+        granularities.append((name, parse_duration(name), parse_duration(retention) if retention else None))
+    return sorted(granularities, key=lambda granularity: granularity[1])
+
+
+def snapshot_time(snapshot):
+    """
+    Return the epoch seconds a sensor snapshot belongs to.
+
+    Numeric upload timestamps in seconds, milliseconds or microseconds are
+    accepted; anything else falls back to the time the snapshot was stored.
+    """
+    try:
+        value = float(snapshot.get("timestamp"))
+        if value > 1e14:
+            return value / 1e6
+        if value > 1e11:
+            return value / 1e3
+        return value
+    except (TypeError, ValueError):
+        return snapshot["_id"].generation_time.timestamp()
+
+
+def bucket_start(timestamp, seconds):
+    """Return the start of the bucket of `seconds` that contains `timestamp`."""
+    return int(timestamp // seconds * seconds)
+
+
+def rollup_key(project_id, metric, submetric, granularity, start):
+    return {"project_id": project_id, "metric": metric, "submetric": submetric,
+            "granularity": granularity, "bucket_start": start}
+
+
+def cover_window(start, end, granularities, now=None):
+    """
+    Cover [start, end) with the fewest buckets.
+
+    The window start is rounded down to the finest granularity whose buckets
+    are still retained at that time. A bucket that reaches past `end` is only
+    used when `end` is the present (no data exists beyond it yet), so the
+    buckets of a window ending now are not split.
+
+    Returns:
+        The list of (granularity name, bucket start) pairs.
+    """
+    now = time.time() if now is None else now
+    retained = [granularity for granularity in granularities
+                if granularity[2] is None or bucket_start(start, granularity[1]) + granularity[1] + granularity[2] > now]
+    granularities = retained or granularities[-1:]
+    finest = granularities[0][1]
+    limit = -(-min(end, now) // finest) * finest  # end rounded up to the finest bucket
+    cursor = bucket_start(start, finest)
+    buckets = []
+    while cursor < limit:
+        for name, seconds, _ in reversed(granularities):
+            if cursor % seconds == 0 and (cursor + seconds <= limit or (end >= now and cursor + seconds > now)):
+                buckets.append((name, cursor))
+                cursor += seconds
+                break
+        else:
+            break
+    return buckets
+
+
+def rollup_expiry(start, seconds, retention):
+    """Return when a bucket may be dropped, or None to keep it forever."""
+    if retention is None:
+        return None
+    return datetime.fromtimestamp(start + seconds + retention, tz=timezone.utc)
+
+
+def ensure_rollup_indexes(collection):
+    collection.create_index([("project_id", 1), ("metric", 1), ("submetric", 1),
+                             ("granularity", 1), ("bucket_start", 1)], unique=True)
+    collection.create_index([("project_id", 1), ("granularity", 1), ("bucket_start", 1)])
+    # Buckets past their retention are removed by MongoDB
+    collection.create_index("expire_at", expireAfterSeconds=0)
+
+
+def window_sketches(collection, project_id, start, end, granularities, now=None):
+    """
+    Merge the rollups of every (metric, submetric) over the window [start, end).
+
+    Returns:
+        A dict of (metric, submetric) to the merged kll_floats_sketch.
+    """
+    buckets = cover_window(start, end, granularities, now)
+    if not buckets:
+        return {}
+    query = {"project_id": project_id,
+             "$or": [{"granularity": name, "bucket_start": bucket} for name, bucket in buckets]}
+    merged = {}
+    for rollup in collection.find(query, {"metric": 1, "submetric": 1, "sketch": 1}):
+        key = (rollup["metric"], rollup["submetric"])
+        if key not in merged:
+            merged[key] = kll_floats_sketch()
+        merged[key].merge(kll_floats_sketch.deserialize(rollup["sketch"]))
+    return merged
@@ -0,0 +1,198 @@
+# segment_store.py
+"""
+Append-only segment files for serialized sketches.
+
+Instead of one .bin file per sketch, the stats worker appends every sketch of a
+sensor to a per-sensor, per-day segment file:
+
+    <root>/<sensor_id>/<YYYYMMDD>.seg
+
+and records (segment, offset, length) in sensor_stats. Segments are read
+through mmap. Segments of past days are compacted once the snapshots that
+reference them have been aggregated.
+"""
+import fcntl
+import logging
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+SEGMENT_SUFFIX = ".seg"
+
+
+def segment_path(root, sensor_id, day=None):
+    """Return the path of the segment a sensor appends to on `day` (default: today, UTC)."""
+    day = day or datetime.now(timezone.utc).strftime("%Y%m%d")
+    return os.path.join(root, sensor_id, day + SEGMENT_SUFFIX)
+
+
+def append_sketches(root, sensor_id, blobs, day=None):
+    """
+    Append serialized sketches to the current segment of a sensor.
+
+    The segment is locked while writing, so several threads or processes can
+    append to the same segment.
+
+    Returns:
+        The segment path and the list of (offset, length) of the blobs, in order.
+    """
+    path = segment_path(root, sensor_id, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            offset = f.seek(0, os.SEEK_END)
+            locations = []
+            for blob in blobs:
+                locations.append((offset, len(blob)))
+                offset += len(blob)
+            f.write(b"".join(blobs))
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return path, locations
+
+
+class SegmentReader:
+    """Reads sketches from segments through a small LRU of mmap'd files. Safe to share between threads."""
+
+    def __init__(self, max_open=256):
+        self.max_open = max_open
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path, offset, length):
+        """Return the `length` bytes at `offset` of the segment at `path`."""
+        with self._lock:
+            mapped = self._maps.get(path)
+            if mapped is None or offset + length > len(mapped):
+                # Not mapped yet, or the segment grew since it was mapped
+                mapped = self._map(path)
+            else:
+                self._maps.move_to_end(path)
+            if offset + length > len(mapped):
+                raise ValueError(f"Range {offset}+{length} is beyond the end of {path}")
+            return mapped[offset:offset + length]
+
+    def _map(self, path):
+        self._unmap(path)
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[path] = mapped
+        while len(self._maps) > self.max_open:
+            _, oldest = self._maps.popitem(last=False)
+            oldest.close()
+        return mapped
+
+    def _unmap(self, path):
+        mapped = self._maps.pop(path, None)
+        if mapped is not None:
+            mapped.close()
+
+    def close(self):
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+
+
+def _segment_day(path):
+    return os.path.basename(path)[:8]
+
+
+def _remap_types(types, path, new_path, new_offsets):
+    """Return a copy of a sensor_stats "type" list with the entries of `path` moved to `new_path`."""
+    remapped = []
+    for metric_type in types:
+        stats = []
+        for stat in metric_type.get("stats", []):
+            if stat.get("segment") == path:
+                stat = dict(stat, segment=new_path, offset=new_offsets[(stat["offset"], stat["length"])])
+            stats.append(stat)
+        remapped.append(dict(metric_type, stats=stats))
+    return remapped
+
+
+def compact_segment(collection, path, min_dead_ratio):
+    """
+    Compact one segment.
+
+    Sketches of snapshots that are still waiting for aggregation are live; the
+    rest are dead. A segment without live sketches is deleted. A segment whose
+    dead share reaches `min_dead_ratio` is rewritten with only the live sketches
+    into a new segment file, the live snapshots are pointed at it and the old
+    file is deleted.
+
+    Returns:
+        "deleted", "rewritten" or "kept".
+    """
+    live = set()
+    live_docs = []
+    for doc in collection.find({"type.stats.segment": path, "aggregated": {"$ne": 1}}, {"type": 1}):
+        live_docs.append(doc)
+        for metric_type in doc.get("type", []):
+            for stat in metric_type.get("stats", []):
+                if stat.get("segment") == path:
+                    live.add((stat["offset"], stat["length"]))
+
+    if not live:
+        os.remove(path)
+        return "deleted"
+
+    live_bytes = sum(length for _, length in live)
+    if 1 - live_bytes / os.path.getsize(path) < min_dead_ratio:
+        return "kept"
+
+    stem = os.path.basename(path)[:-len(SEGMENT_SUFFIX)].split("-")[0]
+    new_path = os.path.join(os.path.dirname(path), "{}-{}{}".format(stem, int(time.time() * 1000), SEGMENT_SUFFIX))
+    new_offsets = {}
+    with open(path, "rb") as source, open(new_path, "wb") as target:
+        offset = 0
+        for old_offset, length in sorted(live):
+            source.seek(old_offset)
+            target.write(source.read(length))
+            new_offsets[(old_offset, length)] = offset
+            offset += length
+
+    for doc in live_docs:
+        collection.update_one({"_id": doc["_id"]},
+                              {"$set": {"type": _remap_types(doc["type"], path, new_path, new_offsets)}})
+    os.remove(path)
+    return "rewritten"
+
+
+def compact_segments(collection, root, min_dead_ratio=0.5, grace_seconds=3600, today=None):
+    """
+    Compact every segment under `root` from a day before `today`.
+
+    Segments of the current day are still appended to and are left alone, as are
+    segments modified in the last `grace_seconds`, whose snapshots may not be
+    recorded in sensor_stats yet.
+
+    Returns:
+        A dict counting the deleted, rewritten and kept segments.
+    """
+    today = today or datetime.now(timezone.utc).strftime("%Y%m%d")
+    collection.create_index("type.stats.segment")
+    summary = {"deleted": 0, "rewritten": 0, "kept": 0}
+    if not os.path.isdir(root):
+        return summary
+    for sensor_dir in os.listdir(root):
+        sensor_path = os.path.join(root, sensor_dir)
+        if not os.path.isdir(sensor_path):
+            continue
+        for file_name in sorted(os.listdir(sensor_path)):
+            path = os.path.join(sensor_path, file_name)
+            if not file_name.endswith(SEGMENT_SUFFIX) or _segment_day(path) >= today:
+                continue
+            if time.time() - os.path.getmtime(path) < grace_seconds:
+                continue
+            try:
+                summary[compact_segment(collection, path, min_dead_ratio)] += 1
+            except Exception as e:
+                logging.error(f"Error compacting segment {path}: {e}")
+    logging.info(f"Compacted segments: {summary}")
+    return summary
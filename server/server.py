@@ -1,14 +1,29 @@
 from fastapi import FastAPI, File, Form, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from typing import List, Optional
 
 from pathlib import Path
 import os
+import asyncio
+import functools
+import hashlib
 import shutil
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient, errors
 import configparser
 
 # server.py (or any other script)
 from logger import setup_logger
+from idempotency import RecentUploads, classify, NEW, CONFLICT
+from helpers import is_path_part
+from stats_ingest import extract_stats_stream
+from backpressure import Backpressure
+from notifier import publisher_from_config
+from freshness import load_freshness
+from rollups import parse_duration
+from telemetry import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram, mongo_command_metrics
 import logging
 
 # Set up logging
@@ -23,15 +38,39 @@ BASE_PATH = Path(config['paths']['BASE_PATH'])
 MONGO_URI = config['mongodb']['MONGO_URI']
 DB_NAME = config['mongodb']['DB_NAME']
 COLLECTION_NAME = config['mongodb']['COLLECTION_NAME_AGGREGATE']
+COLLECTION_NAME_STATS = config['mongodb']['COLLECTION_NAME_STATS']
+OVERALL_STATS_COLLECTION_NAME = config.get('mongodb', 'OVERALL_STATS_COLLECTION_NAME', fallback='overall_stats')
+SENSOR_STATS_COLLECTION_NAME = config.get('mongodb', 'SENSOR_STATS_COLLECTION_NAME', fallback='sensor_overall_stats')
+PROJECT_ID = config['DEFAULT']['PROJECT_ID']
+MAX_INFLIGHT_UPLOADS = config.getint('server', 'MAX_INFLIGHT_UPLOADS', fallback=64)
+IO_WORKERS = config.getint('server', 'IO_WORKERS', fallback=8)
+UPLOAD_CHUNK_SIZE = config.getint('server', 'UPLOAD_CHUNK_SIZE', fallback=1024 * 1024)
+IDEMPOTENCY_CACHE_SIZE = config.getint('server', 'IDEMPOTENCY_CACHE_SIZE', fallback=100000)
+INLINE_STATS_INGEST = config.getboolean('server', 'INLINE_STATS_INGEST', fallback=False)
+SKETCH_STORAGE = config.get('storage', 'SKETCH_STORAGE', fallback='files')
+SEGMENT_ROOT = str(BASE_PATH / "lensai" / "segments") if SKETCH_STORAGE == "segments" else None
+MAX_PENDING_UPLOADS = config.getint('server', 'MAX_PENDING_UPLOADS', fallback=256)
+MAX_BACKLOG = config.getint('server', 'MAX_BACKLOG', fallback=10000)
+DEFER_DATA_BACKLOG = config.getint('server', 'DEFER_DATA_BACKLOG', fallback=5000)
+MIN_FREE_DISK_MB = config.getint('server', 'MIN_FREE_DISK_MB', fallback=1024)
+DEFER_DATA_FREE_DISK_MB = config.getint('server', 'DEFER_DATA_FREE_DISK_MB', fallback=4096)
+BACKPRESSURE_REFRESH_INTERVAL = config.getint('server', 'BACKPRESSURE_REFRESH_INTERVAL', fallback=5)
+RETRY_AFTER = config.getint('server', 'RETRY_AFTER', fallback=30)
+
+VALID_FILE_TYPES = ["stats", "data"]
+INVALID_KEY_MESSAGE = "sensor_id and timestamp must not be empty, '.' or '..', or contain '/' or '\\'."
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
 # Initialize MongoDB client
 try:
-    client = MongoClient(MONGO_URI)
+    client = MongoClient(MONGO_URI, event_listeners=[mongo_command_metrics])
     db = client[DB_NAME]
     collection = db[COLLECTION_NAME]
+    collection_stats = db[COLLECTION_NAME_STATS]
+    overall_stats_collection = db[OVERALL_STATS_COLLECTION_NAME]
+    sensor_overall_stats_collection = db[SENSOR_STATS_COLLECTION_NAME]
 
     # Check if the index already exists
     existing_indexes = collection.index_information()
@@ -48,60 +87,500 @@ except errors.ConnectionFailure as e:
     logging.error(f"Could not connect to MongoDB: {e}")
     raise Exception("Could not connect to MongoDB")
 
+# Bounded pool for the blocking disk and MongoDB calls, so they never run on the event loop
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="upload-io")
+
+# Caps the number of uploads being written at the same time
+upload_slots = asyncio.Semaphore(MAX_INFLIGHT_UPLOADS)
+
+# Backlog, disk and in-flight tracking used to reject uploads under load
+backpressure = Backpressure(BASE_PATH, MAX_BACKLOG, DEFER_DATA_BACKLOG, MIN_FREE_DISK_MB,
+                            DEFER_DATA_FREE_DISK_MB, MAX_PENDING_UPLOADS,
+                            BACKPRESSURE_REFRESH_INTERVAL, RETRY_AFTER)
+
+# Wakes the workers when new jobs are queued
+publisher = publisher_from_config(config)
+
+# Recently seen (sensor_id, timestamp) keys, checked before any disk or MongoDB I/O
+recent_uploads = RecentUploads(IDEMPOTENCY_CACHE_SIZE)
+
+# Request metrics by route; other paths are counted together so the label values stay few
+METRIC_ROUTES = {"/upload/", "/upload/batch", "/upload/check", "/status", "/metrics", "/metrics/freshness"}
+# Routes whose uploads go through admission control
+UPLOAD_ROUTES = {"/upload/", "/upload/batch"}
+http_requests = Counter("lensai_http_requests_total", "HTTP requests by route, method and status code",
+                        ["route", "method", "status"])
+http_request_bytes = Counter("lensai_http_request_bytes_total", "Request body bytes received, e.g. uploaded archives",
+                             ["route"])
+http_request_duration = Histogram("lensai_http_request_duration_seconds", "Time to answer a request", ["route"])
+Gauge("lensai_upload_backlog", "Jobs waiting for the workers, as last refreshed by admission control").set_function(
+    lambda: backpressure.backlog)
+Gauge("lensai_uploads_in_flight", "Uploads being received").set_function(lambda: backpressure.pending_uploads)
+Gauge("lensai_free_disk_mb", "Free disk space under BASE_PATH, as last refreshed").set_function(
+    lambda: backpressure.free_disk_mb)
+
+class RequestMetrics:
+    """ASGI middleware counting the requests, status codes, body bytes and latency of every route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = scope["path"] if scope["path"] in METRIC_ROUTES else "other"
+        start = time.perf_counter()
+        received = [0]
+        status = [500]
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                received[0] += len(message.get("body", b""))
+            return message
+
+        async def status_send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, status_send)
+        finally:
+            http_requests.labels(route, scope["method"], status[0]).inc()
+            http_request_bytes.labels(route).inc(received[0])
+            http_request_duration.labels(route).observe(time.perf_counter() - start)
+
+class AdmissionControl:
+    """
+    ASGI middleware rejecting uploads under load before their body is received.
+
+    FastAPI reads and spools the whole multipart body before an upload handler runs, so
+    an upload turned away there has already cost its network and disk I/O. The file type
+    is part of that body: only the OVERLOADED check runs here, the deferral of data uploads
+    above the DEGRADED watermarks is left to the handlers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in UPLOAD_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        schedule_backpressure_refresh()
+        if not backpressure.admit("stats"):
+            response = overloaded_response("batch" if scope["path"] == "/upload/batch" else "single")
+            await response(scope, receive, send)
+            return
+        with backpressure.track_upload():
+            await self.app(scope, receive, send)
+
 app = FastAPI()
+# The last middleware added runs first: requests rejected by admission control are still counted
+app.add_middleware(AdmissionControl)
+app.add_middleware(RequestMetrics)
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the I/O pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+def write_chunk(buffer, hasher, chunk):
+    """Write a chunk to disk and add it to the running content hash."""
+    buffer.write(chunk)
+    hasher.update(chunk)
+
+async def save_upload(file, file_path):
+    """
+    Stream an uploaded file to disk in chunks without blocking the event loop.
+
+    Returns the SHA-256 hex digest of the written content.
+    """
+    hasher = hashlib.sha256()
+    buffer = await run_blocking(file_path.open, "wb")
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await run_blocking(write_chunk, buffer, hasher, chunk)
+    finally:
+        await run_blocking(buffer.close)
+    return hasher.hexdigest()
+
+async def store_upload(file, file_type, sensor_id, timestamp):
+    """
+    Write an upload to BASE_PATH/lensai/<file_type>/<sensor_id>/<timestamp>.
+
+    Returns the directory and the SHA-256 hex digest of the file.
+    """
+    # Construct the directory path under lensai
+    dir_path = BASE_PATH / "lensai" / file_type / sensor_id / timestamp
+
+    # Create the directory if it doesn't exist
+    await run_blocking(dir_path.mkdir, parents=True, exist_ok=True)
+
+    # Save the file
+    content_hash = await save_upload(file, dir_path / "{}.tar.gz".format(file_type))
+    return dir_path, content_hash
+
+def build_job_document(sensor_id, timestamp, file_type, dir_path, content_hash=None, received_at=None):
+    """Build the to_aggregate document for an upload, received now unless `received_at` is given."""
+    return {
+        'sensor_id': sensor_id,
+        'timestamp': timestamp,
+        'path': str(dir_path),
+        'file_type': file_type,
+        'content_hash': content_hash,
+        'state': 'pending',
+        'extracted': 0,
+        'received_at': time.time() if received_at is None else received_at
+    }
+
+def make_upload_dir(dir_path):
+    """Create an upload directory and its parents. Returns False if it already existed."""
+    try:
+        dir_path.mkdir(parents=True)
+        return True
+    except FileExistsError:
+        return False
+
+async def ingest_stats_inline(file, sensor_id, timestamp, content_hash=None):
+    """
+    Extract and index a stats archive while it is read, without storing the tarball.
+
+    sensor_id and timestamp must be checked with is_path_part first. On an invalid
+    archive or a content_hash mismatch a 400 HTTPException is raised, and the upload
+    directory is removed if this request created it.
+
+    Returns the directory, the processed "type" list and the SHA-256 hex digest of the archive.
+    """
+    dir_path = BASE_PATH / "lensai" / "stats" / sensor_id / timestamp
+    # In segment mode the sketches go to the segment store and no directory is written
+    created = SEGMENT_ROOT is None and await run_blocking(make_upload_dir, dir_path)
+    try:
+        processed_types, file_hash = await run_blocking(extract_stats_stream, file.file, str(dir_path),
+                                                        UPLOAD_CHUNK_SIZE, SEGMENT_ROOT, sensor_id)
+        if content_hash and content_hash != file_hash:
+            logging.error("Content hash mismatch for sensor_id: %s, timestamp: %s", sensor_id, timestamp)
+            raise HTTPException(status_code=400, detail="Content hash does not match the uploaded file.")
+    except (tarfile.TarError, EOFError) as e:
+        logging.error("Invalid stats archive for sensor_id: %s, timestamp: %s: %s", sensor_id, timestamp, e)
+        if created:
+            await run_blocking(shutil.rmtree, dir_path, ignore_errors=True)
+        raise HTTPException(status_code=400, detail="Invalid stats archive.")
+    except BaseException:
+        if created:
+            await run_blocking(shutil.rmtree, dir_path, ignore_errors=True)
+        raise
+    return dir_path, processed_types, file_hash
+
+def record_inline_stats(sensor_id, timestamp, dir_path, processed_types, content_hash):
+    """Write the completed sensor_stats document and an already extracted to_aggregate job."""
+    now = time.time()
+    collection_stats.update_one(
+        {"sensor_id": sensor_id, "timestamp": timestamp},
+        {"$setOnInsert": {
+            "project_name": PROJECT_ID,
+            "sensor_id": sensor_id,
+            "timestamp": timestamp,
+            "status": "completed",
+            "aggregated": 0,
+            "type": processed_types,
+            "received_at": now,
+            "extracted_at": now
+        }},
+        upsert=True
+    )
+    data = build_job_document(sensor_id, timestamp, "stats", dir_path, content_hash, received_at=now)
+    data['state'] = 'done'
+    data['extracted'] = 1
+    data['extracted_at'] = now
+    collection.insert_one(data)
+
+async def check_upload(sensor_id, timestamp, content_hash=None, reserve=False):
+    """
+    Return NEW, DUPLICATE or CONFLICT for an upload without touching the disk.
+
+    The in-process LRU is consulted first and MongoDB only on a miss. With
+    `reserve`, a NEW key is added to the LRU straight away so that concurrent
+    retries of the same upload are seen as duplicates.
+    """
+    key = (sensor_id, timestamp)
+    status = recent_uploads.check(key, content_hash)
+    if status != NEW:
+        return status
+
+    existing_document = await run_blocking(collection.find_one, {"sensor_id": sensor_id, "timestamp": timestamp},
+                                           {"content_hash": 1})
+    if existing_document:
+        recent_uploads.add(key, existing_document.get("content_hash"))
+        return classify(existing_document.get("content_hash"), content_hash)
+
+    # Another request may have reserved the key while MongoDB was queried
+    status = recent_uploads.check(key, content_hash)
+    if status == NEW and reserve:
+        recent_uploads.add(key, content_hash)
+    return status
+
+def duplicate_response(status, sensor_id, timestamp):
+    """Build the response for an upload that is not NEW."""
+    if status == CONFLICT:
+        logging.error("Conflicting upload for sensor_id: %s, timestamp: %s", sensor_id, timestamp)
+        return JSONResponse(content={"message": "A different file already exists for this sensor_id and timestamp"},
+                            status_code=409)
+    logging.info("Document already exists for sensor_id: %s, timestamp: %s", sensor_id, timestamp)
+    return JSONResponse(content={"message": "Document already exists"}, status_code=200)
+
+def schedule_backpressure_refresh():
+    """Refresh the cached backlog and disk figures in the background when they are stale."""
+    if backpressure.begin_refresh():
+        asyncio.get_running_loop().run_in_executor(io_executor, backpressure.refresh, collection)
+
+def overloaded_response(file_type):
+    """Build the 429 response for an upload rejected by admission control."""
+    logging.warning("Rejecting %s upload, server pressure is %s", file_type, backpressure.level())
+    return JSONResponse(content={"message": "Server is busy, retry later"}, status_code=429,
+                        headers={"Retry-After": str(backpressure.retry_after)})
+
+@app.get("/status")
+async def server_status():
+    """Report the current backlog, free disk space, uploads in flight and pressure level."""
+    schedule_backpressure_refresh()
+    return backpressure.status()
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics of the upload server."""
+    schedule_backpressure_refresh()
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+@app.get("/metrics/freshness")
+async def freshness_metrics(project_id: str = PROJECT_ID, window: str = "24h", limit: int = 100):
+    """
+    Report how stale the aggregates are: the lag of the newest aggregated upload of the
+    project and of every sensor (the `limit` stalest), the uploads waiting to be aggregated
+    and the latency histograms of each pipeline stage over the last `window`.
+    """
+    try:
+        window_seconds = parse_duration(window)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        report = await run_blocking(load_freshness, overall_stats_collection, sensor_overall_stats_collection,
+                                    project_id, window_seconds, time.time(), collection, collection_stats)
+    except Exception as e:
+        logging.error("Error reading freshness: %s", e)
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    report["sensors"] = report["sensors"][:limit]
+    return dict(report, project_id=project_id, window=window)
+
+@app.get("/upload/check")
+async def check_upload_needed(sensor_id: str, timestamp: str, content_hash: Optional[str] = None):
+    """Preflight check that tells a client whether an upload still has to be sent."""
+    try:
+        status = await check_upload(sensor_id, timestamp, content_hash)
+    except Exception as e:
+        logging.error("Error checking upload: %s", e)
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    return {"status": status, "upload_needed": status == NEW}
 
 @app.post("/upload/")
 async def upload_file(
     sensor_id: str = Form(...),
     timestamp: str = Form(...),
     file_type: str = Form(...),
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    content_hash: Optional[str] = Form(None)
 ):
     # Validate file_type
-    if file_type not in ["stats", "data"]:
+    if file_type not in VALID_FILE_TYPES:
         logging.error("Invalid file type provided: %s", file_type)
         raise HTTPException(status_code=400, detail="Invalid file type. Must be 'stats' or 'data'.")
 
+    # sensor_id and timestamp name the directory the upload is written to
+    if not (is_path_part(sensor_id) and is_path_part(timestamp)):
+        logging.error("Invalid sensor_id or timestamp provided: %r, %r", sensor_id, timestamp)
+        raise HTTPException(status_code=400, detail=INVALID_KEY_MESSAGE)
+
+    # Admission control turned the request away before its body was received if the server
+    # is overloaded; data uploads received above the DEGRADED watermarks are still deferred
+    if backpressure.defers(file_type):
+        return overloaded_response(file_type)
+
+    key = (sensor_id, timestamp)
+    async with upload_slots:
+        try:
+            # Check for a duplicate before any disk I/O
+            status = await check_upload(sensor_id, timestamp, content_hash, reserve=True)
+            if status != NEW:
+                return duplicate_response(status, sensor_id, timestamp)
+
+            try:
+                if INLINE_STATS_INGEST and file_type == "stats":
+                    # Extract and index the archive straight from the request
+                    dir_path, processed_types, file_hash = await ingest_stats_inline(file, sensor_id, timestamp,
+                                                                                     content_hash)
+                    await run_blocking(record_inline_stats, sensor_id, timestamp, dir_path, processed_types, file_hash)
+                    publisher.publish("aggregate")
+                else:
+                    # Save the file
+                    dir_path, file_hash = await store_upload(file, file_type, sensor_id, timestamp)
+                    if content_hash and content_hash != file_hash:
+                        logging.error("Content hash mismatch for sensor_id: %s, timestamp: %s", sensor_id, timestamp)
+                        await run_blocking((dir_path / "{}.tar.gz".format(file_type)).unlink)
+                        raise HTTPException(status_code=400, detail="Content hash does not match the uploaded file.")
+
+                    # Insert document into MongoDB
+                    data = build_job_document(sensor_id, timestamp, file_type, dir_path, file_hash)
+                    await run_blocking(collection.insert_one, data)
+                    backpressure.record_jobs()
+                    publisher.publish(file_type)
+            except BaseException:
+                recent_uploads.discard(key)
+                raise
+            recent_uploads.add(key, file_hash)
+            logging.info("File uploaded and document inserted successfully: %s", dir_path)
+
+            return JSONResponse(content={"message": "File uploaded successfully"}, status_code=201)
+
+        except errors.DuplicateKeyError as e:
+            recent_uploads.add(key)
+            logging.error("Duplicate entry for sensor_id: %s, timestamp: %s. Error: %s", sensor_id, timestamp, e)
+            return JSONResponse(content={"message": "Duplicate entry found, document already exists"}, status_code=200)
+        except HTTPException:
+            raise
+        except OSError as e:
+            logging.error("File system error: %s", e)
+            raise HTTPException(status_code=500, detail="File system error")
+        except Exception as e:
+            logging.error("Error uploading file: %s", e)
+            raise HTTPException(status_code=500, detail="Internal Server Error")
+
+@app.post("/upload/batch")
+async def upload_batch(
+    sensor_id: List[str] = Form(...),
+    timestamp: List[str] = Form(...),
+    file_type: List[str] = Form(...),
+    file: List[UploadFile] = File(...)
+):
+    """
+    Upload several archives in one request.
+
+    The i-th sensor_id, timestamp, file_type and file parts describe the i-th item.
+    Known duplicates are skipped before any disk I/O, the remaining files are written
+    in parallel and recorded with a single unordered insert_many; the response reports
+    a status of created, duplicate, deferred or error per item.
+    """
+    if not len(sensor_id) == len(timestamp) == len(file_type) == len(file):
+        logging.error("Mismatched batch upload: %d sensor_ids, %d timestamps, %d file_types, %d files",
+                      len(sensor_id), len(timestamp), len(file_type), len(file))
+        raise HTTPException(status_code=400, detail="sensor_id, timestamp, file_type and file must be given once per item.")
+
+    results = []
+    pending = []
+    seen = set()
+    for item_sensor_id, item_timestamp, item_file_type, item_file in zip(sensor_id, timestamp, file_type, file):
+        result = {"sensor_id": item_sensor_id, "timestamp": item_timestamp, "file_type": item_file_type}
+        results.append(result)
+        key = (item_sensor_id, item_timestamp)
+        if item_file_type not in VALID_FILE_TYPES:
+            result.update(status="error", message="Invalid file type. Must be 'stats' or 'data'.")
+        elif not (is_path_part(item_sensor_id) and is_path_part(item_timestamp)):
+            result.update(status="error", message=INVALID_KEY_MESSAGE)
+        elif backpressure.defers(item_file_type):
+            result.update(status="deferred", message="Server is busy, retry later",
+                          retry_after=backpressure.retry_after)
+        elif key in seen:
+            result.update(status="duplicate", message="Duplicate entry in batch")
+        elif recent_uploads.check(key) != NEW:
+            result.update(status="duplicate", message="Document already exists")
+        else:
+            seen.add(key)
+            pending.append((result, item_file))
+
+    # Look up the LRU misses with a single query before writing anything
+    if pending:
+        try:
+            existing_documents = await run_blocking(
+                lambda: list(collection.find(
+                    {"$or": [{"sensor_id": r["sensor_id"], "timestamp": r["timestamp"]} for r, _ in pending]},
+                    {"sensor_id": 1, "timestamp": 1, "content_hash": 1}
+                ))
+            )
+        except Exception as e:
+            logging.error("Error checking batch for duplicates: %s", e)
+            raise HTTPException(status_code=500, detail="Internal Server Error")
+        for document in existing_documents:
+            recent_uploads.add((document["sensor_id"], document["timestamp"]), document.get("content_hash"))
+
+        new_items = []
+        for result, item_file in pending:
+            key = (result["sensor_id"], result["timestamp"])
+            if key in recent_uploads:
+                result.update(status="duplicate", message="Document already exists")
+            else:
+                recent_uploads.add(key)
+                new_items.append((result, item_file))
+        pending = new_items
+
+    async def write_item(result, item_file):
+        async with upload_slots:
+            try:
+                result["path"], result["content_hash"] = await store_upload(
+                    item_file, result["file_type"], result["sensor_id"], result["timestamp"])
+            except OSError as e:
+                recent_uploads.discard((result["sensor_id"], result["timestamp"]))
+                logging.error("File system error for sensor_id: %s, timestamp: %s: %s", result["sensor_id"], result["timestamp"], e)
+                result.update(status="error", message="File system error")
+            except Exception as e:
+                recent_uploads.discard((result["sensor_id"], result["timestamp"]))
+                logging.error("Error storing upload for sensor_id: %s, timestamp: %s: %s", result["sensor_id"], result["timestamp"], e)
+                result.update(status="error", message="Internal Server Error")
+
     try:
-        # Construct the directory path under lensai
-        dir_path = BASE_PATH / "lensai" / file_type / sensor_id / timestamp
-        
-        # Create the directory if it doesn't exist
-        dir_path.mkdir(parents=True, exist_ok=True)
-
-        # Construct the file path
-        file_path = dir_path / "{}.tar.gz".format(file_type)
-
-        # Save the file
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # Check if a document with the same sensor_id and timestamp exists
-        existing_document = collection.find_one({"sensor_id": sensor_id, "timestamp": timestamp})
-        if existing_document:
-            logging.info("Document already exists for sensor_id: %s, timestamp: %s", sensor_id, timestamp)
-            return JSONResponse(content={"message": "Document already exists"}, status_code=200)
-
-        # Insert document into MongoDB
-        data = {
-            'sensor_id': sensor_id,
-            'timestamp': timestamp,
-            'path': str(dir_path),
-            'file_type': file_type,
-            'extracted': 0
-        }
-        collection.insert_one(data)
-        logging.info("File uploaded and document inserted successfully: %s", file_path)
-
-        return JSONResponse(content={"message": "File uploaded successfully"}, status_code=201)
-    
-    except errors.DuplicateKeyError as e:
-        logging.error("Duplicate entry for sensor_id: %s, timestamp: %s. Error: %s", sensor_id, timestamp, e)
-        return JSONResponse(content={"message": "Duplicate entry found, document already exists"}, status_code=200)
-    except OSError as e:
-        logging.error("File system error: %s", e)
-        raise HTTPException(status_code=500, detail="File system error")
-    except Exception as e:
-        logging.error("Error uploading file: %s", e)
-        raise HTTPException(status_code=500, detail="Internal Server Error")
+        await asyncio.gather(*(write_item(result, item_file) for result, item_file in pending))
+
+        written = [result for result, _ in pending if "status" not in result]
+        if written:
+            documents = [build_job_document(r["sensor_id"], r["timestamp"], r["file_type"], r["path"], r["content_hash"])
+                         for r in written]
+            write_errors = {}
+            try:
+                await run_blocking(collection.insert_many, documents, ordered=False)
+            except errors.BulkWriteError as e:
+                write_errors = {error["index"]: error for error in e.details.get("writeErrors", [])}
+            except Exception as e:
+                logging.error("Error inserting batch documents: %s", e)
+                write_errors = {index: {"code": None} for index in range(len(written))}
+
+            for index, result in enumerate(written):
+                key = (result["sensor_id"], result["timestamp"])
+                error = write_errors.get(index)
+                if error is None:
+                    recent_uploads.add(key, result["content_hash"])
+                    result.update(status="created", message="File uploaded successfully")
+                elif error.get("code") == 11000:
+                    result.update(status="duplicate", message="Document already exists")
+                else:
+                    recent_uploads.discard(key)
+                    result.update(status="error", message="Internal Server Error")
+    except BaseException:
+        # Cancelled or failed before every item was recorded, release the keys reserved above
+        for result, _ in pending:
+            if result.get("status") not in ("created", "duplicate"):
+                recent_uploads.discard((result["sensor_id"], result["timestamp"]))
+        raise
+
+    for result in results:
+        result.pop("path", None)
+        result.pop("content_hash", None)
 
+    created = sum(1 for result in results if result["status"] == "created")
+    backpressure.record_jobs(created)
+    for created_file_type in {result["file_type"] for result in results if result["status"] == "created"}:
+        publisher.publish(created_file_type)
+    logging.info("Batch upload of %d items, %d created", len(results), created)
+    return JSONResponse(content={"results": results}, status_code=200)
@@ -0,0 +1,86 @@
+# sketch_cache.py
+import os
+import threading
+from collections import OrderedDict
+
+
+def sketch_cache_key(sketch_ref):
+    """
+    Return the cache key of a sketch reference, or None if the sketch file is missing.
+
+    Files are keyed by path, mtime and size, so a rewritten file is never served
+    from the cache. Segment ranges never change once written and are keyed as is.
+    """
+    if isinstance(sketch_ref, tuple):
+        return ("segment",) + tuple(sketch_ref)
+    try:
+        stat = os.stat(sketch_ref)
+    except OSError:
+        return None
+    return ("file", sketch_ref, stat.st_mtime_ns, stat.st_size)
+
+
+class SketchCache:
+    """
+    Byte-budgeted LRU cache of deserialized sketches. Safe to share between threads.
+
+    The size of an entry is the size of its serialized sketch, which is what a
+    deserialized KLL sketch roughly occupies.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached sketch for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, sketch, size):
+        """Cache `sketch` under `key`, evicting the least recently used entries beyond the budget."""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self._entries[key] = (sketch, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return the hit, miss and eviction counters and the current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes
+            }
@@ -0,0 +1,89 @@
+# sketch_merge.py
+"""
+Parallel merge of serialized KLL sketches.
+
+The sketches of every (metric, submetric) key are merged with a tree
+reduction: leaves of up to `fan_in` serialized sketches are deserialized and
+merged independently, then the partial sketches are merged pairwise, level
+by level, until one sketch per key is left. The merges of all keys go to the
+same executor, so a cycle keeps every worker busy whether it has many small
+key groups or a few large ones.
+
+With a process pool only serialized bytes cross process boundaries.
+"""
+import logging
+
+from datasketches import kll_floats_sketch
+
+
+def merge_serialized(blobs):
+    """
+    Deserialize and merge serialized sketches. Returns the serialized merged sketch.
+
+    Already deserialized sketches, e.g. from a cache in a thread pool, are merged as they are.
+    """
+    merged = kll_floats_sketch()
+    for blob in blobs:
+        try:
+            merged.merge(blob if isinstance(blob, kll_floats_sketch) else kll_floats_sketch.deserialize(bytes(blob)))
+        except Exception as e:
+            logging.error(f"Error merging sketch: {e}")
+    return merged.serialize()
+
+
+def merge_sequential(blobs):
+    """Merge serialized sketches one after another into a sketch, as a reference for merge_groups."""
+    return kll_floats_sketch.deserialize(merge_serialized(blobs))
+
+
+def merge_batches(batches):
+    """Run merge_serialized on each list of sketches of a batch, in one task."""
+    return [merge_serialized(blobs) for blobs in batches]
+
+
+def merge_groups(executor, groups, fan_in=64):
+    """
+    Merge the serialized sketches of several keys with a parallel tree reduction.
+
+    Each level packs the pending merges of all keys into tasks of about
+    `fan_in` sketches, so thousands of small groups, e.g. one per sensor and
+    metric, do not cost one task each.
+
+    Args:
+        executor: Thread or process pool the merge tasks run on.
+        groups: Dict of key to a list of serialized sketches.
+        fan_in: Number of sketches merged by one leaf, and sketches per task.
+
+    Returns:
+        A dict of key to merged kll_floats_sketch, for the keys with at least one sketch.
+    """
+    fan_in = max(fan_in, 2)
+    level = {key: [blobs[start:start + fan_in] for start in range(0, len(blobs), fan_in)]
+             for key, blobs in groups.items() if blobs}
+    merged = {}
+    while level:
+        tasks = []
+        batch, batch_size = [], 0
+        for key, chunks in level.items():
+            for chunk in chunks:
+                batch.append((key, chunk))
+                batch_size += len(chunk)
+                if batch_size >= fan_in:
+                    tasks.append(batch)
+                    batch, batch_size = [], 0
+        if batch:
+            tasks.append(batch)
+
+        futures = [(batch, executor.submit(merge_batches, [chunk for _, chunk in batch])) for batch in tasks]
+        partials = {}
+        for batch, future in futures:
+            for (key, _), result in zip(batch, future.result()):
+                partials.setdefault(key, []).append(result)
+
+        level = {}
+        for key, results in partials.items():
+            if len(results) == 1:
+                merged[key] = kll_floats_sketch.deserialize(results[0])
+            else:
+                level[key] = [results[start:start + 2] for start in range(0, len(results), 2)]
+    return merged
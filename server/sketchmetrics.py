@@ -0,0 +1,149 @@
+# sketchmetrics.py
+"""
+Drift metrics computed directly from two KLL sketches.
+
+QuantileMetrics compares 30-bin equal-width histograms of the sketches, so
+outliers squash the bins and the metrics carry the error of the rebinning.
+These metrics query the sketches themselves:
+
+- KS statistic: largest difference of the CDFs over the reference quantiles
+- Wasserstein-1: mean absolute difference of the quantile functions at
+  QUANTILE_POINTS midpoint ranks, in the units of the metric. The outermost
+  1/(2 * QUANTILE_POINTS) of each tail is not weighed, so a few extreme
+  outliers do not dominate it
+- PSI and Jensen-Shannon: on buckets holding equal shares of the reference,
+  bounded by its quantiles
+
+Their error is the rank error of the sketches plus 1/QUANTILE_POINTS for KS.
+"""
+import numpy as np
+from scipy.special import rel_entr
+
+
+# Ranks at which the CDFs and quantile functions are compared
+QUANTILE_POINTS = 200
+
+# Buckets of equal reference mass of the PSI and Jensen-Shannon divergence
+QUANTILE_BUCKETS = 10
+
+# Floor for empty buckets in the PSI logarithm
+PSI_EPSILON = 1e-4
+
+
+class SketchBaseline:
+
+    def __init__(self, sketch, num_points=QUANTILE_POINTS, num_buckets=QUANTILE_BUCKETS):
+        """
+        Precompute the quantiles, CDF and buckets of a reference sketch, so it is
+        queried once and reused across comparisons.
+        sketch: Non-empty kll_floats_sketch.
+        """
+        self.sketch = sketch
+        self.ranks = (np.arange(num_points) + 0.5) / num_points
+        self.quantiles = np.array(sketch.get_quantiles(self.ranks.tolist()))
+        self.splits = np.unique(sketch.get_quantiles([i / num_buckets for i in range(1, num_buckets)]))
+        # The CDFs are compared at, and the bucket masses taken from, the same points
+        self.points = np.unique(np.concatenate([[sketch.get_min_value()], self.quantiles, self.splits,
+                                                [sketch.get_max_value()]]))
+        self.split_index = np.searchsorted(self.points, self.splits)
+        self.cdf = np.array(sketch.get_cdf(self.points.tolist()))
+        self.pmf = bucket_masses(self.cdf[None], self.split_index)[0]
+
+
+def bucket_masses(cdfs, split_index):
+    """Return the masses of the buckets bounded by the points at `split_index`, from rows of CDFs at the points."""
+    bounds = cdfs[:, split_index]
+    return np.diff(np.concatenate([np.zeros((len(cdfs), 1)), bounds, np.ones((len(cdfs), 1))], axis=1), axis=1)
+
+
+def _query_rows(sketches, query, points, width):
+    rows = np.empty((len(sketches), width))
+    for row, sketch in enumerate(sketches):
+        rows[row] = query(sketch, points)
+    return rows
+
+
+def batch_sketch_metrics(sketches, baseline, metrics=None):
+    """
+    Compute drift metrics of many sketches against one reference at once.
+
+    Args:
+        sketches: Non-empty kll_floats_sketch objects, e.g. one per sensor.
+        baseline: SketchBaseline of the reference sketch.
+        metrics: Names from SketchMetrics.available_metrics(), all of them by default.
+
+    Returns:
+        A dict of metric name to an array with one value per sketch.
+    """
+    metrics = SketchMetrics.available_metrics() if metrics is None else list(metrics)
+    results = {}
+    if {"ks_statistic", "psi", "jensen_shannon_divergence"} & set(metrics):
+        # One CDF query per sketch serves all three
+        cdfs = _query_rows(sketches, type(baseline.sketch).get_cdf, baseline.points.tolist(), len(baseline.cdf))
+        if "ks_statistic" in metrics:
+            results["ks_statistic"] = np.abs(cdfs - baseline.cdf).max(axis=1)
+        pmfs = bucket_masses(cdfs, baseline.split_index)
+        if "psi" in metrics:
+            expected = np.clip(baseline.pmf, PSI_EPSILON, None)
+            actual = np.clip(pmfs, PSI_EPSILON, None)
+            results["psi"] = np.sum((actual - expected) * np.log(actual / expected), axis=1)
+        if "jensen_shannon_divergence" in metrics:
+            m = (pmfs + baseline.pmf) / 2.0
+            js = np.sum(rel_entr(pmfs, m), axis=1) + np.sum(rel_entr(baseline.pmf, m), axis=1)
+            results["jensen_shannon_divergence"] = np.sqrt(np.maximum(js, 0) / 2.0)
+    if "wasserstein_distance" in metrics:
+        quantiles = _query_rows(sketches, type(baseline.sketch).get_quantiles, baseline.ranks.tolist(), len(baseline.ranks))
+        results["wasserstein_distance"] = np.abs(quantiles - baseline.quantiles).mean(axis=1)
+    unknown = set(metrics) - set(results)
+    if unknown:
+        raise ValueError(f"Unknown sketch metrics: {', '.join(sorted(unknown))}")
+    return {name: results[name] for name in metrics}
+
+
+class SketchMetrics:
+    """Drift metrics of one sketch against a reference sketch; use batch_sketch_metrics for many sketches."""
+
+    def __init__(self, sketch1, sketch2=None, baseline=None):
+        """
+        sketch1: Non-empty kll_floats_sketch to compare.
+        sketch2: Reference kll_floats_sketch.
+        baseline: SketchBaseline used instead of sketch2.
+        """
+        self.sketch1 = sketch1
+        self.baseline = baseline if baseline is not None else SketchBaseline(sketch2)
+
+    def _metric(self, name):
+        return batch_sketch_metrics([self.sketch1], self.baseline, [name])[name][0]
+
+    def ks_statistic(self):
+        """
+        Compute the Kolmogorov-Smirnov statistic.
+        """
+        return self._metric("ks_statistic")
+
+    def wasserstein_distance(self):
+        """
+        Compute the Wasserstein-1 distance.
+        """
+        return self._metric("wasserstein_distance")
+
+    def psi(self):
+        """
+        Calculate the Population Stability Index (PSI) on the reference quantile buckets.
+        """
+        return self._metric("psi")
+
+    def jensen_shannon_divergence(self):
+        """
+        Compute the Jensen-Shannon divergence on the reference quantile buckets.
+        """
+        return self._metric("jensen_shannon_divergence")
+
+    @staticmethod
+    def available_metrics():
+        return [
+            "ks_statistic",
+            "wasserstein_distance",
+            "psi",
+            "jensen_shannon_divergence"
+        ]
@@ -0,0 +1,191 @@
+# stats_ingest.py
+import hashlib
+import logging
+import os
+import shutil
+import tarfile
+from pathlib import PurePosixPath
+
+from helpers import METRIC_TYPES, is_within, parse_stat_file_name
+from segment_store import append_sketches
+
+
+class HashingReader:
+    """Read-only file wrapper that computes the SHA-256 of everything read through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def extract_tar_without_root(tar_path, extract_path):
+    """Extracts tar.gz file without creating a root directory. Returns True on success."""
+    try:
+        with tarfile.open(tar_path, "r:gz") as tar:
+            tar.extractall(path=extract_path)
+        logging.info(f"Extracted {tar_path} to {extract_path}")
+        return True
+    except (tarfile.TarError, IOError) as e:
+        logging.error(f"Error extracting {tar_path}: {e}")
+        return False
+
+
+def index_stats_dir(dir_path):
+    """
+    Indexes the sketch files extracted under dir_path.
+
+    Returns:
+        The processed "type" list for the sensor_stats document.
+    """
+    processed_types = []
+    for metrictype in METRIC_TYPES:
+        metrictype_path = os.path.join(dir_path, metrictype)
+        if os.path.exists(metrictype_path):
+            stats = []
+            for file_name in os.listdir(metrictype_path):
+                parsed = parse_stat_file_name(file_name)
+                if parsed:
+                    metric, submetric = parsed
+                    stats.append({
+                        "metric": metric,
+                        "submetric": submetric,
+                        "path": os.path.join(metrictype_path, file_name)
+                    })
+            if stats:
+                processed_types.append({
+                    "metrictype": metrictype,
+                    "stats": stats
+                })
+    return processed_types
+
+
+def extract_and_index_stats(dir_path, segment_root=None, sensor_id=None):
+    """
+    Extracts dir_path/stats.tar.gz, if still present, and indexes the sketch files.
+
+    With `segment_root`, the sketches are appended to the segment of `sensor_id`
+    instead of being extracted into files, and the archive is left in place for
+    the caller to delete once the index is stored.
+
+    This is the CPU-bound part of a stats job. It does not touch MongoDB, so it
+    can run in a worker process.
+
+    Returns:
+        The processed "type" list, or None if the archive could not be extracted.
+    """
+    tar_path = os.path.join(dir_path, "stats.tar.gz")
+    if segment_root is not None:
+        try:
+            with open(tar_path, "rb") as f:
+                processed_types, _ = extract_stats_stream(f, dir_path, segment_root=segment_root, sensor_id=sensor_id)
+            return processed_types
+        except (tarfile.TarError, EOFError, IOError) as e:
+            logging.error(f"Error extracting {tar_path}: {e}")
+            return None
+
+    if os.path.exists(tar_path):
+        if not extract_tar_without_root(tar_path, dir_path):
+            return None
+        os.remove(tar_path)  # Clean up the tar.gz file
+    return index_stats_dir(dir_path)
+
+
+def remove_stats_archive(dir_path, root):
+    """
+    Removes dir_path/stats.tar.gz once its sketches are stored in the segment store.
+
+    Only the archive is removed, and only if dir_path is below `root`, the
+    directory the stats uploads are written to.
+
+    Returns:
+        False if dir_path is outside `root` and nothing was removed.
+    """
+    if not is_within(dir_path, root):
+        logging.error(f"Not removing the archive of {dir_path}, it is outside {root}")
+        return False
+    try:
+        os.remove(os.path.join(dir_path, "stats.tar.gz"))
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def iter_sketch_members(tar):
+    """Yields (metrictype, file_name, metric, submetric, member) for the sketch files of a tar stream."""
+    for member in tar:
+        if not member.isfile():
+            continue
+        parts = PurePosixPath(member.name).parts
+        if parts and parts[0] == ".":
+            parts = parts[1:]
+        if len(parts) != 2 or parts[0] not in METRIC_TYPES:
+            continue
+        metrictype, file_name = parts
+        parsed = parse_stat_file_name(file_name)
+        if parsed:
+            yield (metrictype, file_name) + parsed + (member,)
+
+
+def extract_stats_stream(fileobj, dir_path, chunk_size=1024 * 1024, segment_root=None, sensor_id=None):
+    """
+    Extracts the sketch files of a stats.tar.gz read as a stream and indexes them.
+
+    Members are written to dir_path/<metrictype>/<file_name>, the same layout the
+    stats worker produces with extractall, without storing the archive itself.
+    With `segment_root`, they are appended to the segment of `sensor_id` instead
+    and indexed by segment, offset and length.
+
+    Args:
+        fileobj: File-like object positioned at the start of the gzip tar stream.
+        dir_path: Directory the sketch files are extracted to.
+        chunk_size: Chunk size used to copy member data.
+        segment_root: Root directory of the segment store, or None to write files.
+        sensor_id: Sensor whose segment the sketches are appended to.
+
+    Returns:
+        A tuple of the processed "type" list for the sensor_stats document and
+        the SHA-256 hex digest of the archive.
+
+    Raises:
+        tarfile.TarError: If the stream is not a valid gzip tar archive.
+    """
+    reader = HashingReader(fileobj)
+    entries = []
+    blobs = []
+    with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+        for metrictype, file_name, metric, submetric, member in iter_sketch_members(tar):
+            entry = {"metric": metric, "submetric": submetric}
+            if segment_root is not None:
+                with tar.extractfile(member) as source:
+                    blobs.append(source.read())
+            else:
+                metrictype_path = os.path.join(dir_path, metrictype)
+                os.makedirs(metrictype_path, exist_ok=True)
+                entry["path"] = os.path.join(metrictype_path, file_name)
+                with tar.extractfile(member) as source, open(entry["path"], "wb") as target:
+                    shutil.copyfileobj(source, target, chunk_size)
+            entries.append((metrictype, entry))
+
+    # Consume the end-of-archive padding so the hash covers the whole upload
+    while reader.read(chunk_size):
+        pass
+
+    if blobs:
+        segment, locations = append_sketches(segment_root, sensor_id, blobs)
+        for (_, entry), (offset, length) in zip(entries, locations):
+            entry.update(segment=segment, offset=offset, length=length)
+
+    stats_by_type = {}
+    for metrictype, entry in entries:
+        stats_by_type.setdefault(metrictype, []).append(entry)
+    processed_types = [{"metrictype": metrictype, "stats": stats_by_type[metrictype]}
+                       for metrictype in METRIC_TYPES if metrictype in stats_by_type]
+    return processed_types, reader.hexdigest()
@@ -0,0 +1,273 @@
+# telemetry.py
+"""
+Prometheus-style counters, gauges and histograms, and their text exposition.
+
+Every process keeps its own registry. The upload server serves it on
+/metrics from its FastAPI app; the workers and the aggregator serve it from
+a small HTTP listener on a daemon thread. Updating a metric takes a lock and
+a few additions, so it is cheap enough for the hot paths; gauges that need a
+query, e.g. a queue depth, are computed from a function when scraped.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pymongo import monitoring
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds of the histogram buckets, followed by +Inf
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"  # Not known yet, e.g. before a gauge was first refreshed
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in zip(labels, escaped)) + "}"
+
+
+class Registry:
+    """The metrics of a process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                lines.append("{}{}{} {}".format(metric.name, suffix, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Value:
+    """A counter or gauge value, or a function returning it when scraped."""
+
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def set_function(self, function):
+        """Report the value returned by `function` instead, e.g. a count read from MongoDB."""
+        self._function = function
+
+    def get(self):
+        if self._function is not None:
+            return self._function()
+        with self._lock:
+            return self._value
+
+
+class _HistogramValue:
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of the block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def get(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+        if not self.labelnames:
+            self.labels()  # Reported as 0 until first updated
+
+    def labels(self, *values):
+        """Return the child of these label values, created on first use."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.labelnames)}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        return _Value()
+
+    def _label_sets(self):
+        with self._lock:
+            children = list(self._children.items())
+        return [(dict(zip(self.labelnames, key)), child) for key, child in children]
+
+    def samples(self):
+        for labels, child in self._label_sets():
+            try:
+                yield "", labels, child.get()
+            except Exception as e:
+                logging.error(f"Error reading metric {self.name}: {e}")
+
+    # Metrics without labels are updated directly
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def samples(self):
+        for labels, child in self._label_sets():
+            counts, total = child.get()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", dict(labels, le=_format_value(bound)), cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Latency of the MongoDB commands of a client by command and collection.
+    Passed to MongoClient(event_listeners=[...]).
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self.duration = Histogram("lensai_mongo_command_duration_seconds", "MongoDB command latency",
+                                  ["command", "collection"], buckets=MONGO_BUCKETS, registry=registry)
+        self.failures = Counter("lensai_mongo_command_failures_total", "Failed MongoDB commands",
+                                ["command", "collection"], registry=registry)
+        self._collections = {}
+
+    def started(self, event):
+        # The collection is the value of the command name, e.g. {"find": "sensor_stats", ...}
+        name = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        self._collections[event.request_id] = name if isinstance(name, str) else ""
+
+    def succeeded(self, event):
+        collection = self._collections.pop(event.request_id, "")
+        self.duration.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._collections.pop(event.request_id, "")
+        self.duration.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        self.failures.labels(event.command_name, collection).inc()
+
+
+# Listener of the MongoDB clients of this process
+mongo_command_metrics = MongoCommandMetrics()
+
+
+def start_metrics_server(port, host="0.0.0.0", registry=REGISTRY):
+    """Serve the registry on http://host:port/metrics from a daemon thread; port 0 disables it."""
+    if not port:
+        return None
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are not logged
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# The server modules are imported as top-level modules, as the workers run them from server/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Fixture script that seeds a live MongoDB, not a test module
+collect_ignore = ["test_worker.py"]
+
+
+@pytest.fixture
+def mongo_db():
+    """An empty in-process stand-in for a MongoDB database, from the benchmark requirements."""
+    mongomock = pytest.importorskip("mongomock")
+    from benchmarks.local_stack import patch_mongomock
+    patch_mongomock()
+    return mongomock.MongoClient()["lensai_test"]
+
+
+@pytest.fixture(scope="session")
+def local_stack():
+    """The server, worker and aggregator modules on one in-process MongoDB stand-in, as the benchmarks run them."""
+    pytest.importorskip("mongomock")
+    from benchmarks.local_stack import LocalStack
+    stack = LocalStack()
+    yield stack
+    stack.close()
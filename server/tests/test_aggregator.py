@@ -0,0 +1,137 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from datasketches import kll_floats_sketch
+
+from reference_baseline import ReferenceBaseline
+
+METRIC = ("brightness", "channel_0")
+# All snapshots fall in the same rollup buckets
+TIMESTAMP = str(int(time.time() // 300 * 300))
+
+
+@pytest.fixture
+def aggregator(local_stack):
+    local_stack.reset()
+    return local_stack.aggregator
+
+
+def make_sketch(values):
+    sketch = kll_floats_sketch()
+    for value in values:
+        sketch.update(float(value))
+    return sketch
+
+
+def add_snapshot(aggregator, tmp_path, sensor_id, values):
+    sketch = make_sketch(values)
+    path = tmp_path / sensor_id / "{}_{}.bin".format(*METRIC)
+    path.parent.mkdir(exist_ok=True)
+    path.write_bytes(sketch.serialize())
+    aggregator.collection.insert_one({
+        "sensor_id": sensor_id, "timestamp": TIMESTAMP, "status": "completed", "aggregated": 0,
+        "type": [{"metrictype": "imagestats", "stats": [{"metric": METRIC[0], "submetric": METRIC[1], "path": str(path)}]}],
+    })
+
+
+def running_count(aggregator):
+    state = aggregator.aggregate_state_collection.find_one({"metric": METRIC[0], "submetric": METRIC[1]})
+    return kll_floats_sketch.deserialize(state["sketch"]).n
+
+
+def rollup_counts(aggregator):
+    return sorted((rollup["granularity"], kll_floats_sketch.deserialize(rollup["sketch"]).n)
+                  for rollup in aggregator.rollup_collection.find({"metric": METRIC[0]}))
+
+
+def test_cycles_fold_only_new_snapshots(aggregator, tmp_path):
+    add_snapshot(aggregator, tmp_path, "sensor_1", range(100))
+    add_snapshot(aggregator, tmp_path, "sensor_2", range(50))
+    assert aggregator.process_and_insert_overall_stats() == 2
+
+    add_snapshot(aggregator, tmp_path, "sensor_3", range(10))
+    assert aggregator.process_and_insert_overall_stats() == 1
+    assert aggregator.process_and_insert_overall_stats() == 0
+
+    assert running_count(aggregator) == 160
+    assert aggregator.collection.count_documents({"aggregated": 1}) == 3
+    latest = aggregator.overall_stats_collection.find_one(sort=[("_id", -1)])
+    assert [(histogram["metric"], histogram["submetric"]) for histogram in latest["histograms"]] == [METRIC]
+    assert "expire_at" in latest  # The history is bounded by OVERALL_STATS_RETENTION
+
+
+def test_interrupted_cycle_is_resumed_without_merging_twice(aggregator, tmp_path):
+    add_snapshot(aggregator, tmp_path, "sensor_1", range(100))
+    aggregator.process_and_insert_overall_stats()
+    add_snapshot(aggregator, tmp_path, "sensor_2", range(30))
+
+    # The cycle folds the new snapshot, then stops before marking it aggregated
+    cycle, snapshots = aggregator.claim_pending_snapshots()
+    aggregator.fold_snapshots(snapshots, cycle)
+    assert running_count(aggregator) == 130
+    assert aggregator.collection.count_documents({"aggregated": 2, "aggregation_cycle": cycle}) == 1
+
+    # The next cycle resumes it: the keys stamped with its last_cycle are not merged again
+    assert aggregator.process_and_insert_overall_stats() == 1
+
+    assert running_count(aggregator) == 130
+    assert {count for _, count in rollup_counts(aggregator)} == {130}
+    assert aggregator.collection.count_documents({"aggregated": 1, "aggregation_cycle": cycle}) == 1
+
+
+def test_broken_merge_pool_stops_the_cycle_for_a_restart(aggregator, tmp_path, monkeypatch):
+    add_snapshot(aggregator, tmp_path, "sensor_1", range(100))
+    pool = ProcessPoolExecutor(max_workers=1)
+    with pytest.raises(BrokenProcessPool):
+        pool.submit(os._exit, 1).result()  # The pool process dies, e.g. out of memory
+
+    with monkeypatch.context() as patch:
+        patch.setattr(aggregator, "merge_executor", pool)
+        with pytest.raises(BrokenProcessPool):
+            aggregator.process_and_insert_overall_stats()
+    pool.shutdown()
+
+    # After the restart the snapshots left in progress are resumed
+    assert aggregator.collection.count_documents({"aggregated": 2}) == 1
+    assert aggregator.process_and_insert_overall_stats() == 1
+    assert running_count(aggregator) == 100
+
+
+def test_prewarm_loads_only_snapshots_waiting_to_be_aggregated(aggregator, tmp_path):
+    add_snapshot(aggregator, tmp_path, "sensor_1", range(100))
+    aggregator.process_and_insert_overall_stats()
+    add_snapshot(aggregator, tmp_path, "sensor_2", range(30))
+    aggregator.sketch_cache.clear()
+
+    aggregator.prewarm_sketch_cache(10)
+
+    assert len(aggregator.sketch_cache) == 1
+    hits = aggregator.sketch_cache.hits
+    aggregator.process_and_insert_overall_stats()
+    assert aggregator.sketch_cache.hits == hits + 1
+
+
+def test_sensor_drift_matches_the_drift_of_each_sensor_alone(aggregator):
+    reference = make_sketch(range(100))
+    x, pmf = aggregator.compute_histogram(reference)
+    baseline = ReferenceBaseline({"histograms": [{"metric": METRIC[0], "submetric": METRIC[1], "pmf": pmf, "x": x}]},
+                                 {METRIC: reference})
+    sensor_sketches = {"sensor_1": {METRIC: make_sketch(range(0, 200, 3))},
+                       "sensor_2": {METRIC: make_sketch([5] * 10)}}  # Constant: its PSI is NaN
+
+    documents = aggregator.compute_sensor_stats(sensor_sketches, baseline)
+
+    assert [document["sensor_id"] for document in documents] == ["sensor_1", "sensor_2"]
+    for document in documents:
+        assert document["expire_at"].timestamp() == document["last_updated"] + aggregator.SENSOR_STATS_RETENTION
+        alone = aggregator.compute_metrics(document["histograms"], baseline)
+        assert len(document["distance"]) == len(alone) == 1
+        for entry, expected in zip(document["distance"], alone):
+            assert (entry["metric"], entry["submetric"]) == (expected["metric"], expected["submetric"])
+            assert entry["distances"] == {name: None if value != value else value
+                                          for name, value in expected["distances"].items()}
+    assert documents[1]["distance"][0]["distances"]["PSI"] is None
+    assert all(value is not None for value in documents[0]["distance"][0]["distances"].values())
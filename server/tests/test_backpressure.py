@@ -0,0 +1,83 @@
+import logging
+
+import pytest
+
+from backpressure import DEGRADED, OK, OVERLOADED, Backpressure
+
+
+@pytest.fixture
+def backpressure(tmp_path):
+    return Backpressure(str(tmp_path), max_backlog=100, defer_data_backlog=50, min_free_disk_mb=100,
+                        defer_data_free_disk_mb=500, max_pending_uploads=2, refresh_interval=60, retry_after=30)
+
+
+class FailingCollection:
+    def count_documents(self, query):
+        raise ConnectionError("MongoDB is down")
+
+
+class Collection:
+    def __init__(self, count):
+        self.count = count
+
+    def count_documents(self, query):
+        return self.count
+
+
+@pytest.mark.parametrize("backlog, free_disk_mb, level, admitted", [
+    (0, None, OK, {"stats", "data"}),
+    (50, 10000, DEGRADED, {"stats"}),
+    (0, 499, DEGRADED, {"stats"}),
+    (100, 10000, OVERLOADED, set()),
+    (0, 99, OVERLOADED, set()),
+])
+def test_admit_by_watermark(backpressure, backlog, free_disk_mb, level, admitted):
+    backpressure.backlog = backlog
+    backpressure.free_disk_mb = free_disk_mb
+
+    assert backpressure.level() == level
+    assert {file_type for file_type in ["stats", "data"] if backpressure.admit(file_type)} == admitted
+
+
+@pytest.mark.parametrize("backlog, deferred", [(0, set()), (50, {"data"}), (100, {"data"})])
+def test_received_uploads_deferred_by_watermark(backpressure, backlog, deferred):
+    backpressure.backlog = backlog
+
+    # Stats uploads whose body was received are never deferred, OVERLOADED is checked before that
+    assert {file_type for file_type in ["stats", "data"] if backpressure.defers(file_type)} == deferred
+
+
+def test_uploads_in_flight_overload(backpressure):
+    with backpressure.track_upload():
+        assert backpressure.admit("data")
+        with backpressure.track_upload():
+            assert not backpressure.admit("stats")
+            assert backpressure.status()["level"] == OVERLOADED
+    assert backpressure.pending_uploads == 0
+    assert backpressure.status()["retry_after"] == 30
+
+
+def test_refresh_counts_jobs_recorded_meanwhile(backpressure):
+    assert backpressure.begin_refresh()
+    assert not backpressure.begin_refresh()  # Already running
+    backpressure.record_jobs(3)
+
+    backpressure.refresh(Collection(10))
+
+    assert backpressure.backlog == 13
+    assert backpressure.free_disk_mb > 0
+    assert not backpressure.begin_refresh()  # Fresh for refresh_interval
+
+
+def test_refresh_failure_keeps_the_last_figures(backpressure, caplog):
+    backpressure.refresh(Collection(60))
+    backpressure.last_refresh = 0
+    assert backpressure.begin_refresh()
+
+    with caplog.at_level(logging.ERROR):
+        backpressure.refresh(FailingCollection())
+
+    assert backpressure.backlog == 60
+    assert backpressure.level() == DEGRADED
+    assert "MongoDB is down" in caplog.text
+    assert not backpressure._refreshing
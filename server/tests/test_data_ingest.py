@@ -0,0 +1,40 @@
+import io
+import os
+import tarfile
+
+from data_ingest import extract_and_index_data, remove_data_archive
+
+
+def write_archive(dir_path, names):
+    with tarfile.open(os.path.join(dir_path, "data.tar.gz"), "w:gz") as tar:
+        for name in names:
+            info = tarfile.TarInfo(name)
+            info.size = 3
+            tar.addfile(info, io.BytesIO(b"png"))
+
+
+def test_members_outside_the_upload_directory_are_skipped(tmp_path):
+    upload = tmp_path / "sensor" / "upload"
+    upload.mkdir(parents=True)
+    write_archive(upload, ["../../escaped_123.png", "/tmp/lensai_escaped/x/escaped_123.png",
+                           "images/brightness_channel_0/sample_5.png"])
+
+    processed_types = extract_and_index_data(str(upload), str(tmp_path))
+
+    assert not (tmp_path / "escaped_123.png").exists()
+    assert not os.path.exists("/tmp/lensai_escaped")
+    assert processed_types == [{"metrictype": "images", "data": [{
+        "metric": "brightness", "submetric": "channel_0",
+        "data": [{"url": str(upload / "images" / "brightness_channel_0" / "sample_5.png"), "timestamp": 5}]}]}]
+
+
+def test_archive_is_kept_until_removed(tmp_path):
+    write_archive(tmp_path, ["images/brightness_channel_0/sample_5.png"])
+
+    first = extract_and_index_data(str(tmp_path), str(tmp_path))
+    retry = extract_and_index_data(str(tmp_path), str(tmp_path))  # e.g. after a failed data_stats write
+    remove_data_archive(str(tmp_path))
+
+    assert first == retry
+    assert not (tmp_path / "data.tar.gz").exists()
+    remove_data_archive(str(tmp_path))  # Already removed
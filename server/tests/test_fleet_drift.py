@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from datasketches import kll_floats_sketch
+
+from fleet_drift import (FleetSketches, divergence_scores, pairwise_matrix, top_divergent_pairs,
+                         top_divergent_sensors)
+from sketchmetrics import QUANTILE_POINTS, SketchBaseline, SketchMetrics
+
+
+def make_sketch(values):
+    sketch = kll_floats_sketch()
+    for value in values:
+        sketch.update(float(value))
+    return sketch
+
+
+@pytest.fixture
+def sketches():
+    rng = np.random.default_rng(0)
+    sketches = {"camera_{:03d}".format(index): make_sketch(rng.normal(0, 1, 2000)) for index in range(40)}
+    sketches["camera_007"] = make_sketch(rng.normal(2, 1, 2000))
+    sketches["camera_023"] = make_sketch(rng.normal(0, 3, 2000))
+    return sketches
+
+
+@pytest.fixture
+def fleet(sketches):
+    return FleetSketches(sketches)
+
+
+@pytest.mark.parametrize("metric", SketchMetrics.available_metrics())
+def test_matrix_is_symmetric_and_blocks_agree(fleet, metric):
+    matrix = pairwise_matrix(fleet, metric)
+    assert matrix.shape == (len(fleet), len(fleet))
+    np.testing.assert_allclose(matrix, matrix.T, atol=1e-9)
+    np.testing.assert_allclose(np.diag(matrix), 0, atol=1e-9)
+    blocks = np.vstack([block for _, block in fleet.iter_blocks(metric, block_size=7)])
+    np.testing.assert_allclose(blocks, matrix, atol=1e-12)
+
+
+def test_ks_close_to_sketch_metrics(sketches, fleet):
+    matrix = pairwise_matrix(fleet, "ks_statistic")
+    tolerance = 2 * kll_floats_sketch().normalized_rank_error(False) + 2 / QUANTILE_POINTS
+    for first, second in [("camera_007", "camera_000"), ("camera_023", "camera_001"), ("camera_002", "camera_003")]:
+        expected = SketchMetrics(sketches[first], baseline=SketchBaseline(sketches[second])).ks_statistic()
+        actual = matrix[fleet.sensor_ids.index(first), fleet.sensor_ids.index(second)]
+        assert abs(actual - expected) <= tolerance
+
+
+@pytest.mark.parametrize("metric", SketchMetrics.available_metrics())
+def test_top_divergent_sensors(fleet, metric):
+    top = top_divergent_sensors(fleet, metric, k=2, block_size=5)
+    assert {sensor_id for sensor_id, _ in top} == {"camera_007", "camera_023"}
+    matrix = pairwise_matrix(fleet, metric)
+    medians = [np.median(np.delete(row, index)) for index, row in enumerate(matrix)]
+    np.testing.assert_allclose(divergence_scores(fleet, metric), medians)
+
+
+def test_top_divergent_pairs_match_matrix(fleet):
+    matrix = pairwise_matrix(fleet, "wasserstein_distance")
+    upper = np.triu_indices(len(fleet), k=1)
+    expected = np.sort(matrix[upper])[::-1][:5]
+    pairs = top_divergent_pairs(fleet, "wasserstein_distance", k=5, block_size=3)
+    np.testing.assert_allclose([distance for _, _, distance in pairs], expected)
+    assert all("camera_007" in pair[:2] or "camera_023" in pair[:2] for pair in pairs)
@@ -0,0 +1,100 @@
+import pytest
+
+from freshness import (LATENCY_BUCKETS, freshness_report, latency_histogram, load_freshness, merge_latency_histograms,
+                       pending_uploads, upload_freshness)
+
+
+def test_latency_histogram_buckets_include_their_upper_bound():
+    histogram = latency_histogram([0.5, 1, 1.5, 100000])
+
+    assert histogram["counts"][:2] == [2, 1]
+    assert histogram["counts"][-1] == 1
+    assert sum(histogram["counts"]) == histogram["count"] == 4
+    assert histogram["max"] == 100000
+
+
+def test_merge_latency_histograms_skips_other_buckets():
+    merged = merge_latency_histograms([latency_histogram([2]), latency_histogram([40, 50]),
+                                       latency_histogram([3], buckets=[10])])
+
+    assert merged["count"] == 3
+    assert merged["sum"] == 92
+    assert merged["max"] == 50
+    assert merged["le"] == LATENCY_BUCKETS
+    assert merge_latency_histograms([]) is None
+
+
+def test_upload_freshness_stage_latencies():
+    snapshots = [
+        {"received_at": 100.0, "extracted_at": 110.0},
+        {"received_at": 130.0, "extracted_at": 131.0},
+        {},  # Stored before the stages were stamped
+    ]
+
+    freshness = upload_freshness(snapshots, 140.0, cycle=7)
+
+    assert freshness["aggregation_cycle"] == 7
+    assert freshness["uploads"] == 3
+    assert (freshness["oldest_received_at"], freshness["newest_received_at"]) == (100.0, 130.0)
+    assert freshness["stages"]["extract"]["sum"] == pytest.approx(11.0)
+    assert freshness["stages"]["aggregate"]["sum"] == pytest.approx(39.0)
+    assert freshness["stages"]["end_to_end"]["max"] == pytest.approx(40.0)
+    assert freshness["stages"]["end_to_end"]["count"] == 2
+
+
+def test_freshness_report_lags():
+    overall = [
+        {"freshness": upload_freshness([{"received_at": 100.0, "extracted_at": 101.0}], 105.0)},
+        {"freshness": upload_freshness([{"received_at": 150.0, "extracted_at": 152.0}], 160.0)},
+        {"freshness": upload_freshness([], 170.0)},  # Reference only
+    ]
+    sensors = [
+        {"sensor_id": "fresh", "freshness": upload_freshness([{"received_at": 150.0}], 160.0)},
+        {"sensor_id": "stale", "freshness": upload_freshness([{"received_at": 100.0}], 105.0)},
+        {"sensor_id": "old"},
+    ]
+
+    report = freshness_report(overall, sensors, 200.0, pending=(3, 180.0))
+
+    assert report["last_aggregated_at"] == 170.0
+    assert report["lag_seconds"] == 50.0
+    assert report["uploads"] == 2
+    assert report["stages"]["end_to_end"]["count"] == 2
+    assert [sensor["sensor_id"] for sensor in report["sensors"]] == ["stale", "fresh"]
+    assert report["sensors"][0]["lag_seconds"] == 100.0
+    assert report["pending"] == {"uploads": 3, "oldest_received_at": 180.0, "oldest_age_seconds": 20.0}
+
+
+def test_load_freshness_of_one_sensor(mongo_db):
+    overall, sensors = mongo_db["overall_stats"], mongo_db["sensor_overall_stats"]
+    overall.insert_one({"project_id": "p", "last_updated": 190,
+                        "freshness": upload_freshness([{"received_at": 150.0}], 160.0)})
+    sensors.insert_many([
+        {"project_id": "p", "sensor_id": "a", "last_updated": 100, "freshness": upload_freshness([{"received_at": 90.0}], 100.0)},
+        {"project_id": "p", "sensor_id": "a", "last_updated": 160, "freshness": upload_freshness([{"received_at": 150.0}], 160.0)},
+        {"project_id": "p", "sensor_id": "b", "last_updated": 160, "freshness": upload_freshness([{"received_at": 120.0}], 160.0)},
+    ])
+
+    report = load_freshness(overall, sensors, "p", 3600, 200.0, sensor_id="a")
+
+    assert report["lag_seconds"] == 50.0
+    assert [(sensor["sensor_id"], sensor["lag_seconds"]) for sensor in report["sensors"]] == [("a", 50.0)]
+    assert "pending" not in report
+
+
+def test_pending_uploads_leave_out_failed_jobs(mongo_db):
+    jobs, stats = mongo_db["to_aggregate"], mongo_db["sensor_stats"]
+    jobs.insert_many([
+        {"file_type": "stats", "extracted": 0, "state": "failed", "received_at": 10.0},  # Never aggregated
+        {"file_type": "stats", "extracted": 0, "state": "claimed", "received_at": 150.0},
+        {"file_type": "stats", "extracted": 0, "received_at": 160.0},  # Queued before job states
+        {"file_type": "data", "extracted": 0, "state": "pending", "received_at": 20.0},
+        {"file_type": "stats", "extracted": 1, "state": "done", "received_at": 30.0},
+    ])
+    stats.insert_many([
+        {"sensor_id": "a", "aggregated": 2, "received_at": 140.0},
+        {"sensor_id": "a", "aggregated": 1, "received_at": 40.0},
+        {"sensor_id": "reference", "aggregated": 0, "received_at": 50.0},
+    ])
+
+    assert pending_uploads(jobs, stats) == (3, 140.0)
@@ -0,0 +1,78 @@
+import pytest
+from datasketches import kll_floats_sketch
+
+METRIC_QUERY = """{
+  metricStats(projectId: "p", metric: "%s") {
+    quantiles(ps: [0, 0.5, 1])
+    cdf(points: [50, 10, 50, -1])
+    rank(value: 25)
+    histogram(bins: %d) { edges pmf }
+  }
+}"""
+
+
+@pytest.fixture
+def stack(local_stack):
+    local_stack.reset()
+    return local_stack
+
+
+def add_overall_stats(stack, last_updated, sketches, distance=None):
+    histograms = [{"metric": metric, "submetric": "", "pmf": [1.0], "x": [0.0, 1.0], "sketch": sketch.serialize()}
+                  for metric, sketch in sketches.items()]
+    stack.resolvers.overall_stats_collection.insert_one({"project_id": "p", "last_updated": last_updated,
+                                                         "histograms": histograms, "distance": distance or []})
+
+
+def make_sketch(values):
+    sketch = kll_floats_sketch()
+    for value in values:
+        sketch.update(float(value))
+    return sketch
+
+
+def metric_stats(stack, metric, bins=30):
+    response = stack.schema.execute_sync(METRIC_QUERY % (metric, bins))
+    assert response.errors is None
+    return response.data["metricStats"]
+
+
+def test_sketch_queries_of_a_metric(stack):
+    add_overall_stats(stack, 100, {"brightness": make_sketch(range(100)), "empty": kll_floats_sketch()})
+
+    stats = metric_stats(stack, "brightness", bins=4)
+
+    assert stats["quantiles"] == [0.0, 50.0, 99.0]
+    # Unsorted and duplicate points are answered in the order they were asked
+    assert stats["cdf"] == [0.5, 0.1, 0.5, 0.0]
+    assert stats["rank"] == 0.25
+    assert stats["histogram"]["edges"] == [0.0, 24.75, 49.5, 74.25, 99.0]
+    assert stats["histogram"]["pmf"] == [0.25, 0.25, 0.25, 0.25]
+    assert metric_stats(stack, "empty") == {"quantiles": None, "cdf": None, "rank": None, "histogram": None}
+
+
+def test_single_bin_and_constant_sketch_histograms(stack):
+    add_overall_stats(stack, 100, {"brightness": make_sketch(range(100)), "constant": make_sketch([5] * 10)})
+
+    assert metric_stats(stack, "brightness", bins=1)["histogram"] == {"edges": [0.0, 99.0], "pmf": [1.0]}
+    constant = metric_stats(stack, "constant")
+    assert constant["histogram"] == {"edges": [5.0, 5.0], "pmf": [1.0]}
+    assert constant["quantiles"] == [5.0, 5.0, 5.0]
+    assert constant["cdf"] == [1.0, 1.0, 1.0, 0.0]
+
+
+def test_metric_distances_read_only_the_distances(stack, monkeypatch):
+    distance = [{"metric": "brightness", "submetric": "", "distances": {"PSI": 0.5, "KS": None}}]
+    add_overall_stats(stack, 100, {"brightness": make_sketch(range(10))}, distance)
+    add_overall_stats(stack, 200, {"brightness": make_sketch(range(20))})  # No reference yet
+    collection = stack.resolvers.overall_stats_collection
+    projections = []
+    find = collection.find
+    monkeypatch.setattr(collection, "find", lambda query, projection=None: projections.append(dict(projection or {}))
+                        or find(query, projection))
+
+    distances = stack.resolvers.get_metric_distances("p")
+
+    assert projections == [{"last_updated": 1, "distance": 1}]
+    assert [entry.timestamp for entry in distances.distances] == ["100"]
+    assert distances.distances[0].distance[0].distancevalues.PSI == 0.5
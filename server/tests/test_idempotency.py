@@ -0,0 +1,45 @@
+from idempotency import CONFLICT, DUPLICATE, NEW, RecentUploads, classify
+
+
+def test_classify_hashes():
+    assert classify("a", "a") == DUPLICATE
+    assert classify("a", None) == DUPLICATE
+    assert classify(None, "b") == DUPLICATE
+    assert classify("a", "b") == CONFLICT
+
+
+def test_check_new_duplicate_and_conflict():
+    recent = RecentUploads(10)
+    key = ("sensor_1", "1718000000")
+    assert recent.check(key, "a") == NEW
+
+    recent.add(key, "a")
+    assert recent.check(key) == DUPLICATE
+    assert recent.check(key, "a") == DUPLICATE
+    assert recent.check(key, "b") == CONFLICT
+
+    recent.add(key)  # A later add without a hash keeps the known one
+    assert recent.check(key, "b") == CONFLICT
+    recent.discard(key)
+    assert recent.check(key, "b") == NEW
+
+
+def test_least_recently_seen_key_is_evicted():
+    recent = RecentUploads(2)
+    recent.add(("sensor_1", "1"))
+    recent.add(("sensor_2", "2"))
+    recent.check(("sensor_1", "1"))  # Seen again, now the most recent
+
+    recent.add(("sensor_3", "3"))
+
+    assert len(recent) == 2
+    assert ("sensor_1", "1") in recent
+    assert ("sensor_2", "2") not in recent
+    assert recent.check(("sensor_2", "2")) == NEW
+
+
+def test_disabled_cache_keeps_nothing():
+    recent = RecentUploads(0)
+    recent.add(("sensor_1", "1"), "a")
+    assert len(recent) == 0
+    assert recent.check(("sensor_1", "1"), "a") == NEW
@@ -0,0 +1,96 @@
+from jobqueue import CLAIMED, DONE, FAILED, PENDING, LeaseHeartbeat, claim_jobs, complete_job, complete_jobs, fail_job
+
+
+def add_jobs(collection, count, file_type="stats"):
+    collection.insert_many([{"sensor_id": f"sensor_{index}", "timestamp": str(index), "file_type": file_type,
+                             "path": f"/uploads/{index}", "extracted": 0} for index in range(count)])
+
+
+def test_claimed_jobs_are_not_claimed_twice(mongo_db):
+    jobs_collection = mongo_db["to_aggregate"]
+    add_jobs(jobs_collection, 3)
+    add_jobs(jobs_collection, 1, file_type="data")
+
+    first = claim_jobs(jobs_collection, "stats", "worker_a", 60, 2)
+    second = claim_jobs(jobs_collection, "stats", "worker_b", 60, 2)
+
+    assert [job["sensor_id"] for job in first] == ["sensor_0", "sensor_1"]
+    assert [job["sensor_id"] for job in second] == ["sensor_2"]
+    assert all(job["state"] == CLAIMED and job["attempts"] == 1 for job in first + second)
+    assert claim_jobs(jobs_collection, "stats", "worker_c", 60, 2) == []
+
+
+def test_expired_lease_is_reclaimed(mongo_db):
+    jobs_collection = mongo_db["to_aggregate"]
+    add_jobs(jobs_collection, 1)
+    [job] = claim_jobs(jobs_collection, "stats", "worker_a", 60, 1)
+    jobs_collection.update_one({"_id": job["_id"]}, {"$set": {"lease_expiry": 0}})  # worker_a stalled
+
+    [reclaimed] = claim_jobs(jobs_collection, "stats", "worker_b", 60, 1)
+
+    assert reclaimed["worker_id"] == "worker_b"
+    assert reclaimed["attempts"] == 2
+    # The stalled worker no longer holds the job and cannot complete it
+    assert not complete_job(jobs_collection, job, "worker_a")
+    assert complete_job(jobs_collection, reclaimed, "worker_b")
+    assert jobs_collection.find_one({"_id": job["_id"]})["state"] == DONE
+
+
+def test_failed_job_is_retried_until_max_attempts(mongo_db):
+    jobs_collection = mongo_db["to_aggregate"]
+    add_jobs(jobs_collection, 1)
+
+    states = []
+    for _ in range(3):
+        [job] = claim_jobs(jobs_collection, "stats", "worker_a", 60, 1)
+        states.append(fail_job(jobs_collection, job, "worker_a", 3, ValueError("invalid archive")))
+
+    assert states == [PENDING, PENDING, FAILED]
+    stored = jobs_collection.find_one({})
+    assert (stored["state"], stored["attempts"], stored["error"]) == (FAILED, 3, "invalid archive")
+    assert "lease_expiry" not in stored
+    assert claim_jobs(jobs_collection, "stats", "worker_a", 60, 1) == []
+
+
+def test_complete_jobs_returns_only_the_jobs_still_held(mongo_db):
+    jobs_collection = mongo_db["to_aggregate"]
+    add_jobs(jobs_collection, 3)
+    jobs = claim_jobs(jobs_collection, "stats", "worker_a", 60, 3)
+    # The lease of the second job ran out and another worker holds it now
+    jobs_collection.update_one({"_id": jobs[1]["_id"]}, {"$set": {"worker_id": "worker_b"}})
+
+    completed = complete_jobs(jobs_collection, jobs, "worker_a")
+
+    assert [job["_id"] for job in completed] == [jobs[0]["_id"], jobs[2]["_id"]]
+    assert jobs_collection.find_one({"_id": jobs[1]["_id"]})["state"] == CLAIMED
+    assert jobs_collection.count_documents({"state": DONE, "extracted": 1}) == 2
+    assert complete_jobs(jobs_collection, [], "worker_a") == []
+
+
+def test_job_expiring_on_its_last_attempt_fails(mongo_db):
+    jobs_collection = mongo_db["to_aggregate"]
+    add_jobs(jobs_collection, 1)
+    for worker_id in ["worker_a", "worker_b"]:
+        [job] = claim_jobs(jobs_collection, "stats", worker_id, 60, 1, max_attempts=2)
+        jobs_collection.update_one({"_id": job["_id"]}, {"$set": {"lease_expiry": 0}})  # The worker crashed
+
+    assert claim_jobs(jobs_collection, "stats", "worker_c", 60, 1, max_attempts=2) == []
+    stored = jobs_collection.find_one({})
+    assert (stored["state"], stored["attempts"], stored["error"]) == (FAILED, 2, "lease expired after 2 attempts")
+    assert "worker_id" not in stored and "lease_expiry" not in stored
+
+
+def test_heartbeat_renews_only_the_leases_still_held(mongo_db):
+    jobs_collection = mongo_db["to_aggregate"]
+    add_jobs(jobs_collection, 3)
+    jobs = claim_jobs(jobs_collection, "stats", "worker_a", 60, 3)
+    jobs_collection.update_many({}, {"$set": {"lease_expiry": 0}})
+    jobs_collection.update_one({"_id": jobs[1]["_id"]}, {"$set": {"worker_id": "worker_b"}})  # Taken over
+    heartbeat = LeaseHeartbeat(jobs_collection, "worker_a", 60)
+    heartbeat.add(jobs)
+    heartbeat.remove(jobs[2:])  # Completed
+
+    assert (len(heartbeat), heartbeat.renew()) == (2, 1)
+    assert [document["lease_expiry"] > 0 for document in jobs_collection.find().sort("_id", 1)] == [True, False, False]
+    # A long job keeps its lease and is not claimed by another worker
+    assert [job["_id"] for job in claim_jobs(jobs_collection, "stats", "worker_c", 60, 3)] == [jobs[1]["_id"], jobs[2]["_id"]]
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+from datasketches import kll_floats_sketch
+from scipy.interpolate import interp1d
+from scipy.spatial import distance
+from scipy.spatial.distance import jensenshannon
+from scipy.stats import entropy, pearsonr, spearmanr, wasserstein_distance
+
+from helpers import compute_histogram
+from quantilemetrics import (HistogramBaseline, QuantileMetrics, batch_metrics, normalize_bins,
+                             rebin_histogram, rebin_histogram_loop)
+
+
+def sketch_histogram(rng, loc, scale, num_splits):
+    """Build (x, pmf) of a sketch of normal samples the way helpers.compute_histogram does."""
+    sketch = kll_floats_sketch()
+    for value in rng.normal(loc, scale, 2000):
+        sketch.update(float(value))
+    step = (sketch.get_max_value() - sketch.get_min_value()) / num_splits
+    splits = [sketch.get_min_value() + i * step for i in range(num_splits)]
+    return splits + [sketch.get_max_value()], sketch.get_pmf(splits)
+
+
+def scipy_metrics(hist1, bins1, hist2, bins2, num_buckets=10):
+    """Every metric of one pair with the per-pair loop and scipy functions QuantileMetrics used before."""
+    hist1, hist2 = np.array(hist1), np.array(hist2)
+    bins1 = normalize_bins(np.array(bins1), min(bins1), max(bins1))
+    bins2 = normalize_bins(np.array(bins2), min(bins2), max(bins2))
+    common_bins = np.union1d(bins1, bins2)
+    p = rebin_histogram_loop(hist1, bins1, common_bins)
+    q = rebin_histogram_loop(hist2, bins2, common_bins)
+
+    common_x = np.linspace(max(min(bins1), min(bins2)), min(max(bins1), max(bins2)), num_buckets + 1)
+    expected = interp1d(bins1, hist1, kind='linear', fill_value="extrapolate")(common_x)
+    actual = interp1d(bins2, hist2, kind='linear', fill_value="extrapolate")(common_x)
+    expected = np.where(expected == 0, 0.0001, expected)
+    actual = np.where(actual == 0, 0.0001, actual)
+    return {
+        "euclidean_distance": distance.euclidean(p, q),
+        "manhattan_distance": distance.cityblock(p, q),
+        "cosine_similarity": 1 - distance.cosine(p, q),
+        "pearson_correlation": pearsonr(p, q)[0],
+        "spearman_rank_correlation": spearmanr(p, q)[0],
+        "jensen_shannon_divergence": jensenshannon(p, q),
+        "kullback_leibler_divergence": entropy(p, q),
+        "hellinger_distance": np.sqrt(np.sum((np.sqrt(p) - np.sqrt(q)) ** 2)) / np.sqrt(2),
+        "wasserstein_distance": wasserstein_distance(p, q),
+        "psi": np.sum((expected - actual) * np.log(expected / actual)),
+    }
+
+
+@pytest.fixture
+def pairs():
+    rng = np.random.default_rng(0)
+    return [(sketch_histogram(rng, rng.normal(), rng.uniform(0.5, 2), int(rng.integers(2, 40))),
+             sketch_histogram(rng, rng.normal(), 1.0, int(rng.integers(2, 40))))
+            for _ in range(50)]
+
+
+def test_rebin_matches_loop(pairs):
+    for (x1, pmf1), (x2, pmf2) in pairs:
+        metrics = QuantileMetrics(pmf1, x1, pmf2, x2)
+        for hist, bins, rebinned in [(metrics.hist1, metrics.bins1, metrics.rebinned_hist1),
+                                     (metrics.hist2, metrics.bins2, metrics.rebinned_hist2)]:
+            assert np.array_equal(rebinned, rebin_histogram_loop(hist, bins, metrics.common_bins))
+
+
+def test_rebin_identical_and_nested_bins():
+    bins = np.linspace(0, 1, 11)
+    hist = np.arange(11, dtype=float)
+    assert np.array_equal(rebin_histogram(hist, bins, bins), hist[:-1])
+
+    common = np.union1d(bins, [0.05, 0.55, 0.999])
+    assert np.array_equal(rebin_histogram(hist, bins, common), rebin_histogram_loop(hist, bins, common))
+    assert rebin_histogram(hist, bins, bins[:1]).shape == (0,)
+
+
+@pytest.fixture
+def mixed_pairs():
+    """Histogram pairs of aggregated sketches, including constant and discrete ones."""
+    rng = np.random.default_rng(1)
+
+    def sketch(kind):
+        values = {"constant": [3.0] * 20,
+                  "discrete": rng.integers(0, 3, 500),
+                  "normal": rng.normal(rng.normal(), rng.uniform(0.3, 2), 1000)}[kind]
+        result = kll_floats_sketch()
+        for value in values:
+            result.update(float(value))
+        return result
+
+    kinds = ["constant", "discrete", "normal"]
+    return [compute_histogram(sketch(rng.choice(kinds, p=[0.1, 0.2, 0.7]))) +
+            compute_histogram(sketch(rng.choice(kinds, p=[0.1, 0.2, 0.7])))
+            for _ in range(100)]
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_batch_matches_per_pair_scipy(mixed_pairs):
+    bins1, hists1, bins2, hists2 = zip(*mixed_pairs)
+    batch = batch_metrics(hists1, bins1, hists2, bins2)
+    assert list(batch) == QuantileMetrics.available_metrics()
+    for index, (x1, pmf1, x2, pmf2) in enumerate(mixed_pairs):
+        expected = scipy_metrics(pmf1, x1, pmf2, x2)
+        metrics = QuantileMetrics(pmf1, x1, pmf2, x2)
+        for name, value in expected.items():
+            np.testing.assert_allclose(batch[name][index], value, rtol=1e-9, atol=1e-12, equal_nan=True, err_msg=name)
+            np.testing.assert_allclose(getattr(metrics, name)(), value, rtol=1e-9, atol=1e-12, equal_nan=True, err_msg=name)
+
+
+def test_batch_metrics_subset_and_unknown(pairs):
+    (x1, pmf1), (x2, pmf2) = pairs[0]
+    result = batch_metrics([pmf1], [x1], [pmf2], [x2], metrics=["psi", "pearson_correlation"])
+    assert list(result) == ["psi", "pearson_correlation"]
+    assert result["psi"].shape == (1,)
+    with pytest.raises(ValueError):
+        batch_metrics([pmf1], [x1], [pmf2], [x2], metrics=["median"])
+
+
+def test_intermediates_are_cached(pairs):
+    (x1, pmf1), (x2, pmf2) = pairs[0]
+    metrics = QuantileMetrics(pmf1, x1, baseline=HistogramBaseline(pmf2, x2))
+    metrics.psi()
+    assert "common_bins" not in vars(metrics)
+
+    rebinned = metrics.rebinned_hist1
+    metrics.pearson_correlation()
+    metrics.euclidean_distance()
+    assert metrics.rebinned_hist1 is rebinned
@@ -0,0 +1,66 @@
+import pytest
+from datasketches import kll_floats_sketch
+
+from rollups import cover_window, parse_duration, parse_granularities, rollup_key, window_sketches
+
+DAY = 86400
+GRANULARITIES = parse_granularities("1d, 1h:30d, 5m:2d")
+
+
+def covered_seconds(buckets):
+    sizes = {name: seconds for name, seconds, _ in GRANULARITIES}
+    return sum(sizes[name] for name, _ in buckets)
+
+
+def test_parse_durations_and_granularities():
+    assert parse_duration("90s") == 90 and parse_duration(" 2w ") == 14 * DAY
+    assert GRANULARITIES == [("5m", 300, 2 * DAY), ("1h", 3600, 30 * DAY), ("1d", DAY, None)]
+    with pytest.raises(ValueError):
+        parse_duration("5 minutes")
+
+
+def test_cover_window_uses_coarse_buckets_in_the_middle():
+    start, end = 10 * DAY + 50 * 60, 12 * DAY  # Day 10 00:50 to day 12 00:00, 5-minute buckets still kept
+
+    buckets = cover_window(start, end, GRANULARITIES, now=end + 60)
+
+    assert buckets[:3] == [("5m", start), ("5m", start + 300), ("1h", 10 * DAY + 3600)]
+    assert buckets[-2:] == [("1h", 11 * DAY - 3600), ("1d", 11 * DAY)]
+    assert len(buckets) == 2 + 23 + 1
+    assert covered_seconds(buckets) == end - start
+    # Contiguous, without overlaps
+    sizes = {name: seconds for name, seconds, _ in GRANULARITIES}
+    assert all(bucket + sizes[name] == next_bucket for (name, bucket), (_, next_bucket) in zip(buckets, buckets[1:]))
+
+
+def test_window_ending_now_uses_the_current_bucket():
+    now = 20 * DAY + 10
+
+    buckets = cover_window(now - 5 * 3600 - 100, now, GRANULARITIES, now=now)
+
+    assert buckets[0] == ("5m", 20 * DAY - 5 * 3600 - 300)
+    assert buckets[-1] == ("1d", 20 * DAY)  # Reaches past now, nothing is stored beyond it yet
+
+
+def test_window_start_is_rounded_to_the_finest_retained_granularity():
+    # The 5-minute buckets of day 0 are gone by day 12, the hourly ones by day 40
+    assert cover_window(1000, 2 * DAY, GRANULARITIES, now=12 * DAY) == [("1d", 0), ("1d", DAY)]
+    assert cover_window(DAY + 1000, DAY + 7200, GRANULARITIES, now=12 * DAY) == [("1h", DAY), ("1h", DAY + 3600)]
+    assert cover_window(DAY + 1000, DAY + 7200, GRANULARITIES, now=40 * DAY) == [("1d", DAY)]
+    assert cover_window(DAY, DAY, GRANULARITIES, now=12 * DAY) == []
+
+
+def test_window_sketches_merge_the_covering_rollups(mongo_db):
+    rollups = mongo_db["stats_rollups"]
+    now = 12 * DAY
+    for name, start, values in [("1h", 11 * DAY, [1.0, 2.0]), ("1h", 11 * DAY + 3600, [3.0]),
+                                ("1h", 10 * DAY, [100.0])]:  # Outside the window
+        sketch = kll_floats_sketch()
+        for value in values:
+            sketch.update(value)
+        rollups.insert_one(dict(rollup_key("p", "brightness", "channel_0", name, start), sketch=sketch.serialize()))
+
+    merged = window_sketches(rollups, "p", 11 * DAY, 11 * DAY + 7200, GRANULARITIES, now)
+
+    sketch = merged[("brightness", "channel_0")]
+    assert (sketch.n, sketch.get_max_value()) == (3, 3.0)
@@ -0,0 +1,74 @@
+import os
+
+from segment_store import SegmentReader, append_sketches, compact_segment, compact_segments
+
+
+def add_snapshot(collection, path, locations, aggregated):
+    stats = [{"metric": "metric{}".format(index), "submetric": "", "segment": path, "offset": offset, "length": length}
+             for index, (offset, length) in enumerate(locations)]
+    return collection.insert_one({"type": [{"metrictype": "customstats", "stats": stats}],
+                                  "aggregated": aggregated}).inserted_id
+
+
+def read_stats(collection, snapshot_id):
+    return collection.find_one({"_id": snapshot_id})["type"][0]["stats"]
+
+
+def test_appends_are_located_by_offset(tmp_path):
+    path, first = append_sketches(str(tmp_path), "sensor_1", [b"aaa", b"bb"], day="20240101")
+    same_path, second = append_sketches(str(tmp_path), "sensor_1", [b"cccc"], day="20240101")
+    reader = SegmentReader()
+
+    assert path == same_path == os.path.join(str(tmp_path), "sensor_1", "20240101.seg")
+    assert first == [(0, 3), (3, 2)]
+    assert second == [(5, 4)]
+    assert [reader.read(path, offset, length) for offset, length in first + second] == [b"aaa", b"bb", b"cccc"]
+    reader.close()
+
+
+def test_segment_without_live_sketches_is_deleted(tmp_path, mongo_db):
+    path, locations = append_sketches(str(tmp_path), "sensor_1", [b"aaa", b"bb"], day="20240101")
+    add_snapshot(mongo_db["sensor_stats"], path, locations, aggregated=1)
+
+    assert compact_segment(mongo_db["sensor_stats"], path, 0.5) == "deleted"
+    assert not os.path.exists(path)
+
+
+def test_segment_with_enough_live_sketches_is_kept(tmp_path, mongo_db):
+    path, locations = append_sketches(str(tmp_path), "sensor_1", [b"aaaa", b"bb"], day="20240101")
+    add_snapshot(mongo_db["sensor_stats"], path, locations[:1], aggregated=0)
+    add_snapshot(mongo_db["sensor_stats"], path, locations[1:], aggregated=1)
+
+    assert compact_segment(mongo_db["sensor_stats"], path, 0.5) == "kept"  # A third is dead
+    assert os.path.exists(path)
+
+
+def test_rewritten_segment_keeps_live_sketches_at_remapped_offsets(tmp_path, mongo_db):
+    collection = mongo_db["sensor_stats"]
+    path, locations = append_sketches(str(tmp_path), "sensor_1", [b"dead1", b"live1", b"dead2", b"live2"], day="20240101")
+    add_snapshot(collection, path, [locations[0], locations[2]], aggregated=1)
+    live_id = add_snapshot(collection, path, [locations[1], locations[3]], aggregated=0)
+
+    assert compact_segment(collection, path, 0.5) == "rewritten"
+
+    assert not os.path.exists(path)
+    stats = read_stats(collection, live_id)
+    new_path = stats[0]["segment"]
+    assert new_path != path and os.path.basename(new_path).startswith("20240101-")
+    assert [(stat["offset"], stat["length"]) for stat in stats] == [(0, 5), (5, 5)]
+    reader = SegmentReader()
+    assert [reader.read(new_path, stat["offset"], stat["length"]) for stat in stats] == [b"live1", b"live2"]
+    reader.close()
+
+
+def test_compaction_skips_today_and_recent_segments(tmp_path, mongo_db):
+    collection = mongo_db["sensor_stats"]
+    today, _ = append_sketches(str(tmp_path), "sensor_1", [b"aaa"], day="20240102")
+    past, locations = append_sketches(str(tmp_path), "sensor_1", [b"aaa"], day="20240101")
+    add_snapshot(collection, past, locations, aggregated=1)
+
+    assert compact_segments(collection, str(tmp_path), grace_seconds=3600, today="20240102") == \
+        {"deleted": 0, "rewritten": 0, "kept": 0}
+    assert compact_segments(collection, str(tmp_path), grace_seconds=0, today="20240102") == \
+        {"deleted": 1, "rewritten": 0, "kept": 0}
+    assert os.path.exists(today) and not os.path.exists(past)
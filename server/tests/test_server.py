@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import io
+
+import httpx
+import pytest
+from fastapi import HTTPException, UploadFile
+from pymongo.errors import BulkWriteError
+
+from idempotency import RecentUploads
+from test_stats_ingest import ARCHIVE
+
+
+@pytest.fixture
+def server(local_stack, monkeypatch):
+    local_stack.reset()
+    monkeypatch.setattr(local_stack.server, "recent_uploads", RecentUploads(100))
+    return local_stack.server
+
+
+@pytest.fixture
+def pressure(server, monkeypatch):
+    """The backpressure of the server, with its figures pinned until the test changes them."""
+    monkeypatch.setattr(server.backpressure, "last_refresh", float("inf"))
+    monkeypatch.setattr(server.backpressure, "backlog", 0)
+    monkeypatch.setattr(server.backpressure, "free_disk_mb", None)
+    return server.backpressure
+
+
+def post(server, path, data, files):
+    async def send_request():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://lensai") as client:
+            return await client.post(path, data=data, files=files)
+    return asyncio.run(send_request())
+
+
+def post_batch(server, items):
+    """POST (sensor_id, timestamp, file_type) items to /upload/batch, all with ARCHIVE, and return the per-item statuses."""
+    data = {field: [item[index] for item in items] for index, field in enumerate(["sensor_id", "timestamp", "file_type"])}
+    response = post(server, "/upload/batch", data, [("file", ("upload.tar.gz", ARCHIVE)) for _ in items])
+    assert response.status_code == 200
+    return [result["status"] for result in response.json()["results"]]
+
+
+def ingest(server, archive, sensor_id="sensor_1", timestamp="1718000000", content_hash=None):
+    return asyncio.run(server.ingest_stats_inline(UploadFile(io.BytesIO(archive)), sensor_id, timestamp, content_hash))
+
+
+def test_inline_ingest_records_a_completed_snapshot_and_job(server):
+    dir_path, processed_types, content_hash = ingest(server, ARCHIVE)
+    server.record_inline_stats("sensor_1", "1718000000", dir_path, processed_types, content_hash)
+
+    assert dir_path == server.BASE_PATH / "lensai" / "stats" / "sensor_1" / "1718000000"
+    assert (dir_path / "imgstats" / "brightness_channel_0.bin").read_bytes() == b"sketch_a"
+    snapshot = server.collection_stats.find_one({"sensor_id": "sensor_1", "timestamp": "1718000000"})
+    assert (snapshot["status"], snapshot["aggregated"], snapshot["type"]) == ("completed", 0, processed_types)
+    job = server.collection.find_one({"sensor_id": "sensor_1", "timestamp": "1718000000"})
+    assert (job["state"], job["extracted"], job["file_type"]) == ("done", 1, "stats")
+    assert job["content_hash"] == hashlib.sha256(ARCHIVE).hexdigest()
+
+
+def test_rejected_inline_upload_removes_only_the_directory_it_created(server):
+    with pytest.raises(HTTPException) as invalid:
+        ingest(server, b"not a gzip tar archive")
+    with pytest.raises(HTTPException) as mismatch:
+        ingest(server, ARCHIVE, content_hash="0" * 64)
+
+    assert [invalid.value.status_code, mismatch.value.status_code] == [400, 400]
+    existing = server.BASE_PATH / "lensai" / "stats" / "sensor_1" / "1718000000"
+    assert not existing.exists()
+
+    existing.mkdir()
+    (existing / "kept.bin").write_bytes(b"sketch")
+    with pytest.raises(HTTPException):
+        ingest(server, b"not a gzip tar archive")
+    assert (existing / "kept.bin").exists()
+
+
+def test_inline_ingest_to_segments_writes_no_upload_directory(server, monkeypatch):
+    monkeypatch.setattr(server, "SEGMENT_ROOT", str(server.BASE_PATH / "lensai" / "segments"))
+
+    with pytest.raises(HTTPException):
+        ingest(server, b"not a gzip tar archive")
+    _, processed_types, _ = ingest(server, ARCHIVE)
+
+    assert not (server.BASE_PATH / "lensai" / "stats").exists()
+    assert [stat["length"] for metric_type in processed_types for stat in metric_type["stats"]] == [8, 8]
+
+
+def test_overloaded_uploads_are_rejected_before_the_body_is_received(server, pressure):
+    pressure.backlog = pressure.max_backlog
+    messages = []
+
+    async def receive():
+        raise AssertionError("The request body was read")
+
+    async def send(message):
+        messages.append(message)
+
+    for path in ["/upload/", "/upload/batch"]:
+        scope = {"type": "http", "method": "POST", "path": path, "headers": [], "query_string": b""}
+        asyncio.run(server.app(scope, receive, send))
+
+    assert [message["status"] for message in messages if message["type"] == "http.response.start"] == [429, 429]
+    assert (b"retry-after", str(pressure.retry_after).encode()) in messages[0]["headers"]
+    assert pressure.pending_uploads == 0
+
+
+def test_data_uploads_are_deferred_once_received_above_the_degraded_watermarks(server, pressure):
+    pressure.backlog = pressure.defer_data_backlog
+    form = {"sensor_id": "sensor_1", "timestamp": "1718000000"}
+
+    data = post(server, "/upload/", dict(form, file_type="data"), {"file": ("data.tar.gz", ARCHIVE)})
+    stats = post(server, "/upload/", dict(form, file_type="stats"), {"file": ("stats.tar.gz", ARCHIVE)})
+
+    assert (data.status_code, data.headers["Retry-After"]) == (429, str(pressure.retry_after))
+    assert stats.status_code == 201
+    assert server.collection.count_documents({}) == 1
+    assert pressure.pending_uploads == 0
+
+
+def test_batch_reports_a_status_per_item(server, pressure):
+    pressure.backlog = pressure.defer_data_backlog
+    server.recent_uploads.add(("sensor_1", "1"))
+
+    statuses = post_batch(server, [("sensor_1", "2", "stats"), ("sensor_1", "2", "stats"), ("sensor_1", "1", "stats"),
+                                   ("sensor_1", "3", "data"), ("sensor_1", "4", "logs"), ("..", "5", "stats")])
+
+    assert statuses == ["created", "duplicate", "duplicate", "deferred", "error", "error"]
+    assert [job["timestamp"] for job in server.collection.find()] == ["2"]
+    assert ("sensor_1", "3") not in server.recent_uploads  # A deferred item can be sent again
+
+
+def test_batch_maps_duplicate_key_write_errors_to_duplicates(server, pressure, monkeypatch):
+    def insert_many(documents, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": 11000}, {"index": 1, "code": 121}]})
+    monkeypatch.setattr(server.collection, "insert_many", insert_many)
+
+    statuses = post_batch(server, [("sensor_1", "1", "stats"), ("sensor_1", "2", "stats"), ("sensor_1", "3", "stats")])
+
+    assert statuses == ["duplicate", "error", "created"]
+    assert ("sensor_1", "1") in server.recent_uploads
+    assert ("sensor_1", "2") not in server.recent_uploads
+
+
+def test_batch_releases_the_reservations_of_failed_items(server, pressure, monkeypatch):
+    store_upload = server.store_upload
+
+    async def failing_store_upload(file, file_type, sensor_id, timestamp):
+        if timestamp == "1":
+            raise OSError("No space left on device")
+        return await store_upload(file, file_type, sensor_id, timestamp)
+    monkeypatch.setattr(server, "store_upload", failing_store_upload)
+
+    assert post_batch(server, [("sensor_1", "1", "stats"), ("sensor_1", "2", "stats")]) == ["error", "created"]
+    assert ("sensor_1", "1") not in server.recent_uploads
+    assert ("sensor_1", "2") in server.recent_uploads
+
+    monkeypatch.setattr(server.collection, "insert_many", lambda documents, ordered=True: 1 / 0)
+    assert post_batch(server, [("sensor_1", "3", "stats")]) == ["error"]
+    assert ("sensor_1", "3") not in server.recent_uploads
+
+
+def test_cancelled_batch_releases_its_reservations(server, pressure, monkeypatch):
+    run_blocking = server.run_blocking
+
+    async def cancelled_insert(func, *args, **kwargs):
+        if func == server.collection.insert_many:
+            raise asyncio.CancelledError
+        return await run_blocking(func, *args, **kwargs)
+    monkeypatch.setattr(server, "run_blocking", cancelled_insert)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(server.upload_batch(["sensor_1"], ["1"], ["stats"], [UploadFile(io.BytesIO(ARCHIVE))]))
+    assert ("sensor_1", "1") not in server.recent_uploads
@@ -0,0 +1,41 @@
+import os
+
+from sketch_cache import SketchCache, sketch_cache_key
+
+
+def test_least_recently_used_entries_are_evicted_over_the_byte_budget():
+    cache = SketchCache(100)
+    cache.put("a", "sketch_a", 40)
+    cache.put("b", "sketch_b", 40)
+    assert cache.get("a") == "sketch_a"  # "b" is now the least recently used
+
+    cache.put("c", "sketch_c", 40)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("sketch_a", "sketch_c")
+    assert cache.stats() == {"hits": 3, "misses": 1, "evictions": 1, "hit_ratio": 0.75,
+                             "entries": 2, "bytes": 80, "max_bytes": 100}
+
+
+def test_replaced_and_oversized_entries():
+    cache = SketchCache(100)
+    cache.put("a", "old", 60)
+    cache.put("a", "new", 30)
+    cache.put("huge", "sketch", 101)  # Larger than the whole budget, not cached
+
+    assert cache.get("a") == "new"
+    assert cache.get("huge") is None
+    assert (len(cache), cache.bytes, cache.evictions) == (1, 30, 0)
+
+
+def test_rewritten_file_gets_a_new_key(tmp_path):
+    path = tmp_path / "metric.bin"
+    path.write_bytes(b"sketch")
+    key = sketch_cache_key(str(path))
+
+    path.write_bytes(b"rewritten sketch")
+    os.utime(path, ns=(0, 1))
+
+    assert sketch_cache_key(str(path)) != key
+    assert sketch_cache_key(str(tmp_path / "missing.bin")) is None
+    assert sketch_cache_key(("/segments/sensor_1/20240101.seg", 0, 10)) == ("segment", "/segments/sensor_1/20240101.seg", 0, 10)
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from datasketches import kll_floats_sketch
+
+from sketch_merge import merge_groups, merge_sequential
+
+RANKS = np.linspace(0.01, 0.99, 99)
+
+
+def make_sketch(values):
+    sketch = kll_floats_sketch()
+    for value in values:
+        sketch.update(float(value))
+    return sketch
+
+
+@pytest.fixture
+def groups():
+    """Serialized sketches of a few keys, one large enough for several levels of the reduction."""
+    rng = np.random.default_rng(0)
+    values = {}
+    for key, count in [("brightness", 200), ("sharpness", 17), ("noise", 1)]:
+        values[key] = [rng.normal(rng.normal(0, 1), rng.uniform(0.5, 2), 500) for _ in range(count)]
+    return values, {key: [make_sketch(chunk).serialize() for chunk in chunks] for key, chunks in values.items()}
+
+
+def test_tree_reduction_matches_sequential_merge(groups):
+    values, blobs = groups
+    epsilon = kll_floats_sketch().normalized_rank_error(False)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        merged = merge_groups(executor, blobs, fan_in=4)
+
+    assert set(merged) == set(blobs)
+    for key, sketches in blobs.items():
+        tree, sequential = merged[key], merge_sequential(sketches)
+        exact = np.sort(np.concatenate(values[key]))
+        assert tree.n == sequential.n == len(exact)
+        for sketch in (tree, sequential):
+            # Normalized rank of the returned quantiles in the raw values
+            ranks = np.searchsorted(exact, sketch.get_quantiles(RANKS.tolist()), side="right") / len(exact)
+            assert np.abs(ranks - RANKS).max() <= epsilon
+        # Both are within the error of the exact ranks, so within twice it of each other
+        points = np.quantile(exact, RANKS).tolist()
+        assert np.abs(np.array(tree.get_cdf(points)) - np.array(sequential.get_cdf(points))).max() <= 2 * epsilon
+
+
+def test_merge_groups_takes_deserialized_sketches_and_skips_empty_groups():
+    sketches = [make_sketch(range(start, start + 100)) for start in range(0, 1000, 100)]
+    groups = {"cached": sketches[:5] + [sketch.serialize() for sketch in sketches[5:]], "empty": []}
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        merged = merge_groups(executor, groups, fan_in=2)
+
+    assert list(merged) == ["cached"]
+    assert merged["cached"].n == 1000
+    assert (merged["cached"].get_min_value(), merged["cached"].get_max_value()) == (0, 999)
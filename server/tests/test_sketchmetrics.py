@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from datasketches import kll_floats_sketch
+from scipy.stats import ks_2samp, wasserstein_distance
+
+from sketchmetrics import QUANTILE_POINTS, SketchBaseline, SketchMetrics, batch_sketch_metrics
+
+
+def make_sketch(values):
+    sketch = kll_floats_sketch()
+    for value in values:
+        sketch.update(float(value))
+    return sketch
+
+
+def exact_psi(reference, values, num_buckets=10):
+    """PSI of the raw values on the buckets of equal reference mass."""
+    edges = np.r_[-np.inf, np.quantile(reference, np.arange(1, num_buckets) / num_buckets), np.inf]
+    expected = np.clip(np.histogram(reference, edges)[0] / len(reference), 1e-4, None)
+    actual = np.clip(np.histogram(values, edges)[0] / len(values), 1e-4, None)
+    return np.sum((actual - expected) * np.log(actual / expected))
+
+
+@pytest.fixture
+def samples():
+    rng = np.random.default_rng(0)
+    reference = rng.normal(0, 1, 20000)
+    return reference, [rng.normal(shift, scale, 20000) for shift, scale in [(0, 1), (0.2, 1), (0.5, 1.5), (2, 0.5)]]
+
+
+def test_metrics_close_to_exact(samples):
+    reference, others = samples
+    baseline = SketchBaseline(make_sketch(reference))
+    tolerance = 2 * kll_floats_sketch().normalized_rank_error(False) + 1 / QUANTILE_POINTS
+    for values in others:
+        metrics = SketchMetrics(make_sketch(values), baseline=baseline)
+        assert abs(metrics.ks_statistic() - ks_2samp(reference, values).statistic) <= tolerance
+        assert metrics.wasserstein_distance() == pytest.approx(wasserstein_distance(reference, values), abs=0.05)
+        assert metrics.psi() == pytest.approx(exact_psi(reference, values), rel=0.1, abs=0.01)
+
+
+def test_outliers_do_not_distort_buckets(samples):
+    reference, others = samples
+    with_outliers = np.r_[reference, [1e6] * 20]
+    baseline = SketchBaseline(make_sketch(with_outliers))
+    metrics = SketchMetrics(make_sketch(others[1]), baseline=baseline)
+    assert metrics.psi() == pytest.approx(exact_psi(with_outliers, others[1]), rel=0.1, abs=0.01)
+
+
+def test_batch_matches_single(samples):
+    reference, others = samples
+    baseline = SketchBaseline(make_sketch(reference))
+    sketches = [make_sketch(values) for values in others]
+    batch = batch_sketch_metrics(sketches, baseline)
+    assert list(batch) == SketchMetrics.available_metrics()
+    for index, sketch in enumerate(sketches):
+        metrics = SketchMetrics(sketch, baseline=baseline)
+        for name in SketchMetrics.available_metrics():
+            assert batch[name][index] == pytest.approx(getattr(metrics, name)(), rel=1e-12)
+
+
+def test_identical_and_constant_sketches(samples):
+    reference, _ = samples
+    sketch = make_sketch(reference)
+    constant = make_sketch([3.0] * 10)
+    for a, b in [(sketch, sketch), (constant, constant)]:
+        values = batch_sketch_metrics([a], SketchBaseline(b))
+        assert all(value[0] == pytest.approx(0, abs=1e-12) for value in values.values())
+    with pytest.raises(ValueError):
+        batch_sketch_metrics([sketch], SketchBaseline(sketch), ["median"])
@@ -0,0 +1,98 @@
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+
+from helpers import is_path_part
+from segment_store import SegmentReader
+from stats_ingest import extract_stats_stream, remove_stats_archive
+
+
+def make_archive(members):
+    """Return the bytes of a stats.tar.gz holding `members`, a dict of name to content."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+ARCHIVE = make_archive({
+    "./imgstats/brightness_channel_0.bin": b"sketch_a",
+    "customstats/loss.bin": b"sketch_b",
+    "imgstats/._brightness_channel_0.bin": b"resource fork",
+    "imgstats/readme.txt": b"not a sketch",
+    "unknown/brightness.bin": b"unknown metric type",
+    "imgstats/nested/contrast.bin": b"too deep",
+    "../imgstats/escaped.bin": b"outside",
+})
+
+
+def test_upload_keys_must_name_a_single_directory():
+    assert is_path_part("sensor_1") and is_path_part("1718000000") and is_path_part("..hidden")
+    assert not any(is_path_part(value) for value in ["", ".", "..", "a/b", "/", "a\\b", "a\0b"])
+
+
+def test_only_the_archive_below_the_stats_root_is_removed(tmp_path):
+    stats_root = tmp_path / "lensai" / "stats"
+    upload = stats_root / "sensor_1" / "1718000000"
+    upload.mkdir(parents=True)
+    (upload / "stats.tar.gz").write_bytes(b"archive")
+    (upload / "kept.bin").write_bytes(b"sketch")
+
+    assert remove_stats_archive(str(upload), str(stats_root))
+    assert not (upload / "stats.tar.gz").exists()
+    assert (upload / "kept.bin").exists()
+    assert remove_stats_archive(str(upload), str(stats_root))  # Already removed
+
+
+def test_archive_outside_the_stats_root_is_not_removed(tmp_path):
+    stats_root = tmp_path / "lensai" / "stats"
+    stats_root.mkdir(parents=True)
+    (tmp_path / "stats.tar.gz").write_bytes(b"archive")
+
+    # The path of an upload with sensor_id ".." and timestamp ".."
+    assert not remove_stats_archive(str(stats_root / ".." / ".."), str(stats_root))
+    assert (tmp_path / "stats.tar.gz").exists()
+
+
+def test_sketch_members_are_extracted_and_indexed(tmp_path):
+    processed_types, content_hash = extract_stats_stream(io.BytesIO(ARCHIVE), str(tmp_path), chunk_size=4)
+
+    assert content_hash == hashlib.sha256(ARCHIVE).hexdigest()
+    assert processed_types == [
+        {"metrictype": "imgstats", "stats": [{"metric": "brightness", "submetric": "channel_0",
+                                              "path": str(tmp_path / "imgstats" / "brightness_channel_0.bin")}]},
+        {"metrictype": "customstats", "stats": [{"metric": "loss", "submetric": "",
+                                                 "path": str(tmp_path / "customstats" / "loss.bin")}]}]
+    assert (tmp_path / "imgstats" / "brightness_channel_0.bin").read_bytes() == b"sketch_a"
+    assert sorted(os.listdir(tmp_path / "imgstats")) == ["brightness_channel_0.bin"]
+    assert not (tmp_path.parent / "imgstats").exists()
+
+
+def test_sketch_members_are_appended_to_the_segment(tmp_path):
+    segment_root = tmp_path / "segments"
+
+    processed_types, content_hash = extract_stats_stream(io.BytesIO(ARCHIVE), str(tmp_path / "upload"),
+                                                         segment_root=str(segment_root), sensor_id="sensor_1")
+
+    assert content_hash == hashlib.sha256(ARCHIVE).hexdigest()
+    assert not (tmp_path / "upload").exists()
+    stats = [stat for metric_type in processed_types for stat in metric_type["stats"]]
+    assert [(stat["metric"], stat["offset"], stat["length"]) for stat in stats] == [("brightness", 0, 8), ("loss", 8, 8)]
+    assert os.path.dirname(stats[0]["segment"]) == str(segment_root / "sensor_1")
+    reader = SegmentReader()
+    assert [reader.read(stat["segment"], stat["offset"], stat["length"]) for stat in stats] == [b"sketch_a", b"sketch_b"]
+    reader.close()
+
+
+def test_invalid_archive_raises(tmp_path):
+    with pytest.raises(tarfile.TarError):
+        extract_stats_stream(io.BytesIO(b"not a gzip tar archive"), str(tmp_path))
+    truncated = make_archive({"imgstats/brightness.bin": os.urandom(100000)})[:-20000]  # Cut in the member data
+    with pytest.raises((tarfile.TarError, EOFError)):
+        extract_stats_stream(io.BytesIO(truncated), str(tmp_path))
@@ -0,0 +1,81 @@
+import socket
+import urllib.request
+
+import pytest
+
+from telemetry import Counter, Gauge, Histogram, Registry, start_metrics_server
+
+
+def test_render_counters_and_gauges():
+    registry = Registry()
+    requests = Counter("requests_total", "Requests", ["route", "status"], registry=registry)
+    depth = Gauge("queue_depth", "Jobs waiting", registry=registry)
+    requests.labels("/upload/", 201).inc()
+    requests.labels("/upload/", 201).inc(2)
+    requests.labels('/a"b', 500).inc()
+    depth.set_function(lambda: 7)
+
+    text = registry.render()
+
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{route="/upload/",status="201"} 3.0' in text
+    assert 'requests_total{route="/a\\"b",status="500"} 1.0' in text
+    assert "queue_depth 7.0" in text
+
+
+def test_unlabeled_metrics_are_reported_before_first_update():
+    registry = Registry()
+    Counter("failures_total", "Failures", registry=registry)
+    Gauge("free_disk_mb", "Free disk", registry=registry).set_function(lambda: None)
+
+    text = registry.render()
+
+    assert "failures_total 0.0" in text
+    assert "free_disk_mb NaN" in text
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = Histogram("latency_seconds", "Latency", buckets=(0.1, 1), registry=registry)
+    for value in [0.05, 0.1, 0.5, 3]:
+        latency.observe(value)
+
+    text = registry.render()
+
+    assert 'latency_seconds_bucket{le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{le="1.0"} 3' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in text
+    assert "latency_seconds_sum 3.65" in text
+    assert "latency_seconds_count 4" in text
+
+
+def test_registration_and_label_errors():
+    registry = Registry()
+    counter = Counter("jobs_total", "Jobs", ["result"], registry=registry)
+
+    with pytest.raises(ValueError):
+        Counter("jobs_total", "Jobs", registry=registry)
+    with pytest.raises(ValueError):
+        counter.labels()
+
+
+def test_metrics_server_serves_the_registry():
+    registry = Registry()
+    Counter("scrapes_total", "Scrapes", registry=registry).inc()
+    server = start_metrics_server(0, "127.0.0.1", registry)
+    assert server is None  # Port 0 disables the listener
+
+    server = start_metrics_server(_free_port(), "127.0.0.1", registry)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "scrapes_total 1.0" in response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
@@ -0,0 +1,54 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+import pytest
+
+from test_stats_ingest import ARCHIVE
+
+
+@pytest.fixture
+def worker(local_stack):
+    local_stack.reset()
+    yield local_stack.worker
+    local_stack.worker.pool_broken.clear()
+
+
+def test_broken_extraction_pool_stops_the_worker(worker, monkeypatch):
+    pool = ProcessPoolExecutor(max_workers=1)
+    with pytest.raises(BrokenProcessPool):
+        pool.submit(os._exit, 1).result()  # The pool process dies, e.g. out of memory
+    monkeypatch.setattr(worker, "extract_pool", pool)
+    job = {"sensor_id": "sensor_1", "timestamp": "1718000000", "path": "/uploads/1718000000"}
+
+    assert worker.extract_job(job) == (job, None)
+    assert worker.pool_broken.is_set()
+    pool.shutdown()
+
+
+def test_backlog_is_committed_in_batches_with_one_thread(worker, tmp_path, monkeypatch):
+    for index in range(5):
+        upload = tmp_path / str(index)
+        upload.mkdir()
+        (upload / "stats.tar.gz").write_bytes(ARCHIVE)
+        worker.collection_aggregate.insert_one({"sensor_id": "sensor_1", "timestamp": str(index), "file_type": "stats",
+                                                "path": str(upload), "state": "pending", "extracted": 0})
+    batches = []
+    commit_batch = worker.commit_batch
+
+    def record_batch(results):
+        batches.append(len(results))
+        commit_batch(results)
+        if worker.collection_aggregate.count_documents({"extracted": 0}) == 0:
+            worker.pool_broken.set()  # Only way out of the loop
+
+    monkeypatch.setattr(worker, "commit_batch", record_batch)
+    monkeypatch.setattr(worker, "subscriber", SimpleNamespace(wait=lambda timeout=None: None))
+    monkeypatch.setattr(worker, "BATCH_TIMEOUT", 60.0)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        worker.check_and_process_unextracted_docs(executor, 1)
+
+    # Flushed once the queue is drained, not after every job
+    assert batches == [5]
+    assert worker.collection_stats.count_documents({"status": "completed"}) == 5
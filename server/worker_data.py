@@ -1,11 +1,14 @@
 import os
 import time
-import tarfile
+import socket
 import configparser
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+from data_ingest import extract_and_index_data, remove_data_archive, sample_time_range
+from jobqueue import ensure_job_indexes, claim_jobs, complete_job, fail_job, LeaseHeartbeat
+from notifier import subscriber_from_config
+from telemetry import Counter, Gauge, Histogram, mongo_command_metrics, start_metrics_server
 
 # server.py (or any other script)
 from logger import setup_logger
@@ -20,119 +23,128 @@ config.read('config.ini')
 
 # Constants from config
 BASE_PATH = Path(config['paths']['BASE_PATH'])
+DATA_URL_PREFIX = config.get('paths', 'DATA_URL_PREFIX', fallback='')
 DB_URI = config['mongodb']['MONGO_URI']
 DB_NAME = config['mongodb']['DB_NAME']
-COLLECTION_NAME_STATS = config['mongodb']['COLLECTION_NAME_STATS']
+COLLECTION_NAME_DATA = config.get('mongodb', 'COLLECTION_NAME_DATA', fallback='data_stats')
 COLLECTION_NAME_AGGREGATE = config['mongodb']['COLLECTION_NAME_AGGREGATE']
 PROJECT_NAME = config['DEFAULT']['PROJECT_ID']
 NUM_WORKERS = int(config['DEFAULT']['NUM_WORKERS'])
+POLL_INTERVAL = int(config['DEFAULT'].get('SLEEP_INTERVAL', 10))  # Default to 10 seconds
+LEASE_SECONDS = config.getint('worker', 'LEASE_SECONDS', fallback=300)
+MAX_ATTEMPTS = config.getint('worker', 'MAX_ATTEMPTS', fallback=3)
+WORKER_ID = config.get('worker', 'WORKER_ID', fallback='') or "{}:{}".format(socket.gethostname(), os.getpid())
+METRICS_HOST = config.get('metrics', 'HOST', fallback='0.0.0.0')
+METRICS_PORT = config.getint('metrics', 'DATA_WORKER_PORT', fallback=9102)
 
 # MongoDB Client
-client = MongoClient(DB_URI)
+client = MongoClient(DB_URI, event_listeners=[mongo_command_metrics])
 db = client[DB_NAME]
-collection_stats = db[COLLECTION_NAME_STATS]
+collection_data = db[COLLECTION_NAME_DATA]
 collection_aggregate = db[COLLECTION_NAME_AGGREGATE]
+ensure_job_indexes(collection_aggregate)
+# The sample browser lists the uploads of a sensor newest first
+collection_data.create_index([("project_name", 1), ("sensor_id", 1), ("timestamp", -1)])
 
-# Function to extract tar.gz without root folder
-def extract_tar_without_root(tar_path, extract_path):
-    """Extracts tar.gz file without creating a root directory."""
-    try:
-        with tarfile.open(tar_path, "r:gz") as tar:
-            tar.extractall(path=extract_path)
-        logging.info(f"Extracted {tar_path} to {extract_path}")
-    except (tarfile.TarError, IOError) as e:
-        logging.error(f"Error extracting {tar_path}: {e}")
+# Renews the leases of the jobs being processed
+heartbeat = LeaseHeartbeat(collection_aggregate, WORKER_ID, LEASE_SECONDS)
 
-# Function to process and insert data into MongoDB
-def process_and_insert_data(sensor_id, timestamp, dir_path):
-    """
-    Process tar.gz data for a specific sensor and timestamp, 
-    and insert or update MongoDB documents.
+# Wake-ups for new data uploads
+subscriber = subscriber_from_config(config, "data", collection_aggregate)
+
+# Metrics served on METRICS_PORT
+jobs_total = Counter("lensai_data_jobs_total", "Finished data jobs by result: done, failed or lease_lost", ["result"])
+processing_seconds = Histogram("lensai_data_processing_duration_seconds", "Time to extract a data archive and store its document")
+jobs_in_flight = Gauge("lensai_data_jobs_in_flight", "Data jobs being processed by this worker")
+Gauge("lensai_data_queue_depth", "Data jobs waiting to be processed").set_function(
+    lambda: collection_aggregate.count_documents({"file_type": "data", "extracted": 0, "state": {"$ne": "failed"}}))
+
+# Function to process a claimed data job
+def process_data_job(job):
     """
-    # Prepare the initial data
-    data = {
-        "project_name": PROJECT_NAME,
-        "sensor_id": sensor_id,
-        "timestamp": timestamp,
-        "status": "processing",
-        "aggregated": 0,
-        "type": []
-    }
+    Extract the samples of a claimed data job and write its data_stats document.
 
-    # Insert or update the document in the stats collection
+    Returns:
+        True if the job is done, False if it was released for a retry or failed.
+    """
+    sensor_id = job["sensor_id"]
+    timestamp = job["timestamp"]
+    start = time.perf_counter()
     try:
-        collection_stats.update_one(
+        processed_types = extract_and_index_data(job["path"], str(BASE_PATH), DATA_URL_PREFIX)
+        if processed_types is None:
+            raise ValueError("invalid data archive")
+        first_sample, last_sample = sample_time_range(processed_types)
+        collection_data.update_one(
             {"sensor_id": sensor_id, "timestamp": timestamp},
-            {"$setOnInsert": data},
+            {
+                "$setOnInsert": {
+                    "project_name": PROJECT_NAME,
+                    "sensor_id": sensor_id,
+                    "timestamp": timestamp
+                },
+                "$set": {
+                    "type": processed_types,
+                    "status": "completed",
+                    "first_sample": first_sample,
+                    "last_sample": last_sample
+                }
+            },
             upsert=True
         )
-    except DuplicateKeyError:
-        logging.info(f"Document already exists for sensor_id: {sensor_id}, timestamp: {timestamp}")
-        return
-
-    # Extract tar.gz file if it exists
-    tar_path = os.path.join(dir_path, "stats.tar.gz")
-    if os.path.exists(tar_path):
-        extract_tar_without_root(tar_path, dir_path)
-        os.remove(tar_path)  # Clean up the tar.gz file
-
-    # Process extracted data and update MongoDB
-    processed_data = {"type": [], "status": "completed"}
-    for metrictype in ["imgstats", "modelstats", "samples", "customstats"]:
-        metrictype_path = os.path.join(dir_path, metrictype)
-        if os.path.exists(metrictype_path):
-            stats = []
-            for file_name in os.listdir(metrictype_path):
-                if file_name.endswith(".bin"):
-                    metric, submetric = file_name.split('_', 1) if '_' in file_name else (file_name, "")
-                    metric = metric.replace(".bin", "")
-                    submetric = submetric.replace(".bin", "")
-                    stats.append({
-                        "metric": metric,
-                        "submetric": submetric,
-                        "path": os.path.join(metrictype_path, file_name)
-                    })
-            if stats:
-                processed_data["type"].append({
-                    "metrictype": metrictype,
-                    "stats": stats
-                })
+    except Exception as e:
+        state = fail_job(collection_aggregate, job, WORKER_ID, MAX_ATTEMPTS, e)
+        logging.error(f"Error processing data for sensor_id: {sensor_id}, timestamp: {timestamp}, now {state}: {e}")
+        jobs_total.labels("failed").inc()
+        return False
+    processing_seconds.observe(time.perf_counter() - start)
 
-    # Update the document with the processed data
-    try:
-        collection_stats.update_one(
-            {"sensor_id": sensor_id, "timestamp": timestamp},
-            {"$set": processed_data}
-        )
-        logging.info(f"Data processed for sensor_id: {sensor_id}, timestamp: {timestamp}")
+    if not complete_job(collection_aggregate, job, WORKER_ID):
+        logging.info(f"Lease lost for data job of sensor_id: {sensor_id}, timestamp: {timestamp}")
+        jobs_total.labels("lease_lost").inc()
+        return False
+    # Kept until now so a retry after a failed write can extract it again
+    remove_data_archive(job["path"])
+    jobs_total.labels("done").inc()
+    logging.info(f"Data processed for sensor_id: {sensor_id}, timestamp: {timestamp}")
+    return True
 
-        # Update the aggregation status
-        collection_aggregate.update_one(
-            {"sensor_id": sensor_id, "timestamp": timestamp},
-            {"$set": {"extracted": 1}}
-        )
-    except Exception as e:
-        logging.error(f"Error updating document for sensor_id: {sensor_id}, timestamp: {timestamp}: {e}")
+# Function to continuously claim and process data jobs
+def check_and_process_unextracted_docs(executor, num_threads=NUM_WORKERS):
+    """
+    Continuously claims data jobs and extracts them in parallel.
 
-# Function to continuously check and process unextracted documents
-def check_and_process_unextracted_docs(executor):
-    """Continuously checks for unextracted documents and processes them."""
+    Only as many jobs are claimed as there are free worker threads, so several
+    worker processes can share the queue.
+    """
+    in_flight = set()
     while True:
+        claimed = capacity = 0
         try:
-            # Find unextracted documents
-            unextracted_docs = collection_aggregate.find({"extracted": 0, "file_type": "stats"})
-            for doc in unextracted_docs:
-                sensor_id = doc["sensor_id"]
-                timestamp = doc["timestamp"]
-                dir_path = doc["path"]
-                executor.submit(process_and_insert_data, sensor_id, timestamp, dir_path)
+            in_flight = {future for future in in_flight if not future.done()}
+            jobs_in_flight.set(len(in_flight))
+            capacity = num_threads - len(in_flight)
+            if capacity > 0:
+                jobs = claim_jobs(collection_aggregate, "data", WORKER_ID, LEASE_SECONDS, capacity, MAX_ATTEMPTS)
+                heartbeat.add(jobs)
+                claimed = len(jobs)
+                for job in jobs:
+                    future = executor.submit(process_data_job, job)
+                    future.add_done_callback(lambda _, job=job: heartbeat.remove([job]))
+                    in_flight.add(future)
         except Exception as e:
             logging.error(f"Error processing unextracted documents: {e}")
-        time.sleep(10)  # Poll every 10 seconds
+
+        if in_flight and (capacity <= 0 or claimed == capacity):
+            # More jobs may be waiting, claim again as soon as a thread frees up
+            wait(in_flight, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+        else:
+            subscriber.wait()  # Wait for a new upload, or poll again after the fallback interval
 
 if __name__ == "__main__":
+    start_metrics_server(METRICS_PORT, METRICS_HOST)
+    heartbeat.start()
     # Setup Thread Pool for parallel processing
     with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
         # Start checking and processing unextracted documents
         check_and_process_unextracted_docs(executor)
-
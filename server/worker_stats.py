@@ -1,11 +1,19 @@
 import os
+import sys
 import time
-import tarfile
+import socket
+import threading
 import configparser
+import multiprocessing
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from stats_ingest import extract_and_index_stats, remove_stats_archive
+from jobqueue import ensure_job_indexes, claim_jobs, complete_jobs, fail_job, LeaseHeartbeat
+from notifier import publisher_from_config, subscriber_from_config
+from telemetry import Counter, Gauge, Histogram, mongo_command_metrics, start_metrics_server
 
 # server.py (or any other script)
 from logger import setup_logger
@@ -26,112 +34,218 @@ COLLECTION_NAME_AGGREGATE = config['mongodb']['COLLECTION_NAME_AGGREGATE']
 PROJECT_NAME = config['DEFAULT']['PROJECT_ID']
 NUM_WORKERS = int(config['DEFAULT']['NUM_WORKERS'])
 POLL_INTERVAL = int(config['DEFAULT'].get('SLEEP_INTERVAL', 10))  # Default to 10 seconds
+LEASE_SECONDS = config.getint('worker', 'LEASE_SECONDS', fallback=300)
+MAX_ATTEMPTS = config.getint('worker', 'MAX_ATTEMPTS', fallback=3)
+WORKER_ID = config.get('worker', 'WORKER_ID', fallback='') or "{}:{}".format(socket.gethostname(), os.getpid())
+EXECUTION_MODE = config.get('worker', 'EXECUTION_MODE', fallback='thread')
+NUM_PROCESSES = config.getint('worker', 'NUM_PROCESSES', fallback=0) or os.cpu_count() or 1
+BATCH_SIZE = config.getint('worker', 'BATCH_SIZE', fallback=100)
+BATCH_TIMEOUT = config.getfloat('worker', 'BATCH_TIMEOUT', fallback=1.0)
+SKETCH_STORAGE = config.get('storage', 'SKETCH_STORAGE', fallback='files')
+SEGMENT_ROOT = str(BASE_PATH / "lensai" / "segments") if SKETCH_STORAGE == "segments" else None
+STATS_ROOT = str(BASE_PATH / "lensai" / "stats")
+METRICS_HOST = config.get('metrics', 'HOST', fallback='0.0.0.0')
+METRICS_PORT = config.getint('metrics', 'STATS_WORKER_PORT', fallback=9101)
+
+# Process pool for extraction when EXECUTION_MODE is process. It is forked when the worker
+# starts, before the MongoDB client and the metrics server start any threads.
+extract_pool = None
+if __name__ == "__main__" and EXECUTION_MODE == "process":
+    # Decompression and tar parsing are CPU-bound, run them in worker processes
+    extract_pool = ProcessPoolExecutor(max_workers=NUM_PROCESSES, mp_context=multiprocessing.get_context("fork"))
+    extract_pool.submit(os.getpid).result()  # Fork the whole pool now
+    logging.info(f"Extracting stats archives in {NUM_PROCESSES} processes")
+
+# Set once a pool process died, e.g. out of memory. A broken pool fails every later
+# submit, so the worker exits and supervisord restarts it with a new pool.
+pool_broken = threading.Event()
 
 # MongoDB Client
-client = MongoClient(DB_URI)
+client = MongoClient(DB_URI, event_listeners=[mongo_command_metrics])
 db = client[DB_NAME]
 collection_stats = db[COLLECTION_NAME_STATS]
 collection_aggregate = db[COLLECTION_NAME_AGGREGATE]
+ensure_job_indexes(collection_aggregate)
 
-# Function to extract tar.gz without root folder
-def extract_tar_without_root(tar_path, extract_path):
-    """Extracts tar.gz file without creating a root directory."""
-    try:
-        with tarfile.open(tar_path, "r:gz") as tar:
-            tar.extractall(path=extract_path)
-        logging.info(f"Extracted {tar_path} to {extract_path}")
-    except (tarfile.TarError, IOError) as e:
-        logging.error(f"Error extracting {tar_path}: {e}")
-
-# Function to process and insert data into MongoDB
-def process_and_insert_data(sensor_id, timestamp, dir_path):
+# Renews the leases of the jobs being extracted or waiting for their batch commit
+heartbeat = LeaseHeartbeat(collection_aggregate, WORKER_ID, LEASE_SECONDS)
+
+# Metrics served on METRICS_PORT
+jobs_total = Counter("lensai_stats_jobs_total", "Finished stats jobs by result: done, failed or lease_lost", ["result"])
+extraction_seconds = Histogram("lensai_stats_extraction_duration_seconds", "Time to extract and index a stats archive")
+commit_seconds = Histogram("lensai_stats_commit_duration_seconds", "Time to commit a micro-batch of finished jobs")
+batch_size = Histogram("lensai_stats_commit_batch_size", "Finished jobs per committed micro-batch",
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+jobs_in_flight = Gauge("lensai_stats_jobs_in_flight", "Stats jobs being extracted by this worker")
+Gauge("lensai_stats_queue_depth", "Stats jobs waiting to be extracted").set_function(
+    lambda: collection_aggregate.count_documents({"file_type": "stats", "extracted": 0, "state": {"$ne": "failed"}}))
+
+# Wake-ups for new stats jobs, and notifications to the aggregator for finished ones
+publisher = publisher_from_config(config)
+subscriber = subscriber_from_config(config, "stats", collection_aggregate)
+
+# Function to extract a claimed job
+def extract_job(job):
     """
-    Process tar.gz data for a specific sensor and timestamp,
-    and insert or update MongoDB documents.
+    Extract and index the archive of a claimed job, in a worker process if configured.
+
+    Returns:
+        A (job, processed_types) tuple; processed_types is None if the job failed.
     """
-    # Prepare the initial data
-    data = {
-        "project_name": PROJECT_NAME,
-        "sensor_id": sensor_id,
-        "timestamp": timestamp,
-        "status": "processing",
-        "aggregated": 0,
-        "type": []
-    }
-
-    # Insert or update the document in the stats collection
+    sensor_id = job["sensor_id"]
+    timestamp = job["timestamp"]
+    start = time.perf_counter()
     try:
-        collection_stats.update_one(
-            {"sensor_id": sensor_id, "timestamp": timestamp},
-            {"$setOnInsert": data},
-            upsert=True
-        )
-    except DuplicateKeyError:
-        logging.info(f"Document already exists for sensor_id: {sensor_id}, timestamp: {timestamp}")
-        return
-
-    # Extract tar.gz file if it exists
-    tar_path = os.path.join(dir_path, "stats.tar.gz")
-    if os.path.exists(tar_path):
-        extract_tar_without_root(tar_path, dir_path)
-        os.remove(tar_path)  # Clean up the tar.gz file
-    # Process extracted data and update MongoDB
-    processed_data = {"type": [], "status": "completed"}
-    for metrictype in ["imgstats", "modelstats", "samples", "customstats"]:
-        metrictype_path = os.path.join(dir_path, metrictype)
-        if os.path.exists(metrictype_path):
-            stats = []
-            for file_name in os.listdir(metrictype_path):
-                if file_name.endswith(".bin") and not file_name.startswith("._"):
-                    metric, submetric = file_name.split('_', 1) if '_' in file_name else (file_name, "")
-                    metric = metric.replace(".bin", "")
-                    submetric = submetric.replace(".bin", "")
-                    stats.append({
-                        "metric": metric,
-                        "submetric": submetric,
-                        "path": os.path.join(metrictype_path, file_name)
-                    })
-            if stats:
-                processed_data["type"].append({
-                    "metrictype": metrictype,
-                    "stats": stats
-                })
-
-    # Update the document with the processed data
-    try:
-        collection_stats.update_one(
-            {"sensor_id": sensor_id, "timestamp": timestamp},
-            {"$set": processed_data}
-        )
-        logging.info(f"Data processed for sensor_id: {sensor_id}, timestamp: {timestamp}")
-
-        # Update the aggregation status
-        collection_aggregate.update_one(
-            {"sensor_id": sensor_id, "timestamp": timestamp},
-            {"$set": {"extracted": 1}}
-        )
+        if extract_pool is not None:
+            processed_types = extract_pool.submit(extract_and_index_stats, job["path"], SEGMENT_ROOT, sensor_id).result()
+        else:
+            processed_types = extract_and_index_stats(job["path"], SEGMENT_ROOT, sensor_id)
+    except BrokenProcessPool as e:
+        logging.error(f"Extraction process pool broken while processing sensor_id: {sensor_id}, timestamp: {timestamp}: {e}")
+        pool_broken.set()
+        processed_types = None
     except Exception as e:
-        logging.error(f"Error updating document for sensor_id: {sensor_id}, timestamp: {timestamp}: {e}")
+        logging.error(f"Error processing job for sensor_id: {sensor_id}, timestamp: {timestamp}: {e}")
+        processed_types = None
+    extraction_seconds.observe(time.perf_counter() - start)
+    return job, processed_types
+
+# Function to write a micro-batch of finished jobs to MongoDB
+def commit_batch(results):
+    """
+    Write the sensor_stats documents of finished jobs and mark the jobs as done.
 
-# Function to continuously check and process unextracted documents
-def check_and_process_unextracted_docs(executor):
-    """Continuously checks for unextracted documents and processes them."""
-    while True:
+    Each collection gets a single unordered bulk write. A job whose write fails
+    is released for a retry without failing the rest of the batch.
+    """
+    start = time.perf_counter()
+    succeeded = [(job, processed_types) for job, processed_types in results if processed_types is not None]
+    failed = [job for job, processed_types in results if processed_types is None]
+
+    failed_indexes = set()
+    if succeeded:
+        extracted_at = time.time()
+        requests = [
+            UpdateOne(
+                {"sensor_id": job["sensor_id"], "timestamp": job["timestamp"]},
+                {
+                    "$setOnInsert": {
+                        "project_name": PROJECT_NAME,
+                        "sensor_id": job["sensor_id"],
+                        "timestamp": job["timestamp"],
+                        "aggregated": 0
+                    },
+                    "$set": {"type": processed_types, "status": "completed",
+                             "received_at": job.get("received_at"), "extracted_at": extracted_at}
+                },
+                upsert=True
+            )
+            for job, processed_types in succeeded
+        ]
         try:
-            # Find unextracted documents
-            unextracted_docs = collection_aggregate.find({"extracted": 0, "file_type": "stats"})
-            for doc in unextracted_docs:
-                sensor_id = doc["sensor_id"]
-                timestamp = doc["timestamp"]
-                dir_path = doc["path"]
-                executor.submit(process_and_insert_data, sensor_id, timestamp, dir_path)
+            collection_stats.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            failed_indexes = {error["index"] for error in e.details.get("writeErrors", [])}
+            logging.error(f"{len(failed_indexes)} of {len(requests)} sensor_stats writes failed: {e}")
+        except PyMongoError as e:
+            failed_indexes = set(range(len(requests)))
+            logging.error(f"Error writing sensor_stats batch: {e}")
+
+    done = [job for index, (job, _) in enumerate(succeeded) if index not in failed_indexes]
+    failed += [job for index, (job, _) in enumerate(succeeded) if index in failed_indexes]
+
+    completed_jobs = complete_jobs(collection_aggregate, done, WORKER_ID)
+    completed = len(completed_jobs)
+    if SEGMENT_ROOT is not None:
+        # The sketches are in the segment store now, drop the uploaded archives.
+        # A job whose lease was lost may be extracted by another worker, its archive is kept.
+        for job in completed_jobs:
+            remove_stats_archive(job["path"], STATS_ROOT)
+    if completed < len(done):
+        logging.info(f"Lease lost for {len(done) - completed} jobs")
+    for job in failed:
+        state = fail_job(collection_aggregate, job, WORKER_ID, MAX_ATTEMPTS)
+        logging.error(f"Job for sensor_id: {job['sensor_id']}, timestamp: {job['timestamp']} failed, now {state}")
+    heartbeat.remove(job for job, _ in results)
+    if completed:
+        publisher.publish("aggregate")
+
+    jobs_total.labels("done").inc(completed)
+    jobs_total.labels("lease_lost").inc(len(done) - completed)
+    jobs_total.labels("failed").inc(len(failed))
+    batch_size.observe(len(results))
+    commit_ms = (time.perf_counter() - start) * 1000
+    commit_seconds.observe(commit_ms / 1000)
+    logging.info(f"Committed batch of {len(results)} jobs ({completed} done, {len(failed)} failed) in {commit_ms:.1f} ms")
+
+# Function to continuously claim and process unextracted documents
+def check_and_process_unextracted_docs(executor, num_threads=NUM_WORKERS):
+    """
+    Continuously claims unextracted documents and processes them.
+
+    Only as many jobs are claimed as there are free worker threads, so a job is
+    never submitted twice and several worker processes can share the queue.
+    Finished jobs are committed in micro-batches of up to BATCH_SIZE jobs, or
+    after BATCH_TIMEOUT seconds, or as soon as the queue is drained: no job is
+    running anymore and none could be claimed. While a backlog is worked off,
+    jobs keep being claimed and their results collected into one batch.
+
+    Returns once the extraction process pool is broken, after committing the
+    jobs that were running.
+    """
+    in_flight = set()
+    results = []
+    batch_deadline = None
+    while not pool_broken.is_set():
+        claimed = capacity = 0
+        try:
+            finished = {future for future in in_flight if future.done()}
+            in_flight -= finished
+            jobs_in_flight.set(len(in_flight))
+            results.extend(future.result() for future in finished)
+            if results and batch_deadline is None:
+                batch_deadline = time.monotonic() + BATCH_TIMEOUT
+
+            capacity = num_threads - len(in_flight)
+            if capacity > 0:
+                jobs = claim_jobs(collection_aggregate, "stats", WORKER_ID, LEASE_SECONDS, capacity, MAX_ATTEMPTS)
+                heartbeat.add(jobs)
+                claimed = len(jobs)
+                for job in jobs:
+                    in_flight.add(executor.submit(extract_job, job))
+
+            drained = not in_flight and claimed == 0
+            if results and (len(results) >= BATCH_SIZE or drained or time.monotonic() >= batch_deadline):
+                batch, results, batch_deadline = results, [], None
+                commit_batch(batch)
         except Exception as e:
             logging.error(f"Error processing unextracted documents: {e}")
-        time.sleep(POLL_INTERVAL)  # Poll every X seconds as defined in config.ini
+
+        if in_flight and (capacity <= 0 or claimed == capacity):
+            # More jobs may be waiting, claim again as soon as a thread frees up, or commit the batch when it is due
+            timeout = max(0.0, batch_deadline - time.monotonic()) if results else POLL_INTERVAL
+            wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+        elif in_flight or results:
+            # Collect finished jobs regularly, or claim new ones as soon as they arrive
+            subscriber.wait(BATCH_TIMEOUT)
+        else:
+            subscriber.wait()  # Wait for a new job, or poll again after the fallback interval
+
+    # The running jobs fail right away on a broken pool and are released for another attempt
+    wait(in_flight)
+    results.extend(future.result() for future in in_flight)
+    if results:
+        commit_batch(results)
 
 if __name__ == "__main__":
+    start_metrics_server(METRICS_PORT, METRICS_HOST)
+    heartbeat.start()
+    # Threads only orchestrate jobs and talk to MongoDB, so one per process keeps the pool busy
+    num_threads = max(NUM_WORKERS, NUM_PROCESSES) if extract_pool is not None else NUM_WORKERS
+
     # Setup Thread Pool for parallel processing
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
         # Start checking and processing unextracted documents
-        check_and_process_unextracted_docs(executor)
-
+        check_and_process_unextracted_docs(executor, num_threads)
+    logging.error("Extraction process pool is broken, exiting to be restarted with a new one")
+    sys.exit(1)